@@ -0,0 +1,119 @@
+"""
+Join request audit log: decisions buffered in memory and written to per-chat Redis streams in batches
+"""
+import asyncio
+import time
+from collections import deque
+from lib.metrics import metrics
+from lib.executor import BlockingExecutor
+from lib.redis import Redis
+
+
+class JoinAudit:
+    """
+    Keeps a record of every join request decision. The join path only appends to a bounded in-memory ring
+    buffer; a background task takes the buffered records in batches and appends them to the chat streams with
+    one pipelined XADD per batch, trimming each stream to about max_len entries. When Redis is slow and the
+    buffer is full, the oldest records are dropped. Chat statistics are computed from the chat's stream.
+    """
+    redis = None
+    logger = None
+    max_len = 1000
+    buffer = None
+    executor = None
+    redis_key_prefix = 'join_audit'
+
+    BUFFER_SIZE = 10000
+    BATCH_SIZE = 500
+    # Outcomes of requests checked against the whitelist, the base of the approval rate
+    CHECKED_OUTCOMES = ('approved', 'not_allowed', 'declined')
+
+    def __init__(self, redis_client: Redis, logger, max_len: int = 1000, redis_key_prefix: str = 'join_audit'):
+        self.redis = redis_client
+        self.logger = logger
+        self.max_len = max_len
+        self.redis_key_prefix = redis_key_prefix
+        self.buffer = deque(maxlen=self.BUFFER_SIZE)
+        self.executor = BlockingExecutor('audit', max_workers=1)
+
+    def _redis_key(self, chat_id):
+        return f"{self.redis_key_prefix}:{chat_id}"
+
+    def record(self, chat_id, user_id, username, outcome, reader_type, seconds: float):
+        """Buffer a decision record, called on the join path"""
+        if len(self.buffer) == self.buffer.maxlen:
+            metrics.inc('join_audit_dropped_total', reason='overflow')
+
+        self.buffer.append((chat_id, {
+            'user_id': user_id,
+            'username': username or '',
+            'outcome': outcome,
+            'reader': reader_type,
+            'seconds': f'{seconds:.6f}',
+        }))
+
+    async def flush(self):
+        """Write buffered records to Redis, returns the number written"""
+        written = 0
+
+        while self.buffer:
+            batch = [self.buffer.popleft() for _ in range(min(self.BATCH_SIZE, len(self.buffer)))]
+            entries_by_stream = {}
+            for chat_id, fields in batch:
+                entries_by_stream.setdefault(self._redis_key(chat_id), []).append(fields)
+
+            try:
+                await self.executor.run(self.redis.xadd_many, entries_by_stream, self.max_len)
+            except Exception as e:
+                metrics.inc('join_audit_dropped_total', len(batch), reason='error')
+                self.logger.warning('Could not write %s join audit records: %s', len(batch), str(e))
+                break
+
+            metrics.inc('join_audit_records_total', len(batch))
+            written += len(batch)
+
+        return written
+
+    async def run_periodic(self, interval: float):
+        """Flush the buffer every interval seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    async def stats(self, chat_id, period: float):
+        """
+        Returns decision statistics of the chat for the last period seconds. The stream keeps about max_len
+        entries, so with more requests in the period only the latest are counted: then truncated is True and
+        since is the time of the oldest entry counted.
+        """
+        return await self.executor.run(self._stats, chat_id, period)
+
+    def _stats(self, chat_id, period):
+        # Stream entry ids start with the entry time in milliseconds
+        start = str(int((time.time() - period) * 1000))
+        key = self._redis_key(chat_id)
+        entries = self.redis.xrange(key, start)
+
+        # The period starts before the oldest entry kept in a trimmed stream
+        truncated = False
+        if entries and len(entries) >= self.max_len:
+            truncated = self.redis.xrange(key, count=1)[0][0] == entries[0][0]
+
+        outcomes = {}
+        latencies = []
+        for _, fields in entries:
+            outcomes[fields['outcome']] = outcomes.get(fields['outcome'], 0) + 1
+            latencies.append(float(fields['seconds']))
+
+        latencies.sort()
+        checked = sum(outcomes.get(outcome, 0) for outcome in self.CHECKED_OUTCOMES)
+
+        return {
+            'total': len(entries),
+            'since': int(entries[0][0].split('-')[0]) / 1000 if entries else None,
+            'truncated': truncated,
+            'outcomes': outcomes,
+            'approval_rate': outcomes.get('approved', 0) / checked if checked else None,
+            'percentiles': {p: latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+                            for p in (50, 95, 99)} if latencies else {},
+        }
@@ -0,0 +1,108 @@
+"""
+Whitelist source change events: diffs of consecutive source snapshots published to a Redis stream
+"""
+import json
+import logging
+import time
+from lib.metrics import metrics
+from lib.profiler import profiler
+from lib.lru_cache import LruCache
+from lib.redis import Redis
+from lib.snapshot import diff_snapshots
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotChanges:
+    """
+    Publishes usernames added to and removed from a whitelist source, and changed condition values, as entries of
+    a Redis stream. Readers pass consecutive snapshots of a source with a digest of their content: snapshots with
+    the digest of the previous one are not diffed. The previous snapshot of each source is kept for cache_ttl
+    seconds after its last read, so a change is published if the source is read again within that time.
+    Diffs are computed and published on the reader's executor, off the join request path.
+    Large diffs are split into several entries sharing one change id.
+    """
+    redis = None
+    stream = 'whitelist_changes'
+    max_len = 10000
+    previous = None
+    digests = None
+    tasks = None
+
+    USERNAMES_PER_ENTRY = 1000
+
+    def __init__(self, redis_client: Redis, stream: str = 'whitelist_changes', max_len: int = 10000,
+                 cache_size: int = 1000, cache_ttl: float = 3600):
+        self.redis = redis_client
+        self.stream = stream
+        self.max_len = max_len
+        self.previous = LruCache('snapshot_changes', max_size=cache_size, ttl=cache_ttl)
+        self.digests = LruCache('snapshot_digests', max_size=cache_size, ttl=cache_ttl)
+        self.tasks = set()
+
+    @staticmethod
+    def source_key(reader_type, source):
+        return json.dumps([reader_type, source], sort_keys=True, default=str)
+
+    def update(self, executor, reader_type, source, snapshot, digest=None):
+        """Remember snapshot as the latest one of the source and publish its diff with the previous one if changed"""
+        key = self.source_key(reader_type, source)
+        old = self.previous.get(key)
+        old_digest = self.digests.get(key)
+        self.previous.set(key, snapshot)
+        self.digests.set(key, digest)
+
+        if digest is not None and digest == old_digest:
+            return
+
+        if old is not None and old is not snapshot:
+            self.submit(executor, self.publish_diff, reader_type, source, old, snapshot)
+
+    def submit(self, executor, func, *args):
+        """Run func on the executor in background"""
+        async def run():
+            try:
+                await executor.run(func, *args)
+            except Exception as e:
+                logger.warning('Could not publish whitelist changes: %s', str(e))
+
+        task = profiler.create_task(run())
+        # Keep a reference until the task is done
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def publish_diff(self, reader_type, source, old, new):
+        """Blocking: diff two snapshots and publish the changes"""
+        self.publish(reader_type, source, *diff_snapshots(old, new))
+
+    def publish(self, reader_type, source, added=(), removed=(), changed=None):
+        """Blocking: publish changes of the source to the stream"""
+        added = list(added)
+        removed = list(removed)
+        changed = list((changed or {}).items())
+
+        if not added and not removed and not changed:
+            return
+
+        metrics.inc('snapshot_changes_total', len(added), reader=reader_type, change='added')
+        metrics.inc('snapshot_changes_total', len(removed), reader=reader_type, change='removed')
+        metrics.inc('snapshot_changes_total', len(changed), reader=reader_type, change='changed')
+
+        size = self.USERNAMES_PER_ENTRY
+        parts = max(1, -(-max(len(added), len(removed), len(changed)) // size))
+        change_id = f'{time.time_ns()}'
+        entries = []
+
+        for part in range(parts):
+            entries.append({
+                'change_id': change_id,
+                'part': part + 1,
+                'parts': parts,
+                'reader': reader_type,
+                'source': json.dumps(source, sort_keys=True, default=str),
+                'added': json.dumps(added[part * size:(part + 1) * size]),
+                'removed': json.dumps(removed[part * size:(part + 1) * size]),
+                'changed': json.dumps(dict(changed[part * size:(part + 1) * size]), default=str),
+            })
+
+        self.redis.xadd_many({self.stream: entries}, self.max_len)
@@ -0,0 +1,278 @@
+"""
+Boolean condition expressions over table columns, e.g. 2 in ("yes") and (4 > 18 or not 5 = "banned")
+"""
+import json
+import re
+from functools import lru_cache
+from lib.params import Params
+
+
+class Condition:
+    """
+    Parses condition expressions into a tree of plain dicts that is stored with the whitelist params, and compiles
+    the tree into a closure evaluated row by row over the fetched columns with short-circuiting.
+    Comparisons are stored as before, {'operator': '=', 'value': 5, 'param': '2'}, so a single comparison is stored
+    exactly as the old single-condition syntax was, and stored conditions keep working. Boolean nodes are
+    {'operator': 'and' | 'or' | 'not', 'args': [...]}.
+    Expressions are limited in length, nesting and comparison count, which bounds the cost of evaluating a row.
+    """
+    MAX_LENGTH = 1000
+    MAX_COMPARISONS = 16
+    MAX_VALUES = 100
+    MAX_DEPTH = 32
+
+    # Quoted strings only start a token; inside words quotes are plain characters, as in O'Brien
+    TOKEN_RE = re.compile(r'\s*(?:("[^"]*"|\'[^\']*\')|(!=|=|<|>|\(|\)|,)|([^\s!=<>(),]+))')
+    COMPARISON_OPERATORS = ('=', '!=', '<', '>')
+    BOOLEAN_OPERATORS = ('and', 'or', 'not')
+
+    @classmethod
+    def parse(cls, text: str) -> dict:
+        """Parse expression text into a condition tree, raises Exception on invalid expressions"""
+        if len(text) > cls.MAX_LENGTH:
+            raise Exception(f'Condition is longer than {cls.MAX_LENGTH} characters')
+
+        text = text.strip()
+        parser = _Parser(text, *cls.scan(text))
+        condition = parser.parse_or()
+
+        if parser.peek() is not None:
+            raise Exception(f'Unexpected "{parser.peek()[1]}" in condition')
+
+        if cls.count_comparisons(condition) > cls.MAX_COMPARISONS:
+            raise Exception(f'Condition has more than {cls.MAX_COMPARISONS} comparisons')
+
+        return condition
+
+    @classmethod
+    def tokenize(cls, text: str):
+        """Returns (kind, token) pairs, kind being 'string', 'op' or 'word'"""
+        return cls.scan(text.strip())[0]
+
+    @classmethod
+    def scan(cls, text: str):
+        """Returns (kind, token) pairs and their (start, end) positions in text"""
+        tokens = []
+        spans = []
+        pos = 0
+
+        while pos < len(text):
+            match = cls.TOKEN_RE.match(text, pos)
+            if not match or match.end() == pos:
+                raise Exception(f'Invalid condition near "{text[pos:pos + 20]}"')
+
+            string, op, word = match.groups()
+            if string is not None:
+                tokens.append(('string', string[1:-1]))
+            elif op is not None:
+                tokens.append(('op', op))
+            else:
+                tokens.append(('word', word))
+
+            spans.append((match.start(match.lastindex), match.end()))
+            pos = match.end()
+
+        return tokens, spans
+
+    @classmethod
+    def count_comparisons(cls, condition) -> int:
+        if condition.get('operator') in cls.BOOLEAN_OPERATORS:
+            return sum(cls.count_comparisons(arg) for arg in condition['args'])
+
+        return 1
+
+    @classmethod
+    def columns(cls, condition) -> list:
+        """Column numbers used by the condition, in order of appearance"""
+        if condition.get('operator') in cls.BOOLEAN_OPERATORS:
+            return list(dict.fromkeys(column for arg in condition['args'] for column in cls.columns(arg)))
+
+        return [int(condition['param'])]
+
+    @classmethod
+    def compile(cls, condition):
+        """
+        Returns function(values, i) checking row i, values being a dict of column number -> list of column values.
+        Missing cells are compared as empty strings, strings case-insensitively.
+        """
+        return _compile(json.dumps(condition, sort_keys=True))
+
+
+@lru_cache(maxsize=256)
+def _compile(condition_json: str):
+    # Stored conditions are compiled once per distinct condition
+    return _compile_node(json.loads(condition_json))
+
+
+def _compile_node(condition):
+    operator = condition.get('operator')
+
+    if operator in ('and', 'or'):
+        checks = [_compile_node(arg) for arg in condition['args']]
+
+        if operator == 'and':
+            return lambda values, i: all(check(values, i) for check in checks)
+
+        return lambda values, i: any(check(values, i) for check in checks)
+
+    if operator == 'not':
+        check = _compile_node(condition['args'][0])
+
+        return lambda values, i: not check(values, i)
+
+    column = int(condition['param'])
+
+    def compare(values, i):
+        column_values = values[column]
+
+        return Params.check_condition(condition, column_values[i] if i < len(column_values) else '', lower_case=True)
+
+    return compare
+
+
+class _Parser:
+    """
+    Recursive descent parser:
+      or_expr    := and_expr ('or' and_expr)*
+      and_expr   := not_expr ('and' not_expr)*
+      not_expr   := 'not' not_expr | '(' or_expr ')' | comparison
+      comparison := column ('=' | '!=' | '<' | '>') value | column ['not'] 'in' '(' value (',' value)* ')'
+      value      := quoted string | (word | quoted string | '=')+
+    Other values are read as in the single-condition syntax: the source text of the value, stripped of spaces
+    and quotes. So 2 = foo bar and 3 > 1 compares column 2 with "foo bar", and 2 = a=b with "a=b". The text of a
+    value ends at an operator other than '=', a comma, a parenthesis or an 'and' / 'or' keyword.
+    """
+    text = None
+    tokens = None
+    spans = None
+    pos = 0
+    depth = 0
+
+    def __init__(self, text, tokens, spans):
+        self.text = text
+        self.tokens = tokens
+        self.spans = spans
+        self.pos = 0
+        self.depth = 0
+
+    def peek(self, offset=0):
+        return self.tokens[self.pos + offset] if self.pos + offset < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise Exception('Unexpected end of condition')
+
+        self.pos += 1
+
+        return token
+
+    def is_keyword(self, keyword, offset=0):
+        token = self.peek(offset)
+
+        return token is not None and token[0] == 'word' and token[1].lower() == keyword
+
+    def expect_op(self, op):
+        kind, token = self.next()
+        if kind != 'op' or token != op:
+            raise Exception(f'Expected "{op}" in condition, got "{token}"')
+
+    def parse_or(self):
+        return self.parse_chain('or', self.parse_and)
+
+    def parse_and(self):
+        return self.parse_chain('and', self.parse_not)
+
+    def parse_chain(self, operator, parse_operand):
+        args = [parse_operand()]
+
+        while self.is_keyword(operator):
+            self.next()
+            args.append(parse_operand())
+
+        if len(args) == 1:
+            return args[0]
+
+        # Flatten nested chains of the same operator, e.g. from parentheses
+        flat = []
+        for arg in args:
+            flat.extend(arg['args'] if arg.get('operator') == operator else [arg])
+
+        return {'operator': operator, 'args': flat}
+
+    def parse_not(self):
+        if self.is_keyword('not'):
+            self.next()
+            return {'operator': 'not', 'args': [self.nested(self.parse_not)]}
+
+        token = self.peek()
+        if token == ('op', '('):
+            self.next()
+            condition = self.nested(self.parse_or)
+            self.expect_op(')')
+            return condition
+
+        return self.parse_comparison()
+
+    def nested(self, parse):
+        self.depth += 1
+        if self.depth > Condition.MAX_DEPTH:
+            raise Exception(f'Condition is nested deeper than {Condition.MAX_DEPTH} levels')
+
+        try:
+            return parse()
+        finally:
+            self.depth -= 1
+
+    def parse_comparison(self):
+        kind, column = self.next()
+        if kind != 'word' or not column.isdigit() or int(column) < 1:
+            raise Exception(f'Expected column number in condition, got "{column}"')
+
+        if self.is_keyword('in') or (self.is_keyword('not') and self.is_keyword('in', 1)):
+            operator = 'in' if self.is_keyword('in') else 'not in'
+            self.pos += len(operator.split())
+
+            return {'operator': operator, 'value': self.parse_values(), 'param': column}
+
+        kind, operator = self.next()
+        if kind != 'op' or operator not in Condition.COMPARISON_OPERATORS:
+            raise Exception(f'Expected comparison operator in condition, got "{operator}"')
+
+        return {'operator': operator, 'value': self.parse_value(), 'param': column}
+
+    def parse_values(self):
+        self.expect_op('(')
+        values = [self.parse_value()]
+
+        while self.peek() == ('op', ','):
+            self.next()
+            values.append(self.parse_value())
+
+        self.expect_op(')')
+
+        if len(values) > Condition.MAX_VALUES:
+            raise Exception(f'Condition lists are limited to {Condition.MAX_VALUES} values')
+
+        return values
+
+    def parse_value(self):
+        kind, token = self.next()
+        if kind == 'op':
+            raise Exception(f'Expected value in condition, got "{token}"')
+
+        start = self.pos - 1
+        while self.peek() is not None and (self.peek() == ('op', '=') or self.peek()[0] != 'op'
+                                           and not self.is_keyword('and') and not self.is_keyword('or')):
+            self.pos += 1
+
+        if kind == 'word' or self.pos - start > 1:
+            token = self.text[self.spans[start][0]:self.spans[self.pos - 1][1]].strip().strip('"\'')
+
+        # Quoted numbers are numbers too, as in the single-condition syntax
+        try:
+            if '.' in token:
+                return float(token)
+            return int(token)
+        except ValueError:
+            return token
@@ -0,0 +1,116 @@
+"""
+Bounded thread pool for running blocking library calls outside of the event loop
+"""
+import asyncio
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from lib.metrics import metrics
+
+
+class BlockingExecutor:
+    """
+    Runs blocking calls on a dedicated, size-limited thread pool with per-call timeouts.
+    Calls sharing a key (e.g. one spreadsheet) may only occupy part of the workers, so one slow source
+    cannot starve the others. A timed out call keeps its key slot until its worker thread really finishes, so a
+    hung source holds at most per_key_limit workers. Queue length, wait time and timeouts are exported as metrics.
+    """
+    name = None
+    pool = None
+    max_workers = 4
+    timeout = None
+    per_key_limit = 1
+    key_semaphores = None
+
+    def __init__(self, name: str, max_workers: int = 4, timeout: float | None = None, per_key_limit: int | None = None):
+        self.name = name
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.per_key_limit = per_key_limit if per_key_limit else max(1, max_workers // 2)
+        # key -> [semaphore, calls holding or waiting for it]; idle keys are dropped, so keys may be unbounded
+        self.key_semaphores = {}
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    def _acquire_key_semaphore(self, key):
+        entry = self.key_semaphores.get(key)
+        if entry is None:
+            entry = self.key_semaphores[key] = [asyncio.Semaphore(self.per_key_limit), 0]
+
+        entry[1] += 1
+
+        return entry[0]
+
+    def _release_key_semaphore(self, key, semaphore=None):
+        """Drop a call of the key, also freeing the slot it held if semaphore is given"""
+        if semaphore is not None:
+            semaphore.release()
+
+        entry = self.key_semaphores[key]
+        entry[1] -= 1
+
+        if entry[1] == 0:
+            del self.key_semaphores[key]
+
+    def _release_key_semaphore_later(self, loop, key, semaphore, future):
+        """Done callback of the worker future, called from the worker thread"""
+        try:
+            loop.call_soon_threadsafe(self._release_key_semaphore, key, semaphore)
+        except RuntimeError:
+            # The event loop is already closed at shutdown
+            pass
+
+    async def run(self, func, *args, key=None, timeout=None):
+        """Run func(*args) on the pool and return its result, raising on timeout"""
+        timeout = timeout if timeout is not None else self.timeout
+
+        try:
+            return await asyncio.wait_for(self._run(func, args, key), timeout)
+        except asyncio.TimeoutError:
+            metrics.inc('executor_timeouts_total', executor=self.name)
+            raise Exception(f'{self.name} call timed out after {timeout}s')
+
+    async def _run(self, func, args, key):
+        submitted = time.perf_counter()
+        metrics.add_gauge('executor_queue_length', 1, executor=self.name)
+
+        def call():
+            metrics.add_gauge('executor_queue_length', -1, executor=self.name)
+            metrics.observe('executor_wait_seconds', time.perf_counter() - submitted, executor=self.name)
+
+            return func(*args)
+
+        future = None
+        # Context variables of the caller (request priority, profile) stay visible in the worker thread
+        context = contextvars.copy_context()
+
+        try:
+            if key is None:
+                future = self.pool.submit(context.run, call)
+                return await asyncio.wrap_future(future)
+
+            semaphore = self._acquire_key_semaphore(key)
+            try:
+                await semaphore.acquire()
+            except BaseException:
+                self._release_key_semaphore(key)
+                raise
+
+            try:
+                future = self.pool.submit(context.run, call)
+            except BaseException:
+                self._release_key_semaphore(key, semaphore)
+                raise
+
+            # The slot is freed when the worker is done, not when the caller stops waiting for it
+            future.add_done_callback(partial(self._release_key_semaphore_later, asyncio.get_running_loop(), key,
+                                             semaphore))
+
+            return await asyncio.wrap_future(future)
+        finally:
+            # Cancelled or timed out before a worker picked the call up: it will never run
+            if future is None or future.cancel():
+                metrics.add_gauge('executor_queue_length', -1, executor=self.name)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,69 @@
+"""
+Bounded LRU cache with optional TTL and hit/miss/eviction metrics
+"""
+import time
+from collections import OrderedDict
+from lib.metrics import metrics
+
+
+class LruCache:
+    """
+    Mapping limited to max_size entries, evicting the least recently used one.
+    Entries older than ttl seconds (if set) are treated as missing and dropped on access.
+    """
+    name = None
+    max_size = 1000
+    ttl = None
+    entries = None
+
+    def __init__(self, name: str, max_size: int = 1000, ttl: float | None = None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """Returns cached value marking it as recently used, or default"""
+        entry = self.entries.get(key)
+
+        if entry is not None and self.ttl and time.monotonic() - entry[0] > self.ttl:
+            del self.entries[key]
+            metrics.inc('cache_evictions_total', cache=self.name, reason='ttl')
+            metrics.set_gauge('cache_size', len(self.entries), cache=self.name)
+            entry = None
+
+        if entry is None:
+            metrics.inc('cache_requests_total', cache=self.name, result='miss')
+            return default
+
+        self.entries.move_to_end(key)
+        metrics.inc('cache_requests_total', cache=self.name, result='hit')
+
+        return entry[1]
+
+    def set(self, key, value):
+        """Store value evicting least recently used entries above max_size"""
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            metrics.inc('cache_evictions_total', cache=self.name, reason='size')
+
+        metrics.set_gauge('cache_size', len(self.entries), cache=self.name)
+
+    def delete(self, key):
+        if self.entries.pop(key, None) is not None:
+            metrics.set_gauge('cache_size', len(self.entries), cache=self.name)
+
+    def age(self, key):
+        """Returns seconds since the entry was stored, or None if it is not cached"""
+        entry = self.entries.get(key)
+
+        return None if entry is None else time.monotonic() - entry[0]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,207 @@
+"""
+Lightweight in-process metrics registry with Prometheus text exposition over HTTP
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Metrics:
+    """
+    Counters, gauges and fixed-bucket histograms keyed by metric name and label values.
+    Updates are plain dict operations under a single lock, cheap enough to stay on in production.
+    """
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, prefix: str = 'whitelist_bot'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+        self.server = None
+        # Called with (name, seconds, labels) after every timer, e.g. by the profiler while it is on
+        self.timer_listeners = []
+
+    @staticmethod
+    def _labels_key(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increment counter"""
+        key = self._labels_key(labels)
+
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """Set gauge value"""
+        key = self._labels_key(labels)
+
+        with self.lock:
+            self.gauges.setdefault(name, {})[key] = value
+
+    def add_gauge(self, name: str, value: float, **labels):
+        """Add to gauge value (negative values decrease it)"""
+        key = self._labels_key(labels)
+
+        with self.lock:
+            series = self.gauges.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """Add observation to histogram"""
+        key = self._labels_key(labels)
+        index = bisect.bisect_left(self.DEFAULT_BUCKETS, value)
+
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = {'buckets': [0] * (len(self.DEFAULT_BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+
+            entry = series[key]
+            entry['buckets'][index] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Measure wall time of the block into histogram. Labels may be updated inside the block."""
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(name, elapsed, **labels)
+
+            for listener in self.timer_listeners:
+                listener(name, elapsed, labels)
+
+    def describe(self, name: str, text: str):
+        """Set help text for metric"""
+        self.help[name] = text
+
+    def get_counter(self, name: str, **labels) -> float:
+        """Get current counter value"""
+        with self.lock:
+            return self.counters.get(name, {}).get(self._labels_key(labels), 0)
+
+    @staticmethod
+    def _format_labels(key, extra=None):
+        items = list(key) + (extra or [])
+        if not items:
+            return ''
+
+        values = []
+        for label_name, label_value in items:
+            label_value = str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            values.append(f'{label_name}="{label_value}"')
+
+        return '{' + ','.join(values) + '}'
+
+    def render(self) -> str:
+        """Render all metrics in Prometheus text exposition format"""
+        lines = []
+
+        with self.lock:
+            for kind, registry in [('counter', self.counters), ('gauge', self.gauges)]:
+                for name, series in registry.items():
+                    full_name = f'{self.prefix}_{name}'
+                    if name in self.help:
+                        lines.append(f'# HELP {full_name} {self.help[name]}')
+                    lines.append(f'# TYPE {full_name} {kind}')
+
+                    for key, value in series.items():
+                        lines.append(f'{full_name}{self._format_labels(key)} {value}')
+
+            for name, series in self.histograms.items():
+                full_name = f'{self.prefix}_{name}'
+                if name in self.help:
+                    lines.append(f'# HELP {full_name} {self.help[name]}')
+                lines.append(f'# TYPE {full_name} histogram')
+
+                for key, entry in series.items():
+                    cumulative = 0
+                    for bound, count in zip(list(self.DEFAULT_BUCKETS) + ['+Inf'], entry['buckets']):
+                        cumulative += count
+                        lines.append(f'{full_name}_bucket{self._format_labels(key, [('le', bound)])} {cumulative}')
+
+                    lines.append(f'{full_name}_sum{self._format_labels(key)} {entry['sum']}')
+                    lines.append(f'{full_name}_count{self._format_labels(key)} {entry['count']}')
+
+        return '\n'.join(lines) + '\n'
+
+    def start_server(self, port: int, host: str = '0.0.0.0'):
+        """Serve /metrics on given port from a daemon thread"""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                return
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+
+        thread = threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+        thread.start()
+
+        return self.server
+
+
+# Process-wide registry shared by all modules
+metrics = Metrics()
+metrics.describe('join_decision_seconds', 'Join request decision latency by reader type and outcome')
+metrics.describe('reader_fetch_seconds', 'Whitelist source fetch latency')
+metrics.describe('reader_errors_total', 'Whitelist source fetch errors')
+metrics.describe('redis_command_seconds', 'Redis round-trip time')
+metrics.describe('redis_errors_total', 'Redis command errors')
+metrics.describe('telegram_api_calls_total', 'Telegram Bot API calls')
+metrics.describe('cache_requests_total', 'Cache lookups by result')
+metrics.describe('reader_file_append_fetches_total', 'append_only file reader fetches by mode: full, tail or unchanged')
+metrics.describe('executor_queue_length', 'Blocking calls waiting for a worker thread')
+metrics.describe('executor_wait_seconds', 'Time blocking calls waited for a worker thread')
+metrics.describe('executor_timeouts_total', 'Blocking calls that exceeded their timeout')
+metrics.describe('rate_limiter_wait_seconds', 'Time spent waiting for an upstream API quota token')
+metrics.describe('rate_limiter_waiters', 'Calls waiting for an upstream API quota token')
+metrics.describe('rate_limiter_timeouts_total', 'Calls that gave up waiting for a quota token')
+metrics.describe('rate_limiter_backoffs_total', 'Quota backoffs after rate limit responses')
+metrics.describe('reader_stale_total', 'Join lookups served from last known data after a source error')
+metrics.describe('cache_evictions_total', 'Cache evictions by reason: size or ttl')
+metrics.describe('cache_size', 'Current number of cache entries')
+metrics.describe('snapshot_builds_total', 'Whitelist index builds by mode: inline or process pool')
+metrics.describe('snapshot_build_seconds', 'Process pool whitelist index build time')
+metrics.describe('composite_source_checks_total', 'Composite whitelist source checks by result: allowed, denied, error or cancelled')
+metrics.describe('api_checks_total', 'API reader checks with a latency budget, by whether a hedged request was sent')
+metrics.describe('api_hedge_wins_total', 'Hedged API checks by the request that answered first: primary or hedge')
+metrics.describe('api_budget_overrun_seconds', 'Time past the latency budget until a hedged API check got its answer')
+metrics.describe('telegram_queue_wait_seconds', 'Time Bot API calls waited for the outbound rate limiters, by method and priority')
+metrics.describe('telegram_retry_after_total', 'Bot API flood-limit (429) responses by method')
+metrics.describe('pending_refresh_seconds', 'Time to re-check and approve pending join requests of a chat')
+metrics.describe('pending_joins_approved_total', 'Pending join requests approved after the whitelist changed')
+metrics.describe('snapshot_changes_total', 'Whitelist source changes published to the stream: added, removed or changed usernames')
+metrics.describe('join_audit_records_total', 'Join request decisions written to the audit log')
+metrics.describe('join_audit_dropped_total', 'Join audit records lost: buffer overflow or Redis errors')
+metrics.describe('refresh_leases_total', 'Refresh lease requests: owner (acquired or renewed) or other (held by another replica)')
+metrics.describe('refresh_snapshot_reads_total', 'Source reads under refresh ownership: owner fetches, shared snapshot reads, or missing snapshots')
+metrics.describe('refresh_snapshot_fenced_total', 'Snapshots not published because the lease moved to another replica')
+metrics.describe('reader_cache_reuse_total', 'Reads served from data younger than the chat whitelist_max_age option')
+metrics.describe('negative_cache_hits_total', 'Join checks answered from cached not allowed results (negative_cache_ttl option)')
+metrics.describe('lookup_timeouts_total', 'Whitelist lookups exceeding the chat lookup_timeout_ms option')
+metrics.describe('profiles_sampled_total', 'Handler invocations sampled by the profiler')
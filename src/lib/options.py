@@ -2,6 +2,7 @@
 Simple options class backed by Redis storage
 """
 from lib.redis import Redis
+from lib.profiler import profiler
 
 
 class Options():
@@ -44,8 +45,23 @@ class Options():
             raise Exception(f'Unknown option name: {option_name}')
 
         key = self._redis_key(chat_id, option_name)
-        raw_value = self.redis.get(key)
 
+        with profiler.stage('option_read'):
+            return self._parse_value(option_name, self.redis.get(key))
+
+    def get_options(self, chat_id, option_names):
+        """Get several options of a chat with one Redis round-trip, returns option name -> value"""
+        for option_name in option_names:
+            if option_name not in self.valid_options:
+                raise Exception(f'Unknown option name: {option_name}')
+
+        with profiler.stage('option_read'):
+            raw_values = self.redis.mget([self._redis_key(chat_id, option_name) for option_name in option_names])
+
+        return {option_name: self._parse_value(option_name, raw_value)
+                for option_name, raw_value in zip(option_names, raw_values)}
+
+    def _parse_value(self, option_name, raw_value):
         if raw_value is None:
             if option_name in self.valid_options and 'default' in self.valid_options[option_name]:
                 return self.valid_options[option_name]['default']
@@ -0,0 +1,140 @@
+"""
+Outbound Telegram Bot API scheduler: priorities, rate limits and flood control for all bot calls
+"""
+import asyncio
+import json
+import logging
+import time
+from functools import partial
+from telegram.request import HTTPXRequest
+from lib.metrics import metrics
+from lib.profiler import profiler
+from lib.lru_cache import LruCache
+from lib.rate_limiter import TokenBucketScheduler, request_priority, PRIORITY_DEFERRED, PRIORITY_NAMES
+
+logger = logging.getLogger(__name__)
+
+
+class OutboundScheduler:
+    """
+    Grants message calls (send, edit, forward, copy, delete) from a global token bucket, and messages sent to a
+    chat also from that chat's bucket. Waiting calls are served by priority: join request calls first, then command
+    replies, then deferred message deletions, which are also collected and sent in batches.
+    Other calls, such as getChatMember and join request approvals, are not queued: Telegram does not limit them
+    like messages, and a join decision must not wait behind replies. Flood-limit (429) responses pause the
+    affected bucket for retry_after seconds and the call is retried; a 429 to an unqueued call pauses all of
+    them along with the global bucket.
+    """
+    global_limiter = None
+    chat_limiters = None
+    chat_rate = 20
+    pending_deletes = None
+    flusher = None
+
+    # Methods posting into a chat, subject to per-chat limits
+    CHAT_LIMITED_PREFIXES = ('send', 'edit', 'forward', 'copy')
+    # Methods subject to the global limit
+    RATE_LIMITED_PREFIXES = CHAT_LIMITED_PREFIXES + ('delete',)
+    DEFERRED_METHODS = ('deleteMessage', 'deleteMessages')
+    MAX_RETRIES = 3
+    # Seconds to collect command messages before deleting them in one call
+    DELETE_DELAY = 1.0
+    DELETE_BATCH = 100
+
+    def __init__(self, rate_per_second: float = 30, chat_rate_per_minute: float = 20, cache_size: int = 1000):
+        self.global_limiter = TokenBucketScheduler('telegram', rate_per_minute=rate_per_second * 60,
+                                                   burst=max(1, int(rate_per_second)))
+        self.chat_rate = chat_rate_per_minute
+        self.chat_limiters = LruCache('telegram_chat_limiters', max_size=cache_size)
+        self.pending_deletes = {}
+
+    def chat_limiter(self, chat_id):
+        limiter = self.chat_limiters.get(chat_id)
+
+        if limiter is None:
+            limiter = TokenBucketScheduler('telegram_chat', rate_per_minute=self.chat_rate)
+            self.chat_limiters.set(chat_id, limiter)
+
+        return limiter
+
+    @staticmethod
+    def retry_after(payload):
+        """Returns retry_after seconds of a 429 response, or None to use exponential backoff"""
+        try:
+            return float(json.loads(payload)['parameters']['retry_after'])
+        except Exception:
+            return None
+
+    async def run(self, api_method, chat_id, call):
+        """Run call() returning (status code, payload) once tokens are granted, retrying on flood limits"""
+        priority = PRIORITY_DEFERRED if api_method in self.DEFERRED_METHODS else request_priority.get()
+        rate_limited = api_method.startswith(self.RATE_LIMITED_PREFIXES)
+        chat_limited = chat_id is not None and api_method.startswith(self.CHAT_LIMITED_PREFIXES)
+
+        for attempt in range(self.MAX_RETRIES + 1):
+            started = time.perf_counter()
+
+            if chat_limited:
+                await self.chat_limiter(chat_id).acquire(priority)
+            if rate_limited:
+                await self.global_limiter.acquire(priority)
+            else:
+                # Only held back after a flood-limit response
+                pause = self.global_limiter.paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+
+            waited = time.perf_counter() - started
+            metrics.observe('telegram_queue_wait_seconds', waited, method=api_method, priority=PRIORITY_NAMES[priority])
+            profiler.add(f'telegram_queue:{api_method}', waited)
+
+            with profiler.stage(f'telegram_call:{api_method}'):
+                code, payload = await call()
+
+            if code != 429 or attempt == self.MAX_RETRIES:
+                if code < 400:
+                    self.global_limiter.success()
+                return code, payload
+
+            metrics.inc('telegram_retry_after_total', method=api_method)
+            limiter = self.chat_limiter(chat_id) if chat_limited else self.global_limiter
+            limiter.backoff(self.retry_after(payload))
+
+    def defer_delete(self, bot, chat_id, message_id):
+        """Queue message for deletion with other messages of the chat"""
+        self.pending_deletes.setdefault(chat_id, []).append(message_id)
+
+        if self.flusher is None or self.flusher.done():
+            self.flusher = profiler.create_task(self._flush_deletes(bot))
+
+    async def _flush_deletes(self, bot):
+        # The task runs in its own context copy
+        request_priority.set(PRIORITY_DEFERRED)
+
+        while self.pending_deletes:
+            await asyncio.sleep(self.DELETE_DELAY)
+            pending, self.pending_deletes = self.pending_deletes, {}
+
+            for chat_id, message_ids in pending.items():
+                for i in range(0, len(message_ids), self.DELETE_BATCH):
+                    try:
+                        metrics.inc('telegram_api_calls_total', method='delete_messages')
+                        await bot.delete_messages(chat_id, message_ids[i:i + self.DELETE_BATCH])
+                    except Exception as e:
+                        logger.warning('Could not delete messages in chat %s: %s', chat_id, str(e))
+
+
+class ScheduledRequest(HTTPXRequest):
+    """HTTPXRequest sending every Bot API call through OutboundScheduler"""
+    scheduler = None
+
+    def __init__(self, scheduler: OutboundScheduler, **kwargs):
+        super().__init__(**kwargs)
+        self.scheduler = scheduler
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        chat_id = request_data.parameters.get('chat_id') if request_data is not None else None
+
+        return await self.scheduler.run(api_method, chat_id,
+                                        partial(super().do_request, url, method, request_data, **kwargs))
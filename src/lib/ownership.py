@@ -0,0 +1,143 @@
+"""
+Refresh ownership across bot replicas: one replica refreshes each source, the others read its published snapshot
+"""
+import logging
+import os
+import socket
+import time
+import uuid
+from lib.metrics import metrics
+from lib.profiler import profiler
+from lib.executor import BlockingExecutor
+from lib.lru_cache import LruCache
+from lib.redis import Redis
+
+logger = logging.getLogger(__name__)
+
+# Lease owner id of this process
+REPLICA_ID = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class RefreshOwnership:
+    """
+    Assigns the refresh of each named job to one replica with Redis leases. A replica holds a lease while it
+    keeps renewing it, which happens on every refresh it runs; when it stops, the lease expires within one lease
+    period and the next replica to ask takes it over with a new fencing token.
+    For source reads, the owner fetches the source and publishes the data to Redis, written only under the
+    current fencing token so a replica that lost its lease while fetching cannot overwrite the new owner's data.
+    Other replicas read the published data, downloading it only when its version changed.
+    """
+    redis = None
+    ttl = 30
+    snapshot_ttl = 3600
+    executor = None
+    snapshots = None
+    published = None
+    redis_key_prefix = 'refresh'
+    tasks = None
+
+    def __init__(self, redis_client: Redis, ttl: float = 30, snapshot_ttl: float = 3600, cache_size: int = 1000,
+                 redis_key_prefix: str = 'refresh'):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.snapshot_ttl = snapshot_ttl
+        self.redis_key_prefix = redis_key_prefix
+        self.executor = BlockingExecutor('refresh_snapshots', max_workers=2)
+        # Last read snapshot by name: (version, data), and last published one: (version, data, published at)
+        self.snapshots = LruCache('refresh_snapshots', max_size=cache_size)
+        self.published = LruCache('refresh_published', max_size=cache_size)
+        self.tasks = set()
+
+    def _lease_key(self, name):
+        return f"{self.redis_key_prefix}:{name}:lease"
+
+    def _snapshot_key(self, name):
+        return f"{self.redis_key_prefix}:{name}:snapshot"
+
+    def acquire(self, name, ttl: float | None = None):
+        """Returns fencing token if this replica owns the named job now, None if another replica does"""
+        token = self.redis.acquire_lease(self._lease_key(name), REPLICA_ID, int((ttl or self.ttl) * 1000))
+        metrics.inc('refresh_leases_total', result='owner' if token is not None else 'other')
+
+        return token
+
+    def release(self, name):
+        self.redis.release_lease(self._lease_key(name), REPLICA_ID)
+
+    async def read(self, name, fetch):
+        """
+        Returns JSON-serializable data of the named source: the result of await fetch() if this replica owns
+        the source refresh, else the owner's published data. Falls back to fetch() while nothing is published.
+        """
+        try:
+            token = self.acquire(name)
+        except Exception as e:
+            # Fetching twice is better than not at all
+            logger.warning('Could not acquire refresh lease of %s: %s', name, str(e))
+            return await fetch()
+
+        if token is None:
+            data = await self.executor.run(self.read_published, name)
+            if data is not None:
+                metrics.inc('refresh_snapshot_reads_total', result='shared')
+                return data
+
+            metrics.inc('refresh_snapshot_reads_total', result='missing')
+            return await fetch()
+
+        data = await fetch()
+        metrics.inc('refresh_snapshot_reads_total', result='owner')
+
+        published = self.published.get(name)
+        if published is None or published[1] != data or time.time() - published[2] > self.snapshot_ttl / 2:
+            self.submit(self.publish, name, token, data)
+
+        return data
+
+    def read_published(self, name):
+        """Blocking: returns the published data of the named source, downloaded only if its version changed"""
+        key = self._snapshot_key(name)
+        version = self.redis.hget(key, 'version')
+
+        if version is None:
+            return None
+
+        cached = self.snapshots.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        raw = self.redis.hget_bytes(key, 'data')
+        if raw is None:
+            return None
+
+        data = self.redis.serializer.decode(raw)
+        self.snapshots.set(name, (version, data))
+
+        return data
+
+    def publish(self, name, token, data):
+        """Blocking: publish data of the named source unless the lease moved to another replica"""
+        version = uuid.uuid4().hex
+        encoded = self.redis.serializer.encode(data)
+        written = self.redis.hset_fenced(self._lease_key(name), token, self._snapshot_key(name),
+                                         {'version': version, 'token': token, 'data': encoded},
+                                         int(self.snapshot_ttl * 1000))
+
+        if written:
+            self.published.set(name, (version, data, time.time()))
+        else:
+            metrics.inc('refresh_snapshot_fenced_total')
+            logger.info('Snapshot of %s was not published: the lease moved to another replica', name)
+
+    def submit(self, func, *args):
+        """Run func on the executor in background"""
+        async def run():
+            try:
+                await self.executor.run(func, *args)
+            except Exception as e:
+                logger.warning('Could not publish snapshot: %s', str(e))
+
+        task = profiler.create_task(run())
+        # Keep a reference until the task is done
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
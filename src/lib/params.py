@@ -1,132 +1,37 @@
 """
 Parameters parsing class for handling named parameters and conditions
 """
-import re
 
 
 class Params:
     """
     Class for parsing named parameters from command line arguments
-    Supports various parameter types including conditions with logical operators
+    Supports various parameter types including condition expressions
     """
     
     @staticmethod
     def parse_condition(condition_str):
         """
-        Parse condition string with operators =, !=, <, >, in, not in
+        Parse condition expression: comparisons with operators =, !=, <, >, in, not in combined with and, or, not
+        and parentheses, see Condition
         Examples:
-        - column=5 -> {'operator': '=', 'value': 5}
-        - column!=5 -> {'operator': '!=', 'value': 5}
-        - column<10 -> {'operator': '<', 'value': 10}
-        - column>10 -> {'operator': '>', 'value': 10}
-        - column in (1,2,3,"foo") -> {'operator': 'in', 'value': [1, 2, 3, "foo"]}
-        - column not in (1,2,3) -> {'operator': 'not in', 'value': [1, 2, 3]}
-        
+        - 2=5 -> {'operator': '=', 'value': 5, 'param': '2'}
+        - 2 in (1,2,3,"foo") -> {'operator': 'in', 'value': [1, 2, 3, "foo"], 'param': '2'}
+        - 2 in ("yes") and 4 > 18 -> {'operator': 'and', 'args': [{...}, {...}]}
+
         Args:
             condition_str: Condition string to parse
-            
+
         Returns:
-            Dictionary with 'operator', 'value', and 'param' keys, or None if parsing fails
+            Condition tree, or None if parsing fails
         """
-        # Pattern for 'not in' (must be checked first, before 'in')
-        not_in_match = re.match(r'^(.+?)\s+not\s+in\s+\((.+?)\)$', condition_str.strip())
-        if not_in_match:
-            param_name = not_in_match.group(1).strip()
-            values_str = not_in_match.group(2).strip()
-            # Parse values: split by comma and strip, convert to appropriate types
-            values = []
-            for v in values_str.split(','):
-                v = v.strip().strip('"\'')
-                # Try to parse as number, otherwise keep as string
-                try:
-                    if '.' in v:
-                        values.append(float(v))
-                    else:
-                        values.append(int(v))
-                except ValueError:
-                    values.append(v)
-            return {'operator': 'not in', 'value': values, 'param': param_name}
-        
-        # Pattern for 'in'
-        in_match = re.match(r'^(.+?)\s+in\s+\((.+?)\)$', condition_str.strip())
-        if in_match:
-            param_name = in_match.group(1).strip()
-            values_str = in_match.group(2).strip()
-            # Parse values: split by comma and strip, convert to appropriate types
-            values = []
-            for v in values_str.split(','):
-                v = v.strip().strip('"\'')
-                # Try to parse as number, otherwise keep as string
-                try:
-                    if '.' in v:
-                        values.append(float(v))
-                    else:
-                        values.append(int(v))
-                except ValueError:
-                    values.append(v)
-            return {'operator': 'in', 'value': values, 'param': param_name}
-        
-        # Pattern for != (must be checked before =)
-        ne_match = re.match(r'^(.+?)!=(.+)$', condition_str.strip())
-        if ne_match:
-            param_name = ne_match.group(1).strip()
-            value_str = ne_match.group(2).strip().strip('"\'')
-            # Try to convert to number
-            try:
-                if '.' in value_str:
-                    value = float(value_str)
-                else:
-                    value = int(value_str)
-            except ValueError:
-                value = value_str
-            return {'operator': '!=', 'value': value, 'param': param_name}
-        
-        # Pattern for <
-        lt_match = re.match(r'^(.+?)<(.+)$', condition_str.strip())
-        if lt_match:
-            param_name = lt_match.group(1).strip()
-            value_str = lt_match.group(2).strip().strip('"\'')
-            try:
-                if '.' in value_str:
-                    value = float(value_str)
-                else:
-                    value = int(value_str)
-            except ValueError:
-                value = value_str
-            return {'operator': '<', 'value': value, 'param': param_name}
-        
-        # Pattern for >
-        gt_match = re.match(r'^(.+?)>(.+)$', condition_str.strip())
-        if gt_match:
-            param_name = gt_match.group(1).strip()
-            value_str = gt_match.group(2).strip().strip('"\'')
-            try:
-                if '.' in value_str:
-                    value = float(value_str)
-                else:
-                    value = int(value_str)
-            except ValueError:
-                value = value_str
-            return {'operator': '>', 'value': value, 'param': param_name}
-        
-        # Pattern for = (must be checked last)
-        eq_match = re.match(r'^(.+?)=(.+)$', condition_str.strip())
-        if eq_match:
-            param_name = eq_match.group(1).strip()
-            value_str = eq_match.group(2).strip().strip('"\'')
-            # Try to convert to number
-            try:
-                if '.' in value_str:
-                    value = float(value_str)
-                else:
-                    value = int(value_str)
-            except ValueError:
-                value = value_str
-            return {'operator': '=', 'value': value, 'param': param_name}
-        
-        # If no pattern matches, return None
-        return None
-    
+        from lib.condition import Condition
+
+        try:
+            return Condition.parse(condition_str)
+        except Exception:
+            return None
+
     @staticmethod
     def check_condition(condition, value, lower_case: bool = False):
         """
@@ -283,7 +188,7 @@ class Params:
             params_config: Dictionary defining parameter configurations with structure:
                 {
                     'param_name': {
-                        'type': type or 'condition',
+                        'type': int, bool, str or 'condition',
                         'default': default_value  # optional
                     }
                 }
@@ -319,17 +224,26 @@ class Params:
                     
                     # Handle condition type specially
                     if param_type == 'condition':
-                        condition = Params.parse_condition(param_value)
-                        if condition:
-                            params[param_name] = condition
-                        else:
-                            raise Exception(f'Invalid condition format: {param_value}')
+                        from lib.condition import Condition
+
+                        try:
+                            params[param_name] = Condition.parse(param_value)
+                        except Exception as e:
+                            raise Exception(f'Invalid condition format: {param_value} ({str(e)})')
                     # Handle int type
                     elif param_type == int:
                         try:
                             params[param_name] = int(param_value)
                         except ValueError:
                             raise Exception(f'Invalid integer value for parameter {param_name}: {param_value}')
+                    # Handle bool type
+                    elif param_type == bool:
+                        if param_value.lower() in ['1', 'true', 'yes', 'on']:
+                            params[param_name] = True
+                        elif param_value.lower() in ['0', 'false', 'no', 'off']:
+                            params[param_name] = False
+                        else:
+                            raise Exception(f'Invalid boolean value for parameter {param_name}: {param_value}')
                     # Handle str type (default)
                     else:
                         params[param_name] = param_value
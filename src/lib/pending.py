@@ -0,0 +1,227 @@
+"""
+Pending join requests: requests that were not allowed, re-checked when the chat whitelist changes
+"""
+import asyncio
+import json
+import time
+from telegram.error import BadRequest
+from lib.metrics import metrics
+from lib.profiler import profiler
+from lib.executor import BlockingExecutor
+from lib.ownership import REPLICA_ID
+from lib.redis import Redis
+from lib.rate_limiter import request_priority, PRIORITY_REFRESH
+
+
+class PendingJoins:
+    """
+    Keeps join requests that were neither approved nor declined in a Redis sorted set per chat, scored by request
+    time. A refresh checks all pending users of a chat against the current whitelist in one bulk check: they were
+    rejected by an earlier version of it, so the ones allowed now are exactly the pending users added since.
+    They are approved in small concurrent batches at refresh priority, behind live join requests.
+    With a SnapshotChanges publisher, the whitelist change stream is followed through a consumer group, so each
+    change is handled by one bot replica: only pending users named in the change are re-checked, in every chat
+    that has them. Periodic refreshes of all chats are a slow fallback for sources without change events
+    (api readers); with RefreshOwnership they run on one bot replica at a time.
+    """
+    redis = None
+    whitelist = None
+    options = None
+    logger = None
+    max_age = 604800
+    redis_key_prefix = 'pending'
+    tasks = None
+    ownership = None
+    changes = None
+    executor = None
+
+    CHATS_KEY = 'pending_chats'
+    APPROVE_BATCH = 20
+    # Consumer group of the change stream, entries per read and max wait for new ones
+    CHANGES_GROUP = 'pending_joins'
+    CHANGES_BATCH = 100
+    CHANGES_BLOCK_MS = 5000
+
+    def __init__(self, redis_client: Redis, whitelist, options, logger, max_age: int = 604800,
+                 redis_key_prefix: str = 'pending', ownership=None, changes=None):
+        self.redis = redis_client
+        self.ownership = ownership
+        self.changes = changes
+        self.executor = BlockingExecutor('pending_changes', max_workers=1)
+        self.whitelist = whitelist
+        self.options = options
+        self.logger = logger
+        self.max_age = max_age
+        self.redis_key_prefix = redis_key_prefix
+        self.tasks = set()
+
+    def _redis_key(self, chat_id):
+        return f"{self.redis_key_prefix}:{chat_id}"
+
+    @staticmethod
+    def _member(user_id, username):
+        # Telegram usernames can not contain ':'
+        return f"{user_id}:{username}"
+
+    def add(self, chat_id, user_id, username, requested_at: float):
+        self.redis.zadd(self._redis_key(chat_id), {self._member(user_id, username): requested_at})
+        self.redis.sadd(self.CHATS_KEY, chat_id)
+
+    def remove(self, chat_id, user_id, username):
+        self.redis.zrem(self._redis_key(chat_id), self._member(user_id, username))
+
+    def get(self, chat_id):
+        """Returns (user_id, username) of pending requests not older than max_age, dropping expired ones"""
+        key = self._redis_key(chat_id)
+        self.redis.zremrangebyscore(key, '-inf', time.time() - self.max_age)
+
+        pending = []
+        for member in self.redis.zrangebyscore(key):
+            user_id, username = member.split(':', 1)
+            pending.append((int(user_id), username))
+
+        if not pending:
+            self.redis.srem(self.CHATS_KEY, chat_id)
+
+        return pending
+
+    async def refresh(self, bot, chat_id, pending=None):
+        """
+        Approve pending requests of the chat (or the given subset of them) that the whitelist allows now,
+        returns the number approved
+        """
+        if pending is None:
+            pending = self.get(chat_id)
+
+        if not pending or not self.options.get_option(chat_id, 'enabled'):
+            return 0
+
+        priority_token = request_priority.set(PRIORITY_REFRESH)
+
+        try:
+            with metrics.timer('pending_refresh_seconds'):
+                results = await self.whitelist.check_allowed_users(chat_id, [username for _, username in pending],
+                                                                   fresh=True)
+                allowed = [request for request, result in zip(pending, results) if result]
+
+                approved = 0
+                for i in range(0, len(allowed), self.APPROVE_BATCH):
+                    batch = allowed[i:i + self.APPROVE_BATCH]
+                    approved += sum(await asyncio.gather(*[self.approve(bot, chat_id, *request) for request in batch]))
+        finally:
+            request_priority.reset(priority_token)
+
+        if allowed:
+            self.logger.info('Approved %s of %s pending join requests in chat %s', approved, len(pending), chat_id)
+
+        return approved
+
+    async def approve(self, bot, chat_id, user_id, username) -> bool:
+        try:
+            metrics.inc('telegram_api_calls_total', method='approve')
+            await bot.approve_chat_join_request(chat_id=chat_id, user_id=user_id)
+        except BadRequest as e:
+            # The request was cancelled or handled by an admin
+            self.logger.info('Pending join request of user %s in chat %s is gone: %s', username, chat_id, str(e))
+            self.remove(chat_id, user_id, username)
+            return False
+        except Exception as e:
+            self.logger.warning('Could not approve pending join request of user %s in chat %s: %s',
+                                username, chat_id, str(e))
+            return False
+
+        metrics.inc('pending_joins_approved_total')
+        self.remove(chat_id, user_id, username)
+
+        return True
+
+    async def refresh_all(self, bot):
+        """Refresh every chat with pending requests"""
+        for chat_id in self.redis.smembers(self.CHATS_KEY):
+            try:
+                await self.refresh(bot, int(chat_id))
+            except Exception as e:
+                self.logger.warning('Pending join requests refresh failed for chat %s: %s', chat_id, str(e))
+
+    async def refresh_usernames(self, bot, usernames):
+        """Refresh pending requests of the given usernames in every chat"""
+        for chat_id in self.redis.smembers(self.CHATS_KEY):
+            try:
+                pending = [request for request in self.get(int(chat_id)) if request[1].lower() in usernames]
+                if pending:
+                    await self.refresh(bot, int(chat_id), pending)
+            except Exception as e:
+                self.logger.warning('Pending join requests refresh failed for chat %s: %s', chat_id, str(e))
+
+    @staticmethod
+    def changed_usernames(entries):
+        """Usernames added, removed or with changed condition values in change stream entries"""
+        usernames = set()
+
+        for _, fields in entries:
+            usernames.update(json.loads(fields.get('added') or '[]'))
+            # Removed from the subtracted source of a composite difference
+            usernames.update(json.loads(fields.get('removed') or '[]'))
+            usernames.update(json.loads(fields.get('changed') or '{}').keys())
+
+        return usernames
+
+    async def follow_changes(self, bot):
+        """Re-check pending users named in whitelist change events, each event on one replica"""
+        stream = self.changes.stream
+        await self.executor.run(self.redis.xgroup_create, stream, self.CHANGES_GROUP)
+
+        while True:
+            try:
+                entries = await self.executor.run(self.redis.xreadgroup, self.CHANGES_GROUP, REPLICA_ID, stream,
+                                                  self.CHANGES_BATCH, self.CHANGES_BLOCK_MS)
+            except Exception as e:
+                self.logger.warning('Could not read whitelist changes: %s', str(e))
+                await asyncio.sleep(self.CHANGES_BLOCK_MS / 1000)
+                continue
+
+            if not entries:
+                continue
+
+            usernames = self.changed_usernames(entries)
+            if usernames:
+                await self.refresh_usernames(bot, usernames)
+
+            try:
+                await self.executor.run(self.redis.xack, stream, self.CHANGES_GROUP,
+                                        [entry_id for entry_id, _ in entries])
+            except Exception as e:
+                self.logger.warning('Could not acknowledge whitelist changes: %s', str(e))
+
+    def schedule_refresh(self, bot, chat_id):
+        """Refresh the chat in background, e.g. after its whitelist was changed by a command"""
+        async def refresh():
+            try:
+                await self.refresh(bot, chat_id)
+            except Exception as e:
+                self.logger.warning('Pending join requests refresh failed for chat %s: %s', chat_id, str(e))
+
+        task = profiler.create_task(refresh())
+        # Keep a reference until the task is done
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def owns_periodic_refresh(self, interval: float) -> bool:
+        """Take or keep the periodic refresh lease; it outlives the interval so the owner keeps it between runs"""
+        if self.ownership is None:
+            return True
+
+        try:
+            return self.ownership.acquire('pending', ttl=interval * 1.5) is not None
+        except Exception as e:
+            # Refreshing twice is better than not at all
+            self.logger.warning('Could not acquire pending refresh lease: %s', str(e))
+            return True
+
+    async def run_periodic(self, bot, interval: float):
+        """Refresh all chats every interval seconds"""
+        while True:
+            await asyncio.sleep(interval)
+
+            if self.owns_periodic_refresh(interval):
+                await self.refresh_all(bot)
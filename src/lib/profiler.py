@@ -0,0 +1,252 @@
+"""
+Sampling profiler of update handlers: per-stage wall times of a fraction of invocations, dumped to a file
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from lib.metrics import metrics
+from lib.executor import BlockingExecutor
+
+logger = logging.getLogger(__name__)
+
+# Profile of the sampled handler invocation running in the current context
+current_profile = ContextVar('current_profile', default=None)
+
+NO_STAGE = nullcontext()
+
+
+class Profile:
+    """Stage wall times of one sampled handler invocation: stage -> (seconds, calls)"""
+    handler = None
+    started = None
+    stages = None
+    token = None
+    lock = None
+    finished = False
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.started = time.perf_counter()
+        self.stages = {}
+        # Stages may also be added from executor threads
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            # Worker threads left running by the invocation, e.g. a losing hedged request, may finish after it
+            if self.finished:
+                return
+
+            total, calls = self.stages.get(stage, (0.0, 0))
+            self.stages[stage] = (total + seconds, calls + 1)
+
+
+class SamplingProfiler:
+    """
+    Profiles a sampled fraction of handler invocations. A sampled invocation carries its Profile in a context
+    variable: blocks wrapped with stage(), metric timers (Redis commands, reader fetches) and Telegram calls
+    made while it runs, also on executor threads, add their wall times to it. Stages may nest and overlap, so
+    their times are inclusive. Background tasks started with create_task() are not part of the invocation.
+    Finished profiles are aggregated per handler and stage, and every dump interval
+    the aggregates are appended to a JSON lines file and reset.
+    With profiling disabled, or for invocations not sampled, a stage costs one context variable lookup.
+    """
+    sample_rate = 0.0
+    path = 'profile.jsonl'
+    handlers = None
+    window_started = None
+    lock = None
+    executor = None
+
+    # Latest samples per handler and stage used for percentiles
+    SAMPLES = 1000
+
+    def __init__(self, sample_rate: float = 0.0, path: str = 'profile.jsonl'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.executor = BlockingExecutor('profiler', max_workers=1)
+        self.reset()
+        self.set_sample_rate(sample_rate)
+
+    def reset(self):
+        """Start a new aggregation window, returns the aggregates of the previous one and its start time"""
+        with self.lock:
+            handlers, window_started = self.handlers, self.window_started
+            self.handlers = {}
+            self.window_started = time.time()
+
+        return handlers, window_started
+
+    def set_sample_rate(self, sample_rate: float):
+        """Profile sample_rate of invocations (0 disables profiling)"""
+        if not 0 <= sample_rate <= 1:
+            raise Exception(f'Invalid sample rate: {sample_rate}. Expected a number from 0 to 1')
+
+        self.sample_rate = sample_rate
+
+        # Metric timers are only watched while profiling is on
+        if sample_rate > 0 and self.observe_timer not in metrics.timer_listeners:
+            metrics.timer_listeners.append(self.observe_timer)
+        elif sample_rate == 0 and self.observe_timer in metrics.timer_listeners:
+            metrics.timer_listeners.remove(self.observe_timer)
+
+    def start(self, handler):
+        """Returns the Profile of this invocation if it is sampled, else None"""
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+
+        profile = Profile(handler)
+        profile.token = current_profile.set(profile)
+        metrics.inc('profiles_sampled_total', handler=handler)
+
+        return profile
+
+    def finish(self, profile):
+        """Add a finished invocation to the aggregates"""
+        if profile is None:
+            return
+
+        current_profile.reset(profile.token)
+        elapsed = time.perf_counter() - profile.started
+
+        with profile.lock:
+            profile.finished = True
+
+        with self.lock:
+            entry = self.handlers.setdefault(profile.handler, {'seconds': deque(maxlen=self.SAMPLES), 'count': 0,
+                                                               'total': 0.0, 'stages': {}})
+            entry['count'] += 1
+            entry['total'] += elapsed
+            entry['seconds'].append(elapsed)
+
+            for stage, (seconds, calls) in profile.stages.items():
+                stage_entry = entry['stages'].setdefault(stage, {'seconds': deque(maxlen=self.SAMPLES), 'count': 0,
+                                                                 'total': 0.0, 'calls': 0})
+                stage_entry['count'] += 1
+                stage_entry['total'] += seconds
+                stage_entry['calls'] += calls
+                stage_entry['seconds'].append(seconds)
+
+    @contextmanager
+    def profile(self, handler):
+        """Profile the block as one invocation of handler, if sampled"""
+        profile = self.start(handler)
+        try:
+            yield profile
+        finally:
+            self.finish(profile)
+
+    def stage(self, name):
+        """Context manager adding the wall time of the block to the current profile as stage name"""
+        profile = current_profile.get()
+        if profile is None:
+            return NO_STAGE
+
+        return self._stage(profile, name)
+
+    @contextmanager
+    def _stage(self, profile, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            profile.add(name, time.perf_counter() - start)
+
+    @staticmethod
+    def create_task(coroutine):
+        """Start a background task that may outlive the current invocation; its work is not added to its profile"""
+        context = contextvars.copy_context()
+        context.run(current_profile.set, None)
+
+        return asyncio.create_task(coroutine, context=context)
+
+    @staticmethod
+    def add(name, seconds: float):
+        """Add seconds to stage name of the current profile, if any"""
+        profile = current_profile.get()
+        if profile is not None:
+            profile.add(name, seconds)
+
+    @staticmethod
+    def observe_timer(name, seconds, labels):
+        """Metric timer listener: e.g. redis_command_seconds{command=get} is added as stage redis_command:get"""
+        profile = current_profile.get()
+        if profile is not None:
+            profile.add(':'.join([name.removesuffix('_seconds')] + [str(value) for value in labels.values()]),
+                        seconds)
+
+    @staticmethod
+    def percentiles(samples):
+        ordered = sorted(samples)
+
+        return {f'p{p}': ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in (50, 95, 99)}
+
+    def summary(self, handlers=None):
+        """Aggregates of the current window: per handler invocation times and its stages, slowest total first"""
+        if handlers is None:
+            with self.lock:
+                handlers = {handler: dict(entry, seconds=list(entry['seconds']),
+                                          stages={stage: dict(stage_entry, seconds=list(stage_entry['seconds']))
+                                                  for stage, stage_entry in entry['stages'].items()})
+                            for handler, entry in self.handlers.items()}
+
+        result = {}
+        for handler, entry in handlers.items():
+            stages = {}
+            for stage, stage_entry in sorted(entry['stages'].items(), key=lambda item: -item[1]['total']):
+                stages[stage] = {
+                    'invocations': stage_entry['count'],
+                    'calls': stage_entry['calls'],
+                    'mean': stage_entry['total'] / stage_entry['count'],
+                    'max': max(stage_entry['seconds']),
+                    'share': stage_entry['total'] / entry['total'] if entry['total'] else 0,
+                    **self.percentiles(stage_entry['seconds']),
+                }
+
+            result[handler] = {
+                'invocations': entry['count'],
+                'mean': entry['total'] / entry['count'],
+                'max': max(entry['seconds']),
+                **self.percentiles(entry['seconds']),
+                'stages': stages,
+            }
+
+        return result
+
+    async def dump(self):
+        """Append the aggregates of the current window to the profile file and start a new window"""
+        handlers, window_started = self.reset()
+        if not handlers:
+            return
+
+        report = {
+            'window_start': window_started,
+            'window_end': time.time(),
+            'sample_rate': self.sample_rate,
+            'handlers': self.summary(handlers),
+        }
+
+        try:
+            await self.executor.run(self.write, json.dumps(report))
+        except Exception as e:
+            logger.warning('Could not write profile to %s: %s', self.path, str(e))
+
+    def write(self, line):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    async def run_periodic(self, interval: float):
+        """Dump profiles every interval seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.dump()
+
+
+profiler = SamplingProfiler()
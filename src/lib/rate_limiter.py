@@ -0,0 +1,123 @@
+"""
+Token bucket scheduler with priority classes for rate limited upstream APIs
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from contextvars import ContextVar
+from lib.metrics import metrics
+from lib.profiler import profiler
+
+PRIORITY_JOIN = 0
+PRIORITY_COMMAND = 1
+PRIORITY_REFRESH = 2
+PRIORITY_DEFERRED = 3
+
+PRIORITY_NAMES = {PRIORITY_JOIN: 'join', PRIORITY_COMMAND: 'command', PRIORITY_REFRESH: 'refresh',
+                  PRIORITY_DEFERRED: 'deferred'}
+
+# Priority class of the code path currently running: join requests unless a handler says otherwise
+request_priority = ContextVar('request_priority', default=PRIORITY_JOIN)
+
+
+class TokenBucketScheduler:
+    """
+    Global token bucket: tokens refill at rate_per_minute up to burst. When tokens run out, callers wait and
+    are served strictly by priority class, then in arrival order. backoff() pauses all grants, e.g. after 429.
+    """
+    name = None
+    rate = 1.0
+    burst = 1
+    tokens = 0.0
+    updated = 0.0
+    paused_until = 0.0
+    waiters = None
+    dispatcher = None
+
+    MAX_BACKOFF = 64.0
+
+    def __init__(self, name: str, rate_per_minute: float, burst: int | None = None):
+        self.name = name
+        self.rate = rate_per_minute / 60
+        self.burst = burst if burst else max(1, int(rate_per_minute // 6))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.backoff_seconds = 0.0
+        self.waiters = []
+        self.counter = itertools.count()
+        self.dispatcher = None
+
+    def _refill(self):
+        now = time.monotonic()
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    async def acquire(self, priority: int | None = None, timeout: float | None = None):
+        """Wait for a token. Raises TimeoutError if it cannot be granted within timeout."""
+        priority = request_priority.get() if priority is None else priority
+        started = time.perf_counter()
+        self._refill()
+
+        if not self.waiters and time.monotonic() >= self.paused_until and self.tokens >= 1:
+            self.tokens -= 1
+            metrics.observe('rate_limiter_wait_seconds', 0, limiter=self.name, priority=PRIORITY_NAMES[priority])
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        metrics.set_gauge('rate_limiter_waiters', len(self.waiters), limiter=self.name)
+
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = profiler.create_task(self._dispatch())
+
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            metrics.inc('rate_limiter_timeouts_total', limiter=self.name, priority=PRIORITY_NAMES[priority])
+            raise TimeoutError(f'{self.name} rate limit wait exceeded {timeout}s')
+        finally:
+            metrics.observe('rate_limiter_wait_seconds', time.perf_counter() - started,
+                            limiter=self.name, priority=PRIORITY_NAMES[priority])
+
+    async def _dispatch(self):
+        """Hand out tokens to waiters by priority as they refill"""
+        while self.waiters:
+            # Drop waiters that gave up
+            while self.waiters and self.waiters[0][2].done():
+                heapq.heappop(self.waiters)
+
+            if not self.waiters:
+                break
+
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                heapq.heappop(self.waiters)[2].set_result(True)
+            else:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+        metrics.set_gauge('rate_limiter_waiters', len(self.waiters), limiter=self.name)
+
+    def backoff(self, retry_after: float | None = None):
+        """Pause token grants: for retry_after seconds if given, otherwise exponentially growing delay"""
+        if retry_after is None:
+            self.backoff_seconds = min(self.MAX_BACKOFF, self.backoff_seconds * 2 if self.backoff_seconds else 1.0)
+            retry_after = self.backoff_seconds
+
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        # No tokens accrue while paused
+        self.tokens = 0.0
+        self.updated = self.paused_until
+        metrics.inc('rate_limiter_backoffs_total', limiter=self.name)
+
+    def success(self):
+        """Reset exponential backoff after a successful call"""
+        self.backoff_seconds = 0.0
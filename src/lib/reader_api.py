@@ -1,6 +1,12 @@
+import asyncio
 import json
 import re
+import time
+from collections import deque
 from lib.params import Params
+from lib.metrics import metrics
+from lib.lru_cache import LruCache
+from lib.executor import BlockingExecutor
 from urllib.parse import urlencode
 from urllib.request import Request, urlopen
 
@@ -16,6 +22,10 @@ Expected response formats indicating access granted:
 - JSON boolean true
 - JSON object with truthy flag: one of keys ["allowed", "allow", "ok", "in_whitelist"]
 - Plain text "true" / "1" (case-insensitive)
+
+Requests run on a thread pool. Each location has a latency budget: the p95 of its recent response times.
+If the answer does not arrive within the budget, a second (hedged) request is sent and the first answer wins.
+Answers are reused for the chat's whitelist_max_age seconds when that option is set.
 """
 
 
@@ -24,10 +34,27 @@ class ReaderApi:
 
     params = {'location': {'type': str}, 'token': {'type': str}}
 
+    executor = None
+    # location URL -> recent response times, seconds
+    latencies = None
+    # (request URL, token) -> last answer
+    results = None
+
+    LATENCY_WINDOW = 200
+    # Responses to observe before hedging is enabled for a location
+    HEDGE_MIN_SAMPLES = 20
+    HEDGE_PERCENTILE = 0.95
+    MIN_BUDGET = 0.01
+
     def __init__(self, config):
         if config:
             self.config = config
 
+        self.executor = BlockingExecutor('api', max_workers=int(self.config.get('api_workers') or 8))
+        self.latencies = LruCache('api_latencies', max_size=int(self.config.get('cache_size') or 1000))
+        self.results = LruCache('api_results', max_size=int(self.config.get('cache_size') or 1000),
+                                ttl=float(self.config.get('cache_ttl') or 3600))
+
     async def check_allowed_user(self, location, username):
         base_url = location['params']['location']
 
@@ -49,10 +76,23 @@ class ReaderApi:
         if token:
             headers['Authorization'] = f'Bearer {token}'
 
-        request = Request(url, headers=headers)
-        with urlopen(request) as response:
-            content_bytes = response.read()
+        max_age = (location.get('policy') or {}).get('whitelist_max_age')
+        if max_age:
+            result = self.results.get((url, token))
+            if result is not None and self.results.age((url, token)) <= max_age:
+                metrics.inc('reader_cache_reuse_total', reader='api')
+                return result
+
+        result = self.parse_response(await self.hedged_fetch(base_url, Request(url, headers=headers)))
+
+        if max_age:
+            self.results.set((url, token), result)
 
+        return result
+
+    @staticmethod
+    def parse_response(content_bytes) -> bool:
+        """Returns True if the response body grants access"""
         # Try JSON boolean or object flags
         try:
             data = json.loads(content_bytes.decode('utf-8'))
@@ -73,10 +113,81 @@ class ReaderApi:
 
         return content in ['true', '1', 'yes', 'ok']
 
-    def parse_params(self, args, check_missing=True):
+    def fetch(self, request):
+        """Blocking request, returns response body"""
+        try:
+            with metrics.timer('reader_fetch_seconds', reader='api'):
+                with urlopen(request, timeout=float(self.config.get('api_timeout') or 10)) as response:
+                    return response.read()
+        except Exception:
+            metrics.inc('reader_errors_total', reader='api')
+            raise
+
+    def budget(self, base_url):
+        """Returns latency budget of the location, or None while there are too few samples"""
+        window = self.latencies.get(base_url)
+
+        if window is None or len(window) < self.HEDGE_MIN_SAMPLES:
+            return None
+
+        return max(self.MIN_BUDGET, sorted(window)[int(len(window) * self.HEDGE_PERCENTILE)])
+
+    async def timed_fetch(self, base_url, request):
+        started = time.perf_counter()
+
+        try:
+            return await self.executor.run(self.fetch, request, key=base_url)
+        finally:
+            # Cancelled and failed requests count with the time spent so far, so p95 is not biased to winners
+            window = self.latencies.get(base_url)
+            if window is None:
+                window = deque(maxlen=self.LATENCY_WINDOW)
+                self.latencies.set(base_url, window)
+            window.append(time.perf_counter() - started)
+
+    async def hedged_fetch(self, base_url, request):
+        """Fetch, sending a second request if the first one exceeds the location budget"""
+        budget = self.budget(base_url)
+        started = time.perf_counter()
+        primary = asyncio.create_task(self.timed_fetch(base_url, request))
+        pending = {primary}
+
+        if budget is None:
+            return await primary
+
+        try:
+            done, _ = await asyncio.wait(pending, timeout=budget)
+
+            if done:
+                metrics.inc('api_checks_total', hedged='false')
+                return primary.result()
+
+            metrics.inc('api_checks_total', hedged='true')
+            pending.add(asyncio.create_task(self.timed_fetch(base_url, request)))
+            error = None
+
+            # First successful answer wins
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    if task.exception() is None:
+                        metrics.inc('api_hedge_wins_total', winner='primary' if task is primary else 'hedge')
+                        metrics.observe('api_budget_overrun_seconds', time.perf_counter() - started - budget)
+                        return task.result()
+
+                    error = error or task.exception()
+
+            raise error
+        finally:
+            # Drop the losing request; its worker thread finishes on its own
+            for task in pending:
+                task.cancel()
+
+    def parse_params(self, args, check_missing=True, set_default=False):
         """Parse named parameters from args array in format parameter_name=parameter_value
         Uses self.params to determine supported parameters and their types
         """
-        return Params.parse_params(args, self.params, check_missing)
+        return Params.parse_params(args, self.params, check_missing, set_default)
 
 
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import time
+from lib.params import Params
+from lib.metrics import metrics
+from lib.lru_cache import LruCache
+
+"""
+Composite Datasource: combines several child whitelist locations.
+- union: user is listed in any of the sources
+- intersection: user is listed in all of the sources
+- difference: user is listed in the first source and in none of the others (e.g. a ban list)
+
+Children are ordered by expected cost of reaching a decisive answer, estimated from observed latency and hit rate.
+Fast children (e.g. redis sets) are checked one by one; the remaining ones are checked concurrently, and checks
+still running are cancelled as soon as one answer decides the result.
+"""
+
+
+class ReaderComposite:
+    config = {}
+    get_reader = None
+    stats = None
+
+    params = {'mode': {'default': 'union', 'type': str}}
+
+    MODES = ['union', 'intersection', 'difference']
+
+    # Expected latency of sources that were not checked yet, seconds
+    LATENCY_PRIORS = {'redis': 0.001}
+    DEFAULT_LATENCY = 0.1
+    # Sources expected to answer faster than this are checked before the others are started
+    INLINE_LATENCY = 0.005
+    # Weight of the latest observation in the latency and hit rate moving averages
+    EWMA_ALPHA = 0.2
+
+    def __init__(self, config, get_reader):
+        if config:
+            self.config = config
+
+        self.get_reader = get_reader
+
+        # source key -> (latency, hit rate)
+        self.stats = LruCache('composite_stats', max_size=int(self.config.get('cache_size') or 1000))
+
+    @staticmethod
+    def source_key(source):
+        return json.dumps([source['reader_type'], source['params']], sort_keys=True, default=str)
+
+    def source_stats(self, source):
+        stats = self.stats.get(self.source_key(source))
+
+        if stats is None:
+            return self.LATENCY_PRIORS.get(source['reader_type'], self.DEFAULT_LATENCY), 0.5
+
+        return stats
+
+    def record(self, source, latency, allowed=None):
+        old_latency, old_hit_rate = self.source_stats(source)
+        hit_rate = old_hit_rate
+
+        if allowed is not None:
+            hit_rate += self.EWMA_ALPHA * ((1.0 if allowed else 0.0) - old_hit_rate)
+
+        self.stats.set(self.source_key(source), (old_latency + self.EWMA_ALPHA * (latency - old_latency), hit_rate))
+
+    @staticmethod
+    def literals(location):
+        """
+        Returns the short-circuit value and (source, negated) pairs: the result is the short-circuit value
+        as soon as any pair evaluates to it, and the opposite one if none does
+        """
+        sources = location['params'].get('sources') or []
+
+        match location['params'].get('mode', 'union'):
+            case 'union':
+                return True, [(source, False) for source in sources]
+            case 'intersection':
+                return False, [(source, False) for source in sources]
+            case 'difference':
+                return False, [(source, i > 0) for i, source in enumerate(sources)]
+            case mode:
+                raise Exception(f'Invalid composite mode: {mode}')
+
+    def expected_cost(self, source, negated, short_circuit):
+        """Latency per chance of the source deciding the result: cheap and selective sources go first"""
+        latency, hit_rate = self.source_stats(source)
+        decisive_rate = hit_rate if negated != short_circuit else 1 - hit_rate
+
+        return latency / max(decisive_rate, 0.01)
+
+    async def check_source(self, source, username, policy=None):
+        reader_type = source['reader_type']
+        started = time.perf_counter()
+
+        try:
+            # Sources follow the chat policy
+            allowed = bool(await self.get_reader(reader_type).check_allowed_user(dict(source, policy=policy), username))
+        except asyncio.CancelledError:
+            metrics.inc('composite_source_checks_total', reader=reader_type, result='cancelled')
+            raise
+        except Exception:
+            self.record(source, time.perf_counter() - started)
+            metrics.inc('composite_source_checks_total', reader=reader_type, result='error')
+            raise
+
+        self.record(source, time.perf_counter() - started, allowed)
+        metrics.inc('composite_source_checks_total', reader=reader_type, result='allowed' if allowed else 'denied')
+
+        return allowed
+
+    async def check_allowed_user(self, location, username):
+        short_circuit, literals = self.literals(location)
+        policy = location.get('policy')
+
+        if not literals:
+            raise Exception('Composite whitelist has no sources, use /add_whitelist_source')
+
+        literals.sort(key=lambda literal: self.expected_cost(*literal, short_circuit))
+        errors = []
+        remote = []
+
+        for source, negated in literals:
+            if self.source_stats(source)[0] > self.INLINE_LATENCY:
+                remote.append((source, negated))
+                continue
+
+            try:
+                if (await self.check_source(source, username, policy) != negated) == short_circuit:
+                    return short_circuit
+            except Exception as e:
+                errors.append(e)
+
+        pending = {asyncio.create_task(self.check_source(source, username, policy)): negated
+                   for source, negated in remote}
+
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    negated = pending.pop(task)
+
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                    elif (task.result() != negated) == short_circuit:
+                        return short_circuit
+        finally:
+            for task in pending:
+                task.cancel()
+
+        # Without a decisive answer a failed source could have changed the result
+        if errors:
+            raise errors[0]
+
+        return not short_circuit
+
+    def parse_params(self, args, check_missing=True, set_default=False):
+        params = Params.parse_params(args, self.params, check_missing, set_default)
+
+        if 'mode' in params and params['mode'] not in self.MODES:
+            raise Exception(f'Invalid composite mode ({params['mode']}). Supported modes: {', '.join(self.MODES)}')
+
+        return params
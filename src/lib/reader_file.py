@@ -1,51 +1,284 @@
-import re
-from urllib.request import urlopen
+import hashlib
+import io
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 from lib.params import Params
+from lib.metrics import metrics
+from lib.lru_cache import LruCache
+from lib.executor import BlockingExecutor
+from lib.snapshot import normalize_line, build_sorted_index, open_url
 
 """
 Text File Datasource: checks telegram login against a plain text file available by URL.
 Each line should contain one username (with or without leading '@').
+Files are parsed as a stream, line by line; gzip content (Content-Encoding: gzip or .gz URL) is decompressed on the fly.
+
+With append_only=true the file is expected to only grow by appending newline-terminated lines: after the first full
+load only the new tail is fetched with an HTTP Range request. The request overlaps the already loaded part by a small
+window whose checksum is compared with the stored one; on mismatch, or if the file shrank, the file is reloaded fully.
+
+Downloads run on a thread pool. Files larger than snapshot_pool_threshold bytes are indexed in a process pool
+into a compact sorted buffer, so parsing huge lists neither blocks the event loop nor holds millions of str objects.
+
+When the chat's whitelist_max_age option is set, an index read no longer ago than that is reused without a download.
+
+With a SnapshotChanges publisher, every reload is diffed with the previous index of the file (kept for that) and
+appended tails are published as added usernames.
 """
 
 class ReaderFile:
     config = {}
 
-    params = {'location': {'type': str}}
+    params = {'location': {'type': str}, 'append_only': {'default': False, 'type': bool}}
 
-    def __init__(self, config):
+    # Bytes before the known offset re-fetched to detect rewritten files in append_only mode
+    APPEND_CHECK_WINDOW = 4096
+
+    # url -> {'index', 'offset', 'window_digest', 'window_size'} for append_only locations
+    append_state = None
+    # url -> last index, kept for locations read with whitelist_max_age
+    snapshots = None
+    executor = None
+    changes = None
+
+    def __init__(self, config, changes=None):
         if config:
             self.config = config
 
+        self.changes = changes
+
+        self.executor = BlockingExecutor('file', max_workers=4)
+
+        self.append_state = LruCache('file_append_state', max_size=int(self.config.get('cache_size') or 1000),
+                                     ttl=float(self.config.get('cache_ttl') or 3600))
+        self.snapshots = LruCache('file_snapshots', max_size=int(self.config.get('cache_size') or 1000),
+                                  ttl=float(self.config.get('cache_ttl') or 3600))
+
     async def check_allowed_user(self, location, username):
-        usernames = await self.read_users(location)
+        usernames = await self.read_snapshot(location)
 
-        if username.lower() in usernames:
+        if username.lower().removeprefix('@') in usernames:
             return True
         else:
             return False
 
-    async def read_users(self, location, max_count):
+    async def check_allowed_users(self, location, usernames):
+        """Check several usernames against one snapshot of the file"""
+        index = await self.read_snapshot(location)
+
+        return [username.lower().removeprefix('@') in index for username in usernames]
+
+    async def read_snapshot(self, location):
+        """Returns set-like index of all usernames in the file, reusing one read within whitelist_max_age"""
+        url = location['params']['location']
+        max_age = (location.get('policy') or {}).get('whitelist_max_age')
+        cache = self.append_state if location['params'].get('append_only') else self.snapshots
+
+        if max_age:
+            cached = cache.get(url)
+            if cached is not None and cache.age(url) <= max_age:
+                metrics.inc('reader_cache_reuse_total', reader='file')
+                return cached['index'] if cache is self.append_state else cached
+
+        if location['params'].get('append_only'):
+            return await self.read_index_append_only(location)
+
+        index = await self.read_index(location)
+        if max_age:
+            self.snapshots.set(url, index)
+
+        return index
+
+    @contextmanager
+    def open_stream(self, location):
+        """Open location as a binary stream, transparently decompressing gzip content"""
+        url = location['params']['location']
+
+        try:
+            with metrics.timer('reader_fetch_seconds', reader='file'):
+                with open_url(url) as stream:
+                    yield stream
+        except Exception:
+            metrics.inc('reader_errors_total', reader='file')
+            raise
+
+    @staticmethod
+    def iter_usernames(stream):
+        """Decode and normalize lines one at a time, skipping blank lines and comments"""
+        for raw_line in stream:
+            username = normalize_line(raw_line)
+            if username is not None:
+                yield username
+
+    async def read_index(self, location):
+        """Load all usernames into a set-like index for lookups"""
+        url = location['params']['location']
+        index, digest = await self.executor.run(self.load_index, location, key=url)
+
+        if self.changes:
+            self.changes.update(self.executor, 'file', {'location': url}, index, digest)
+
+        return index
+
+    def load_index(self, location):
+        """
+        Blocking index load: small files are parsed inline. Large ones are downloaded again and indexed by a
+        process pool worker, so only up to threshold bytes are ever held here. Returns the index and a digest of
+        the file content.
+        """
+        threshold = int(self.config.get('snapshot_pool_threshold') or 8 * 1024 * 1024)
+
+        with self.open_stream(location) as stream:
+            chunks = []
+            size = 0
+            while size < threshold:
+                chunk = stream.read(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+
+            if size < threshold:
+                raw = b''.join(chunks)
+                metrics.inc('snapshot_builds_total', mode='inline')
+                return set(self.iter_usernames(io.BytesIO(raw))), hashlib.sha1(raw).hexdigest()
+
+        # Too large to parse here: the worker downloads and streams the file itself
+        del chunks
+
+        metrics.inc('snapshot_builds_total', mode='process')
+        try:
+            with metrics.timer('snapshot_build_seconds'):
+                return build_sorted_index(location['params']['location'], self.config.get('snapshot_workers'))
+        except Exception:
+            metrics.inc('reader_errors_total', reader='file')
+            raise
+
+    async def read_index_append_only(self, location):
+        """Load index once, then extend it with the lines appended since the last fetch"""
         url = location['params']['location']
 
-        with urlopen(url) as response:
-            content_bytes = response.read()
-            try:
-                content = content_bytes.decode('utf-8')
-            except Exception:
-                content = content_bytes.decode('latin-1')
-
-        usernames = [
-            re.sub('^@', '', line.strip().lower())
-            for line in content.splitlines()
-            if line.strip() != '' and not line.strip().startswith('#')
-        ]
-
-        if max_count is None:
-            return usernames
+        if url.split('?')[0].endswith('.gz'):
+            raise Exception('append_only mode is not supported for gzip files')
+
+        old_state = self.append_state.get(url)
+
+        if old_state is None:
+            state = await self.executor.run(self.load_append_state, url, key=url)
         else:
-            return usernames[0:max_count]
+            state = await self.executor.run(self.update_append_state, url, old_state, key=url)
+
+        added = state.pop('added', None)
+        self.append_state.set(url, state)
+
+        if self.changes and old_state is not None:
+            if state['index'] is not old_state['index']:
+                # Reloaded fully
+                self.changes.submit(self.executor, self.changes.publish_diff, 'file', {'location': url},
+                                    old_state['index'], state['index'])
+            elif added:
+                self.changes.submit(self.executor, self.changes.publish, 'file', {'location': url}, added)
+
+        return state['index']
+
+    def load_append_state(self, url):
+        """Full load of an append_only location"""
+        try:
+            with metrics.timer('reader_fetch_seconds', reader='file'):
+                with urlopen(Request(url, headers={'Accept-Encoding': 'identity'})) as response:
+                    return self.parse_append_stream(response)
+        except Exception:
+            metrics.inc('reader_errors_total', reader='file')
+            raise
+
+    def parse_append_stream(self, stream):
+        """Index complete lines remembering the offset after the last one and the checksum of the bytes before it"""
+        index = set()
+        offset = 0
+        window = deque()
+        window_size = 0
+
+        for raw_line in stream:
+            if not raw_line.endswith(b'\n'):
+                break
+
+            index.update(self.iter_usernames([raw_line]))
+            offset += len(raw_line)
+
+            window.append(raw_line)
+            window_size += len(raw_line)
+            while window_size - len(window[0]) >= self.APPEND_CHECK_WINDOW:
+                window_size -= len(window.popleft())
+
+        metrics.inc('reader_file_append_fetches_total', mode='full')
+
+        return self.append_state_entry(index, offset, b''.join(window)[-self.APPEND_CHECK_WINDOW:])
+
+    def update_append_state(self, url, state):
+        """Fetch the tail after the known offset, falling back to full load if the prefix changed"""
+        start = state['offset'] - state['window_size']
+        request = Request(url, headers={'Accept-Encoding': 'identity', 'Range': f'bytes={start}-'})
+
+        try:
+            with metrics.timer('reader_fetch_seconds', reader='file'):
+                with urlopen(request) as response:
+                    if getattr(response, 'status', None) != 206:
+                        # Range not supported by the server: the full body is already here
+                        return self.parse_append_stream(response)
+
+                    if not response.headers.get('Content-Range', '').startswith(f'bytes {start}-'):
+                        data = None
+                    else:
+                        data = response.read()
+        except HTTPError as e:
+            if e.code != 416:
+                metrics.inc('reader_errors_total', reader='file')
+                raise
+            # Range not satisfiable: the file is shorter than it used to be
+            data = None
+        except Exception:
+            metrics.inc('reader_errors_total', reader='file')
+            raise
+
+        if data is None or hashlib.sha256(data[0:state['window_size']]).hexdigest() != state['window_digest']:
+            return self.load_append_state(url)
+
+        new_data = data[state['window_size']:]
+        complete_size = new_data.rfind(b'\n') + 1
+
+        if complete_size == 0:
+            metrics.inc('reader_file_append_fetches_total', mode='unchanged')
+            return state
+
+        added = set(self.iter_usernames(new_data[0:complete_size].splitlines())) - state['index']
+        state['index'].update(added)
+        metrics.inc('reader_file_append_fetches_total', mode='tail')
+
+        window = data[0:state['window_size'] + complete_size][-self.APPEND_CHECK_WINDOW:]
+        entry = self.append_state_entry(state['index'], state['offset'] + complete_size, window)
+        entry['added'] = added
+
+        return entry
+
+    @staticmethod
+    def append_state_entry(index, offset, window):
+        return {
+            'index': index,
+            'offset': offset,
+            'window_digest': hashlib.sha256(window).hexdigest(),
+            'window_size': len(window),
+        }
 
-    def parse_params(self, args, check_missing=True):
-        return Params.parse_params(args, self.params, check_missing)
+    async def read_users(self, location, max_count=None):
+        """Load users, reading only as much of the file as needed for max_count entries"""
+        def load_users():
+            with self.open_stream(location) as stream:
+                return list(islice(self.iter_usernames(stream), max_count))
 
+        return await self.executor.run(load_users, key=location['params']['location'])
 
+    def parse_params(self, args, check_missing=True, set_default=False):
+        return Params.parse_params(args, self.params, check_missing, set_default)
@@ -1,16 +1,36 @@
 import gspread
+import hashlib
+import json
 import re
 import os
 from lib.params import Params
+from lib.condition import Condition
+from lib.metrics import metrics
+from lib.executor import BlockingExecutor
+from lib.rate_limiter import TokenBucketScheduler, request_priority, PRIORITY_JOIN
+from lib.lru_cache import LruCache
 
 """
 Google Spreadsheets Datasource: checks telegram login against given column on given sheet of online table
+gspread is synchronous, so every call runs on a dedicated bounded thread pool with a per-call timeout.
+Usernames and all columns used by the condition expression are fetched together in one batch_get request,
+and the compiled condition is evaluated on the row of the username.
+All calls share a token bucket sized to the Google Sheets read quota, with join lookups served first. When the API
+is unavailable or over quota, join lookups fall back to the last successfully read column values.
+With a SnapshotChanges publisher, each fresh full read is diffed with the previous one (usernames and condition values).
+Columns read no longer ago than the chat's whitelist_max_age option are reused without an API call.
+With RefreshOwnership, one bot replica reads each sheet range from Google and the others read its published copy.
 """
 
 class ReaderGspread:
     reader = None
+    executor = None
+    scheduler = None
     config = {}
-    sources = {}
+    sources = None
+    last_values = None
+    changes = None
+    ownership = None
 
     params = {
                 'location': {'type': str},
@@ -19,62 +39,198 @@ class ReaderGspread:
                 'condition': {'default': None, 'type': 'condition'}
              }
 
-    def __init__(self, config):
+    def __init__(self, config, changes=None, ownership=None):
         if config:
             self.config = config
 
+        self.changes = changes
+        self.ownership = ownership
+
         if 'gsa_file' not in config:
             raise Exception('No google service account file given for gspread reader')
         elif not os.path.exists(config['gsa_file']):
             raise Exception(f'Google service account file not found: {config['gsa_file']}')
 
         self.reader = gspread.service_account(filename=config['gsa_file'])
+        # Abort hung Google requests: a timed out executor call keeps its worker until the request returns
+        self.reader.http_client.set_timeout(float(config.get('gspread_timeout') or 30))
+        self.executor = BlockingExecutor('gspread',
+                                         max_workers=int(config.get('gspread_workers') or 4),
+                                         timeout=float(config.get('gspread_timeout') or 30))
+        self.scheduler = TokenBucketScheduler('gspread', rate_per_minute=float(config.get('gspread_quota') or 60))
 
-    async def check_allowed_user(self, location, username):
-        usernames = await self.read_users(location)
+        # Worksheet handles by (url, sheet) and last read column values by (url, sheet, columns, max_count)
+        cache_size = int(config.get('cache_size') or 1000)
+        cache_ttl = float(config.get('cache_ttl') or 3600)
+        self.sources = LruCache('gspread_worksheets', max_size=cache_size, ttl=cache_ttl)
+        self.last_values = LruCache('gspread_snapshots', max_size=cache_size, ttl=cache_ttl)
 
-        if 'condition' in location['params']:
-            cond_values = await self.read_cond_column(location)
-        else:
-            cond_values = None
+    async def read_condition_columns(self, location):
+        """Returns usernames, values of columns by number and the compiled condition (None without condition)"""
+        column = location['params']['column']
+        condition = location['params'].get('condition')
+        columns = [column] + Condition.columns(condition) if condition else [column]
+
+        values = dict(zip(columns, await self.read_columns(location, columns)))
+
+        return values[column], values, Condition.compile(condition) if condition else None
+
+    async def check_allowed_user(self, location, username):
+        usernames, values, check = await self.read_condition_columns(location)
+        username = username.lower().removeprefix('@')
 
         for i, list_username in enumerate(usernames):
             list_username = re.sub('^@', '', list_username.lower().strip())
             if username == list_username:
-                if cond_values is None:
-                    return True
-                elif Params.check_condition(location['params']['condition'], cond_values[i], lower_case=True):
-                    return True
-                else:
-                    return False
-
-        if username.lower() in map(lambda x: re.sub('^@', '', x.lower().strip()), usernames):
-            return True
-        else:
-            return False
+                return check is None or check(values, i)
 
-    async def read_users(self, location, max_count = None):
-        """Load users"""
-        if location['params']['location'] not in self.sources:
-            spreadsheet = self.reader.open_by_url(location['params']['location'])
-            self.sources[location['params']['location']] = spreadsheet.get_worksheet(location['params']['sheet'] - 1)
+        return False
+
+    async def check_allowed_users(self, location, usernames):
+        """Check several usernames with one read: the first row of a username decides, as for single checks"""
+        list_usernames, values, check = await self.read_condition_columns(location)
+
+        allowed = {}
+        for i, list_username in enumerate(list_usernames):
+            list_username = re.sub('^@', '', list_username.lower().strip())
+            if list_username in allowed:
+                continue
+
+            allowed[list_username] = check is None or check(values, i)
+
+        return [allowed.get(username.lower().removeprefix('@'), False) for username in usernames]
+
+    async def get_worksheet(self, location):
+        """Returns cached worksheet handle for the location, opening the spreadsheet on cache miss"""
+        url = location['params']['location']
+        key = (url, location['params']['sheet'])
+
+        worksheet = self.sources.get(key)
+
+        if worksheet is None:
+            def open_worksheet():
+                return self.reader.open_by_url(url).get_worksheet(location['params']['sheet'] - 1)
 
-        usernames = self.sources[location['params']['location']].col_values(location['params']['column'])
+            worksheet = await self.fetch(open_worksheet, key=url)
+            self.sources.set(key, worksheet)
 
-        if max_count is None:
-            return usernames
+        return worksheet
+
+    async def fetch(self, method, *args, key=None):
+        """Run blocking gspread method on the executor within the quota, recording its latency and errors"""
+        def timed_call():
+            with metrics.timer('reader_fetch_seconds', reader='gspread'):
+                return method(*args)
+
+        try:
+            await self.scheduler.acquire(timeout=self.executor.timeout)
+            result = await self.executor.run(timed_call, key=key)
+        except gspread.exceptions.APIError as e:
+            metrics.inc('reader_errors_total', reader='gspread')
+            if e.code == 429 or getattr(e.response, 'status_code', None) == 429:
+                self.scheduler.backoff(self.retry_after(e))
+            raise
+        except Exception:
+            metrics.inc('reader_errors_total', reader='gspread')
+            raise
+
+        self.scheduler.success()
+
+        return result
+
+    @staticmethod
+    def retry_after(error):
+        """Returns Retry-After header value of API error response in seconds, if any"""
+        try:
+            return float(error.response.headers['Retry-After'])
+        except Exception:
+            return None
+
+    async def read_columns(self, location, columns, max_count=None):
+        """
+        Load values of several columns with one batch_get call, optionally limited to the first max_count rows.
+        Join lookups are served the last known values when the API call fails.
+        """
+        unique_columns = list(dict.fromkeys(columns))
+        key = (location['params']['location'], location['params']['sheet'], tuple(unique_columns), max_count)
+
+        ranges = []
+        for column in unique_columns:
+            letter = gspread.utils.rowcol_to_a1(1, column).rstrip('0123456789')
+            ranges.append(f'{letter}1:{letter}{max_count}' if max_count else f'{letter}:{letter}')
+
+        max_age = (location.get('policy') or {}).get('whitelist_max_age')
+        if max_age:
+            values = self.last_values.get(key)
+            if values is not None and self.last_values.age(key) <= max_age:
+                metrics.inc('reader_cache_reuse_total', reader='gspread')
+                return [values[column] for column in columns]
+
+        fetched = False
+
+        async def fetch_values():
+            nonlocal fetched
+            worksheet = await self.get_worksheet(location)
+            value_ranges = await self.fetch(
+                lambda: worksheet.batch_get(ranges, major_dimension=gspread.utils.Dimension.cols),
+                key=location['params']['location'])
+            fetched = True
+
+            # Each value range holds a single column, or nothing if the column is empty
+            return [value_range[0] if value_range else [] for value_range in value_ranges]
+
+        try:
+            if self.ownership and max_count is None:
+                name = 'gspread:' + hashlib.sha1(json.dumps(key[0:3]).encode()).hexdigest()
+                column_values = await self.ownership.read(name, fetch_values)
+            else:
+                column_values = await fetch_values()
+        except Exception:
+            values = self.last_values.get(key) if request_priority.get() == PRIORITY_JOIN else None
+            if values is None:
+                raise
+            metrics.inc('reader_stale_total', reader='gspread')
         else:
-            return usernames[0:max_count]
+            values = dict(zip(unique_columns, column_values))
+            old_values = self.last_values.get(key)
+            self.last_values.set(key, values)
 
-    async def read_cond_column(self, location):
-        """ Load condition column values """
-        if location['params']['location'] not in self.sources:
-            spreadsheet = self.reader.open_by_url(location['params']['location'])
-            self.sources[location['params']['location']] = spreadsheet.get_worksheet(location['params']['sheet'] - 1)
+            # Changes are published by the replica that read the sheet
+            if self.changes and fetched and max_count is None and old_values is not None:
+                source = {'location': key[0], 'sheet': key[1], 'columns': unique_columns}
+                self.changes.submit(self.executor, self.publish_column_diff, source, unique_columns, old_values, values)
 
-        cond_column = self.sources[location['params']['location']].col_values(int(location['params']['condition']['param']))
+        return [values[column] for column in columns]
+
+    @staticmethod
+    def column_snapshot(values, columns):
+        """
+        Returns username -> condition column value, or list of values with several condition columns (None without
+        them), first row of a username wins
+        """
+        usernames = values[columns[0]]
+        cond_columns = [values[column] for column in columns[1:]]
+        snapshot = {}
+
+        for i, username in enumerate(usernames):
+            username = re.sub('^@', '', username.lower().strip())
+            if username and username not in snapshot:
+                row = [column_values[i] if i < len(column_values) else '' for column_values in cond_columns]
+                snapshot[username] = (row[0] if len(row) == 1 else row) if row else None
+
+        return snapshot
+
+    def publish_column_diff(self, source, columns, old_values, new_values):
+        """Blocking: diff and publish two reads of the same columns"""
+        if old_values != new_values:
+            self.changes.publish_diff('gspread', source, self.column_snapshot(old_values, columns),
+                                      self.column_snapshot(new_values, columns))
+
+    async def read_users(self, location, max_count = None):
+        """Load users, requesting only the first max_count rows if given"""
+        usernames, = await self.read_columns(location, [location['params']['column']], max_count)
 
-        return cond_column
+        return usernames
 
     def parse_params(self, args, check_missing=True, set_default=False):
         """
@@ -0,0 +1,89 @@
+import gzip
+import io
+from contextlib import contextmanager
+from lib.params import Params
+from lib.executor import BlockingExecutor
+from lib.reader_file import ReaderFile
+from lib.redis import Redis
+
+"""
+Redis Set Datasource: the whitelist is stored in the bot's own Redis as a set of lowercase usernames, one set per chat.
+Join requests are checked with a single SISMEMBER, with no third-party service involved.
+The set is bulk loaded from a text file (URL or uploaded document, same format as the file reader, gzip allowed):
+usernames are added to a temporary key with pipelined SADD in chunks, which then atomically replaces the live set.
+With a SnapshotChanges publisher, the usernames added and removed by a load are published.
+"""
+
+
+class ReaderRedis:
+    config = {}
+    redis = None
+    executor = None
+    changes = None
+
+    # Per-chat key is assigned by Whitelist; set explicitly only for the default source
+    params = {'key': {'default': None, 'type': str}}
+
+    # Members per SADD command
+    CHUNK_SIZE = 1000
+
+    def __init__(self, config, redis_client: Redis, changes=None):
+        if config:
+            self.config = config
+
+        self.redis = redis_client
+        self.changes = changes
+        self.executor = BlockingExecutor('redis_load', max_workers=2)
+
+    @staticmethod
+    def set_key(location):
+        if not location['params'].get('key'):
+            raise Exception('Redis whitelist key is not set')
+
+        return location['params']['key']
+
+    async def check_allowed_user(self, location, username):
+        return self.redis.sismember(self.set_key(location), username.lower().removeprefix('@'))
+
+    async def check_allowed_users(self, location, usernames):
+        """Check several usernames with one SMISMEMBER"""
+        return self.redis.smismember(self.set_key(location),
+                                     [username.lower().removeprefix('@') for username in usernames])
+
+    async def read_users(self, location, max_count=None):
+        """Returns up to max_count random usernames of the set"""
+        return self.redis.srandmember(self.set_key(location), max_count or self.redis.scard(self.set_key(location)))
+
+    def count_users(self, location):
+        return self.redis.scard(self.set_key(location))
+
+    async def load(self, location, open_stream):
+        """Replace the set with usernames read from the stream opened by open_stream(), returns the new set size"""
+        key = self.set_key(location)
+
+        def load_set():
+            with open_stream() as stream:
+                if not self.changes:
+                    return self.redis.replace_set(key, ReaderFile.iter_usernames(stream), self.CHUNK_SIZE)
+
+                count, added, removed = self.redis.replace_set(key, ReaderFile.iter_usernames(stream), self.CHUNK_SIZE,
+                                                               with_diff=True)
+
+            self.changes.publish('redis', {'key': key}, added, removed)
+
+            return count
+
+        return await self.executor.run(load_set, key=key)
+
+    @staticmethod
+    @contextmanager
+    def open_bytes(data: bytes):
+        """Open uploaded file content as a binary stream, decompressing gzip"""
+        if data[0:2] == b'\x1f\x8b':
+            with gzip.GzipFile(fileobj=io.BytesIO(data)) as stream:
+                yield stream
+        else:
+            yield io.BytesIO(data)
+
+    def parse_params(self, args, check_missing=True, set_default=False):
+        return Params.parse_params(args, self.params, check_missing, set_default)
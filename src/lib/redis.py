@@ -3,11 +3,46 @@ Redis client class for storing and retrieving data
 """
 import redis
 import json
+import uuid
+import zlib
 from typing import Any, Optional
+from lib.metrics import metrics
+from lib.serializer import get_serializer
 
 
 class Redis:
-    def __init__(self, host: str = 'localhost', port: int = 6379, db: int = 0, password: str = None):
+    # Lease: take the key if free, renew it if held by the same owner; a new holder gets the next fencing token
+    ACQUIRE_LEASE_SCRIPT = """
+        local holder = redis.call('GET', KEYS[1])
+        if holder == ARGV[1] then
+            redis.call('PEXPIRE', KEYS[1], ARGV[2])
+            return tonumber(redis.call('GET', KEYS[2]) or '0')
+        end
+        if holder then
+            return false
+        end
+        redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+        return redis.call('INCR', KEYS[2])
+    """
+    RELEASE_LEASE_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    """
+    # Write a hash unless a newer fencing token was issued since the writer's lease was granted
+    HSET_FENCED_SCRIPT = """
+        if tonumber(ARGV[1]) < tonumber(redis.call('GET', KEYS[1]) or '0') then
+            return 0
+        end
+        redis.call('DEL', KEYS[2])
+        redis.call('HSET', KEYS[2], unpack(ARGV, 3))
+        redis.call('PEXPIRE', KEYS[2], ARGV[2])
+        return 1
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 6379, db: int = 0, password: str = None,
+                 serializer=None):
         """
         Initialize Redis connection
         
@@ -16,12 +51,15 @@ class Redis:
             port: Redis server port
             db: Redis database number
             password: Redis password (optional)
+            serializer: Serializer of stored dicts and snapshots (binary by default), see lib.serializer
         """
         self.host = host
         self.port = port
         self.db = db
         self.password = password
+        self.serializer = serializer or get_serializer()
         self.client = None
+        self.binary_client = None
         self._connect()
     
     def _connect(self):
@@ -34,8 +72,20 @@ class Redis:
                 password=self.password,
                 decode_responses=True
             )
+            # Serialized values are read as bytes
+            self.binary_client = redis.Redis(
+                host=self.host,
+                port=self.port,
+                db=self.db,
+                password=self.password,
+                decode_responses=False
+            )
             # Test connection
             self.client.ping()
+
+            self.acquire_lease_script = self.client.register_script(self.ACQUIRE_LEASE_SCRIPT)
+            self.release_lease_script = self.client.register_script(self.RELEASE_LEASE_SCRIPT)
+            self.hset_fenced_script = self.client.register_script(self.HSET_FENCED_SCRIPT)
         except redis.ConnectionError as e:
             raise Exception(f"Failed to connect to Redis at {self.host}:{self.port}: {e}")
     
@@ -50,10 +100,46 @@ class Redis:
             Value as string or None if key doesn't exist
         """
         try:
-            return self.client.get(key)
+            with metrics.timer('redis_command_seconds', command='get'):
+                return self.client.get(key)
         except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='get')
             raise Exception(f"Failed to get value from Redis: {e}")
     
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        """
+        Get raw value from Redis by key
+
+        Args:
+            key: Redis key
+
+        Returns:
+            Value as bytes or None if key doesn't exist
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='get'):
+                return self.binary_client.get(key)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='get')
+            raise Exception(f"Failed to get value from Redis: {e}")
+
+    def mget(self, keys: list) -> list:
+        """
+        Get values of several keys with one command
+
+        Args:
+            keys: Redis keys
+
+        Returns:
+            List of values as strings, None for missing keys
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='mget'):
+                return self.client.mget(keys)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='mget')
+            raise Exception(f"Failed to get values from Redis: {e}")
+
     def set(self, key: str, value: Any, expire: Optional[int] = None) -> bool:
         """
         Set value in Redis by key
@@ -73,13 +159,155 @@ class Redis:
             else:
                 value = str(value)
             
-            if expire:
-                return self.client.setex(key, expire, value)
-            else:
-                return self.client.set(key, value)
+            with metrics.timer('redis_command_seconds', command='set'):
+                if expire:
+                    return self.client.setex(key, expire, value)
+                else:
+                    return self.client.set(key, value)
         except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='set')
             raise Exception(f"Failed to set value in Redis: {e}")
     
+    def set_nx(self, key: str, value: Any, expire: int) -> bool:
+        """
+        Set value in Redis only if key doesn't exist yet
+
+        Args:
+            key: Redis key
+            value: Value to store (will be converted to string)
+            expire: Expiration time in seconds
+
+        Returns:
+            True if the key was set, False if it already existed
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='set_nx'):
+                return bool(self.client.set(key, str(value), nx=True, ex=expire))
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='set_nx')
+            raise Exception(f"Failed to set value in Redis: {e}")
+
+    def incr(self, key: str) -> int:
+        """
+        Increment integer value of key, a missing key counting as 0
+
+        Args:
+            key: Redis key
+
+        Returns:
+            New value
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='incr'):
+                return self.client.incr(key)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='incr')
+            raise Exception(f"Failed to increment value in Redis: {e}")
+
+    @staticmethod
+    def fence_key(key: str) -> str:
+        """Key of the fencing token counter of a lease"""
+        return f"{key}:fence"
+
+    def acquire_lease(self, key: str, owner: str, ttl_ms: int) -> Optional[int]:
+        """
+        Acquire lease key for owner (SET NX PX), or renew it if owner already holds it
+
+        Args:
+            key: Redis key of the lease
+            owner: Unique id of the lease holder
+            ttl_ms: Lease period in milliseconds
+
+        Returns:
+            Fencing token of the lease, incremented on every change of holder, or None if held by another owner
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='acquire_lease'):
+                token = self.acquire_lease_script(keys=[key, self.fence_key(key)], args=[owner, ttl_ms])
+                return int(token) if token is not None else None
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='acquire_lease')
+            raise Exception(f"Failed to acquire lease in Redis: {e}")
+
+    def release_lease(self, key: str, owner: str) -> bool:
+        """
+        Release lease key if owner holds it
+
+        Args:
+            key: Redis key of the lease
+            owner: Unique id of the lease holder
+
+        Returns:
+            True if the lease was released
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='release_lease'):
+                return bool(self.release_lease_script(keys=[key], args=[owner]))
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='release_lease')
+            raise Exception(f"Failed to release lease in Redis: {e}")
+
+    def hset_fenced(self, lease_key: str, token: int, key: str, mapping: dict, expire_ms: int) -> bool:
+        """
+        Replace hash key with mapping, unless the lease was granted to another holder after token was issued
+
+        Args:
+            lease_key: Redis key of the lease guarding the write
+            token: Fencing token of the writer's lease
+            key: Redis key of the hash
+            mapping: Field -> value dict
+            expire_ms: Expiration time in milliseconds
+
+        Returns:
+            True if written, False if the token is stale
+        """
+        args = [token, expire_ms]
+        for field, value in mapping.items():
+            args.extend([field, value])
+
+        try:
+            with metrics.timer('redis_command_seconds', command='hset_fenced'):
+                return bool(self.hset_fenced_script(keys=[self.fence_key(lease_key), key], args=args))
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='hset_fenced')
+            raise Exception(f"Failed to write hash in Redis: {e}")
+
+    def hget(self, key: str, field: str) -> Optional[str]:
+        """
+        Get hash field value
+
+        Args:
+            key: Redis key of the hash
+            field: Field name
+
+        Returns:
+            Value as string or None if the key or field doesn't exist
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='hget'):
+                return self.client.hget(key, field)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='hget')
+            raise Exception(f"Failed to get hash field from Redis: {e}")
+
+    def hget_bytes(self, key: str, field: str) -> Optional[bytes]:
+        """
+        Get raw hash field value
+
+        Args:
+            key: Redis key of the hash
+            field: Field name
+
+        Returns:
+            Value as bytes or None if the key or field doesn't exist
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='hget'):
+                return self.binary_client.hget(key, field)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='hget')
+            raise Exception(f"Failed to get hash field from Redis: {e}")
+
     def delete(self, key: str) -> bool:
         """
         Delete key from Redis
@@ -91,8 +319,10 @@ class Redis:
             True if key was deleted, False if key didn't exist
         """
         try:
-            return bool(self.client.delete(key))
+            with metrics.timer('redis_command_seconds', command='delete'):
+                return bool(self.client.delete(key))
         except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='delete')
             raise Exception(f"Failed to delete key from Redis: {e}")
     
     def exists(self, key: str) -> bool:
@@ -106,10 +336,396 @@ class Redis:
             True if key exists, False otherwise
         """
         try:
-            return bool(self.client.exists(key))
+            with metrics.timer('redis_command_seconds', command='exists'):
+                return bool(self.client.exists(key))
         except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='exists')
             raise Exception(f"Failed to check key existence in Redis: {e}")
     
+    def sismember(self, key: str, member: str) -> bool:
+        """
+        Check if member belongs to the set stored at key
+
+        Args:
+            key: Redis key of the set
+            member: Set member
+
+        Returns:
+            True if member is in the set, False otherwise (including missing key)
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='sismember'):
+                return bool(self.client.sismember(key, member))
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='sismember')
+            raise Exception(f"Failed to check set membership in Redis: {e}")
+
+    def scard(self, key: str) -> int:
+        """
+        Get number of members of the set stored at key
+
+        Args:
+            key: Redis key of the set
+
+        Returns:
+            Set size, 0 if key doesn't exist
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='scard'):
+                return self.client.scard(key)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='scard')
+            raise Exception(f"Failed to get set size from Redis: {e}")
+
+    def srandmember(self, key: str, count: int) -> list:
+        """
+        Get up to count distinct random members of the set stored at key
+
+        Args:
+            key: Redis key of the set
+            count: Max number of members to return
+
+        Returns:
+            List of members, empty if key doesn't exist
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='srandmember'):
+                return self.client.srandmember(key, count)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='srandmember')
+            raise Exception(f"Failed to get set members from Redis: {e}")
+
+    def smismember(self, key: str, members: list) -> list:
+        """
+        Check membership of several members in the set stored at key with one command
+
+        Args:
+            key: Redis key of the set
+            members: Members to check
+
+        Returns:
+            List of booleans in the order of members
+        """
+        if not members:
+            return []
+
+        try:
+            with metrics.timer('redis_command_seconds', command='smismember'):
+                return [bool(result) for result in self.client.smismember(key, members)]
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='smismember')
+            raise Exception(f"Failed to check set membership in Redis: {e}")
+
+    def sadd(self, key: str, *members) -> int:
+        """
+        Add members to the set stored at key
+
+        Args:
+            key: Redis key of the set
+            members: Members to add
+
+        Returns:
+            Number of members that were not in the set yet
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='sadd'):
+                return self.client.sadd(key, *members)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='sadd')
+            raise Exception(f"Failed to add set members in Redis: {e}")
+
+    def srem(self, key: str, *members) -> int:
+        """
+        Remove members from the set stored at key
+
+        Args:
+            key: Redis key of the set
+            members: Members to remove
+
+        Returns:
+            Number of members removed
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='srem'):
+                return self.client.srem(key, *members)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='srem')
+            raise Exception(f"Failed to remove set members in Redis: {e}")
+
+    def smembers(self, key: str) -> set:
+        """
+        Get all members of the set stored at key
+
+        Args:
+            key: Redis key of the set
+
+        Returns:
+            Set of members, empty if key doesn't exist
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='smembers'):
+                return self.client.smembers(key)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='smembers')
+            raise Exception(f"Failed to get set members from Redis: {e}")
+
+    def zadd(self, key: str, mapping: dict) -> int:
+        """
+        Add members with scores to the sorted set stored at key, updating scores of existing members
+
+        Args:
+            key: Redis key of the sorted set
+            mapping: Member to score mapping
+
+        Returns:
+            Number of new members
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='zadd'):
+                return self.client.zadd(key, mapping)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='zadd')
+            raise Exception(f"Failed to add sorted set members in Redis: {e}")
+
+    def zrem(self, key: str, *members) -> int:
+        """
+        Remove members from the sorted set stored at key
+
+        Args:
+            key: Redis key of the sorted set
+            members: Members to remove
+
+        Returns:
+            Number of members removed
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='zrem'):
+                return self.client.zrem(key, *members)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='zrem')
+            raise Exception(f"Failed to remove sorted set members in Redis: {e}")
+
+    def zrangebyscore(self, key: str, min_score: float | str = '-inf', max_score: float | str = '+inf') -> list:
+        """
+        Get members of the sorted set stored at key with scores in the given range, lowest score first
+
+        Args:
+            key: Redis key of the sorted set
+            min_score: Lowest score, inclusive
+            max_score: Highest score, inclusive
+
+        Returns:
+            List of members, empty if key doesn't exist
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='zrangebyscore'):
+                return self.client.zrangebyscore(key, min_score, max_score)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='zrangebyscore')
+            raise Exception(f"Failed to get sorted set members from Redis: {e}")
+
+    def zremrangebyscore(self, key: str, min_score: float | str, max_score: float | str) -> int:
+        """
+        Remove members of the sorted set stored at key with scores in the given range
+
+        Args:
+            key: Redis key of the sorted set
+            min_score: Lowest score, inclusive
+            max_score: Highest score, inclusive
+
+        Returns:
+            Number of members removed
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='zremrangebyscore'):
+                return self.client.zremrangebyscore(key, min_score, max_score)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='zremrangebyscore')
+            raise Exception(f"Failed to remove sorted set members in Redis: {e}")
+
+    def replace_set(self, key: str, members, chunk_size: int = 1000, pipeline_depth: int = 10, with_diff: bool = False):
+        """
+        Replace the set stored at key with members from an iterable of any size
+
+        Members are added to a temporary key with pipelined SADD commands of chunk_size members,
+        sending pipeline_depth commands per round-trip. The temporary key is then renamed over key,
+        so readers see either the old set or the complete new one.
+
+        Args:
+            key: Redis key of the set
+            members: Iterable of set members
+            chunk_size: Members per SADD command
+            pipeline_depth: SADD commands per pipeline round-trip
+            with_diff: Also return members added and removed by the swap, computed atomically with it
+
+        Returns:
+            Number of distinct members in the new set, or (number, added, removed) with with_diff
+        """
+        # Expires if the load is interrupted before the swap
+        temp_key = f"{key}:loading:{uuid.uuid4().hex}"
+
+        try:
+            with metrics.timer('redis_command_seconds', command='replace_set'):
+                pipe = self.client.pipeline(transaction=False)
+                chunk = []
+                loaded = 0
+
+                for member in members:
+                    chunk.append(member)
+                    if len(chunk) == chunk_size:
+                        pipe.sadd(temp_key, *chunk)
+                        chunk = []
+                        loaded += 1
+                        if len(pipe) >= pipeline_depth:
+                            pipe.expire(temp_key, 3600)
+                            pipe.execute()
+
+                if chunk:
+                    pipe.sadd(temp_key, *chunk)
+                    loaded += 1
+
+                if len(pipe):
+                    pipe.expire(temp_key, 3600)
+                    pipe.execute()
+
+                swap = self.client.pipeline(transaction=True)
+                if with_diff:
+                    swap.sdiff(temp_key, key)
+                    swap.sdiff(key, temp_key)
+
+                if loaded == 0:
+                    swap.delete(key)
+                    swap.scard(key)
+                else:
+                    swap.rename(temp_key, key)
+                    swap.persist(key)
+                    swap.scard(key)
+
+                results = swap.execute()
+
+                return (results[-1], list(results[0]), list(results[1])) if with_diff else results[-1]
+        except Exception as e:
+            try:
+                self.client.delete(temp_key)
+            except redis.RedisError:
+                pass
+
+            if isinstance(e, redis.RedisError):
+                metrics.inc('redis_errors_total', command='replace_set')
+                raise Exception(f"Failed to load set into Redis: {e}")
+
+            raise
+
+    def xadd_many(self, entries_by_stream: dict, maxlen: Optional[int] = None) -> list:
+        """
+        Append entries to one or more streams with one pipelined round-trip
+
+        Args:
+            entries_by_stream: Stream key -> list of field -> value dicts
+            maxlen: Approximate max length of each stream, older entries are trimmed
+
+        Returns:
+            List of entry ids
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='xadd'):
+                pipe = self.client.pipeline(transaction=False)
+                for stream, entries in entries_by_stream.items():
+                    for fields in entries:
+                        pipe.xadd(stream, fields, maxlen=maxlen, approximate=True)
+
+                return pipe.execute()
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='xadd')
+            raise Exception(f"Failed to add stream entries in Redis: {e}")
+
+    def xrange(self, stream: str, start: str = '-', end: str = '+', count: Optional[int] = None) -> list:
+        """
+        Get stream entries with ids between start and end
+
+        Args:
+            stream: Redis key of the stream
+            start: Min entry id, or a millisecond timestamp
+            end: Max entry id
+            count: Max number of entries
+
+        Returns:
+            List of (entry id, field -> value dict)
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='xrange'):
+                return self.client.xrange(stream, start, end, count)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='xrange')
+            raise Exception(f"Failed to read stream from Redis: {e}")
+
+    def xgroup_create(self, stream: str, group: str) -> bool:
+        """
+        Create a consumer group of the stream reading new entries, creating the stream if needed
+
+        Args:
+            stream: Redis key of the stream
+            group: Consumer group name
+
+        Returns:
+            True if created, False if the group already exists
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='xgroup_create'):
+                return bool(self.client.xgroup_create(stream, group, id='$', mkstream=True))
+        except redis.ResponseError as e:
+            if str(e).startswith('BUSYGROUP'):
+                return False
+            metrics.inc('redis_errors_total', command='xgroup_create')
+            raise Exception(f"Failed to create stream consumer group in Redis: {e}")
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='xgroup_create')
+            raise Exception(f"Failed to create stream consumer group in Redis: {e}")
+
+    def xreadgroup(self, group: str, consumer: str, stream: str, count: int, block_ms: int) -> list:
+        """
+        Read stream entries not yet delivered to the consumer group, waiting up to block_ms for new ones
+
+        Args:
+            group: Consumer group name
+            consumer: Consumer name within the group
+            stream: Redis key of the stream
+            count: Max number of entries
+            block_ms: Max wait for entries in milliseconds
+
+        Returns:
+            List of (entry id, field -> value dict)
+        """
+        try:
+            with metrics.timer('redis_command_seconds', command='xreadgroup'):
+                result = self.client.xreadgroup(group, consumer, {stream: '>'}, count=count, block=block_ms)
+                return result[0][1] if result else []
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='xreadgroup')
+            raise Exception(f"Failed to read stream from Redis: {e}")
+
+    def xack(self, stream: str, group: str, ids: list) -> int:
+        """
+        Acknowledge entries processed by the consumer group
+
+        Args:
+            stream: Redis key of the stream
+            group: Consumer group name
+            ids: Entry ids
+
+        Returns:
+            Number of entries acknowledged
+        """
+        if not ids:
+            return 0
+
+        try:
+            with metrics.timer('redis_command_seconds', command='xack'):
+                return self.client.xack(stream, group, *ids)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='xack')
+            raise Exception(f"Failed to acknowledge stream entries in Redis: {e}")
+
     def get_dict(self, key: str) -> Optional[dict]:
         """
         Get dictionary value from Redis by key
@@ -118,20 +734,20 @@ class Redis:
             key: Redis key
             
         Returns:
-            Dictionary or None if key doesn't exist or value is not valid JSON
+            Dictionary or None if key doesn't exist or value can't be decoded
         """
-        value = self.get(key)
+        value = self.get_bytes(key)
         if value is None:
             return None
         
         try:
-            return json.loads(value)
-        except json.JSONDecodeError:
+            return self.serializer.decode(value)
+        except (ValueError, zlib.error):
             return None
     
     def set_dict(self, key: str, value: dict, expire: Optional[int] = None) -> bool:
         """
-        Set dictionary value in Redis by key
+        Set dictionary value in Redis by key, encoded with the serializer
         
         Args:
             key: Redis key
@@ -141,9 +757,21 @@ class Redis:
         Returns:
             True if successful
         """
-        return self.set(key, value, expire)
+        try:
+            value = self.serializer.encode(value)
+
+            with metrics.timer('redis_command_seconds', command='set'):
+                if expire:
+                    return self.binary_client.setex(key, expire, value)
+                else:
+                    return self.binary_client.set(key, value)
+        except redis.RedisError as e:
+            metrics.inc('redis_errors_total', command='set')
+            raise Exception(f"Failed to set value in Redis: {e}")
     
     def close(self):
         """Close Redis connection"""
         if self.client:
             self.client.close()
+        if self.binary_client:
+            self.binary_client.close()
@@ -0,0 +1,103 @@
+"""
+Value serializers for Redis: versioned binary encoding with compression of large values, reading legacy JSON.
+Both serializers read both formats, so the written one can be switched either way without migrating data.
+"""
+import json
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Never the first byte of JSON text
+MAGIC = 0xA7
+VERSION = 1
+HEADER = struct.Struct('>BBBB')
+
+CODEC_JSON = 1
+CODEC_MSGPACK = 2
+FLAG_ZLIB = 1
+
+
+def decode(data: bytes):
+    """Decode a binary enveloped value, or legacy JSON text"""
+    if not data or data[0] != MAGIC:
+        return json.loads(data)
+
+    _, version, codec, flags = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise Exception(f'Unsupported serialized value version: {version}')
+
+    payload = data[HEADER.size:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+
+    if codec == CODEC_MSGPACK:
+        if msgpack is None:
+            raise Exception('msgpack package is required to read this value')
+        return msgpack.unpackb(payload, raw=False)
+    elif codec == CODEC_JSON:
+        return json.loads(payload)
+    else:
+        raise Exception(f'Unsupported serialized value codec: {codec}')
+
+
+class JsonSerializer:
+    """Legacy format: JSON text"""
+    name = 'json'
+
+    def encode(self, value) -> bytes:
+        return json.dumps(value).encode('utf-8')
+
+    def decode(self, data: bytes):
+        return decode(data)
+
+
+class BinarySerializer:
+    """
+    Binary envelope: magic byte, format version, codec and flags, then the payload.
+    The payload is MessagePack when the msgpack package is installed, compact JSON otherwise; values larger than
+    compress_threshold bytes are zlib-compressed if that makes them smaller. The codec and compression of every
+    value are read from its header, so values written with another codec or threshold stay readable.
+    """
+    name = 'binary'
+    compress_threshold = 1024
+    compress_level = 1
+    codec = None
+
+    def __init__(self, compress_threshold: int = 1024, compress_level: int = 1):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.codec = CODEC_MSGPACK if msgpack is not None else CODEC_JSON
+
+    def encode(self, value) -> bytes:
+        if self.codec == CODEC_MSGPACK:
+            payload = msgpack.packb(value, use_bin_type=True)
+        else:
+            payload = json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+        flags = 0
+        if len(payload) > self.compress_threshold:
+            compressed = zlib.compress(payload, self.compress_level)
+            if len(compressed) < len(payload):
+                payload = compressed
+                flags |= FLAG_ZLIB
+
+        return HEADER.pack(MAGIC, VERSION, self.codec, flags) + payload
+
+    def decode(self, data: bytes):
+        return decode(data)
+
+
+def get_serializer(name: str = 'binary', compress_threshold: int = 1024):
+    """Returns serializer by name: binary or json"""
+    match name:
+        case 'binary':
+            return BinarySerializer(compress_threshold=compress_threshold)
+        case 'json':
+            return JsonSerializer()
+        case _:
+            raise Exception(f'Unknown serializer: {name}')
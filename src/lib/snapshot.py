@@ -0,0 +1,210 @@
+"""
+Compact username index for large whitelist snapshots, built in a process pool
+"""
+import gzip
+import hashlib
+import multiprocessing
+import os
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from urllib.request import Request, urlopen
+
+
+def normalize_line(raw_line: bytes):
+    """Returns normalized username of a raw whitelist line, or None for blank lines and comments"""
+    try:
+        line = raw_line.decode('utf-8')
+    except UnicodeDecodeError:
+        line = raw_line.decode('latin-1')
+
+    line = line.strip()
+    if line == '' or line.startswith('#'):
+        return None
+
+    return line.lower().removeprefix('@')
+
+
+@contextmanager
+def open_url(url):
+    """Open url as a binary stream, transparently decompressing gzip content"""
+    request = Request(url, headers={'Accept-Encoding': 'gzip'})
+
+    with urlopen(request) as response:
+        if response.headers.get('Content-Encoding', '').lower() == 'gzip' or url.split('?')[0].endswith('.gz'):
+            with gzip.GzipFile(fileobj=response) as stream:
+                yield stream
+        else:
+            yield response
+
+
+def build_index(raw: bytes):
+    """Index raw whitelist file content, see build_index_lines"""
+    return build_index_lines(raw.splitlines())
+
+
+def build_index_lines(raw_lines):
+    """
+    Parse raw whitelist lines into a sorted, deduplicated, newline-separated UTF-8 buffer plus
+    an array of entry offsets. Runs in worker processes: the result pickles as two flat byte strings.
+    """
+    usernames = set()
+    for raw_line in raw_lines:
+        username = normalize_line(raw_line)
+        if username is not None:
+            usernames.add(username.encode('utf-8'))
+
+    data = b'\n'.join(sorted(usernames))
+    if usernames:
+        data += b'\n'
+
+    offsets = array('I' if len(data) < 2 ** 32 else 'Q', [0])
+    position = 0
+    for line in data.splitlines(keepends=True):
+        position += len(line)
+        offsets.append(position)
+
+    return data, offsets.typecode, offsets.tobytes()
+
+
+class SortedIndex:
+    """
+    Read-only set of usernames over a sorted byte buffer, looked up by binary search. It takes a fraction of
+    the memory of a set of str, but a lookup slices and compares about log2(n) entries: ~10 µs at a million
+    entries against ~0.1 µs for a set. So it is only built for files above snapshot_pool_threshold.
+    """
+    data = b''
+    offsets = None
+
+    def __init__(self, data: bytes, typecode: str, offsets: bytes):
+        self.data = data
+        self.offsets = array(typecode)
+        self.offsets.frombytes(offsets)
+
+    def _item(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1] - 1]
+
+    def __contains__(self, username):
+        target = username.encode('utf-8')
+        data, offsets = self.data, self.offsets
+
+        # Inline bisect: about twice as fast as bisect_left with a key function
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if data[offsets[middle]:offsets[middle + 1] - 1] < target:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low < len(self) and self._item(low) == target
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._item(i).decode('utf-8')
+
+    def nbytes(self):
+        return len(self.data) + len(self.offsets) * self.offsets.itemsize
+
+
+process_pool = None
+process_pool_lock = threading.Lock()
+
+
+def get_process_pool(max_workers: int | None = None):
+    """Returns shared process pool for snapshot builds, created on first use"""
+    global process_pool
+
+    if process_pool is None:
+        # Called from executor threads: only one of them may create the pool
+        with process_pool_lock:
+            if process_pool is None:
+                # Spawned workers do not inherit the parent's threads and locks
+                process_pool = ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(),
+                                                   mp_context=multiprocessing.get_context('spawn'))
+
+    return process_pool
+
+
+def build_url_index(url):
+    """
+    Download url and index it line by line, returns the index parts and a SHA-1 digest of the content.
+    Runs in worker processes, so neither the worker nor the parent ever holds the whole file.
+    """
+    digest = hashlib.sha1()
+
+    def hashed_lines(stream):
+        for raw_line in stream:
+            digest.update(raw_line)
+            yield raw_line
+
+    with open_url(url) as stream:
+        data, typecode, offsets = build_index_lines(hashed_lines(stream))
+
+    return data, typecode, offsets, digest.hexdigest()
+
+
+def build_sorted_index(url: str, max_workers: int | None = None):
+    """
+    Build index of the file at url in the process pool, blocking the calling thread until it is done.
+    Returns the index and a digest of the file content.
+    """
+    data, typecode, offsets, digest = get_process_pool(max_workers).submit(build_url_index, url).result()
+
+    return SortedIndex(data, typecode, offsets), digest
+
+
+def diff_snapshots(old, new):
+    """
+    Returns (added, removed, changed) between two snapshots of a source in O(n). Snapshots are sets or sorted
+    indexes of usernames, or dicts of username -> condition value; changed maps usernames present in both
+    dicts to (old value, new value).
+    """
+    if isinstance(old, SortedIndex) and isinstance(new, SortedIndex):
+        return diff_sorted(old, new) + ({},)
+
+    if isinstance(old, SortedIndex):
+        old = set(old)
+    if isinstance(new, SortedIndex):
+        new = set(new)
+
+    added = [username for username in new if username not in old]
+    removed = [username for username in old if username not in new]
+    changed = {}
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        for username, value in new.items():
+            if username in old and old[username] != value:
+                changed[username] = (old[username], value)
+
+    return added, removed, changed
+
+
+def diff_sorted(old: SortedIndex, new: SortedIndex):
+    """Returns (added, removed) of two sorted indexes with one merge pass"""
+    added = []
+    removed = []
+    i = j = 0
+
+    while i < len(old) and j < len(new):
+        old_item = old._item(i)
+        new_item = new._item(j)
+
+        if old_item == new_item:
+            i += 1
+            j += 1
+        elif old_item < new_item:
+            removed.append(old_item.decode('utf-8'))
+            i += 1
+        else:
+            added.append(new_item.decode('utf-8'))
+            j += 1
+
+    removed.extend(old._item(k).decode('utf-8') for k in range(i, len(old)))
+    added.extend(new._item(k).decode('utf-8') for k in range(j, len(new)))
+
+    return added, removed
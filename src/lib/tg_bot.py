@@ -1,8 +1,20 @@
 from lib.tg_bot_base import TgBotBase
-from lib.whitelist import Whitelist
+from lib.whitelist import Whitelist, LookupTimeoutError
 from lib.options import Options
 from lib.redis import Redis
+from lib.serializer import get_serializer
+from lib.metrics import metrics
+from lib.profiler import profiler
+from lib.pending import PendingJoins
+from lib.audit import JoinAudit
+from lib.reader_file import ReaderFile
+from lib.reader_redis import ReaderRedis
+import asyncio
+import html
 import logging
+import os
+import socket
+import time
 from typing import Optional
 
 from telegram import Chat, ChatMember, ChatMemberUpdated, Update
@@ -12,6 +24,11 @@ from telegram.ext import ContextTypes, ChatJoinRequestHandler
 
 
 class TgBot(TgBotBase):
+    # Usernames per /test_users call, and the most listed in its reply message instead of a file
+    MAX_TEST_USERS = 10000
+    MAX_LISTED_USERS = 50
+    # Slowest stages per handler listed by /profile
+    MAX_PROFILE_STAGES = 10
 
     commands = {
         'get_whitelist':    {'args': [], 'description': 'Returns the whitelist location for current chat', 'admin': True},
@@ -19,7 +36,13 @@ class TgBot(TgBotBase):
         'set_whitelist':    {'args': ['reader type', 'location=default', 'column=1', 'sheet=0'], 'description': 'Sets the whitelist parameters for current chat', 'admin': True},
         'set_whitelist_condition': {'args': ['condition'],
                           'description': 'Sets the whitelist parameters for current chat (where appropriate)', 'admin': True},
+        'add_whitelist_source': {'args': ['reader type', 'location=default'],
+                          'description': 'Adds a source to the composite whitelist of current chat', 'admin': True},
+        'load_whitelist':   {'args': ['url=replied file'], 'description': 'Load redis whitelist from file URL or a replied text file', 'admin': True},
         'test_user':        {'args': ['username'], 'description': 'Check if user is allowed into chat'},
+        'test_users':       {'args': ['usernames=replied file'], 'description': 'Check many users given as arguments or in a replied text file', 'admin': True},
+        'join_stats':       {'args': ['hours=24'], 'description': 'Join request decisions and latency for current chat', 'admin': True},
+        'profile':          {'args': ['sample rate=show'], 'description': 'Profile a fraction (0 to 1, 0 stops) of join requests and commands, or show the current profile (bot operator only)'},
         'get_option':       {'args': ['option name'], 'description': 'Get option value for current chat', 'admin': True},
         'set_option':       {'args': ['option name', 'option_value'], 'description': 'Set option value for current chat', 'admin': True},
         'list_options':     {'args': [], 'description': 'List all options', 'admin': True},
@@ -33,21 +56,49 @@ class TgBot(TgBotBase):
         # Initialize Redis client with parameters from config
         redis_host = config.get('redis_host', 'localhost')
         redis_port = config.get('redis_port', 6379)
-        redis_client = Redis(host=redis_host, port=redis_port)
-
-        self.whitelist = Whitelist(config, self.logger, redis_client=redis_client)
+        compress_threshold = config.get('redis_compress_threshold')
+        serializer = get_serializer(config.get('redis_serializer') or 'binary',
+                                    compress_threshold=int(compress_threshold) if compress_threshold is not None else 1024)
+        redis_client = Redis(host=redis_host, port=redis_port, serializer=serializer)
+        self.redis = redis_client
 
         self.options = Options({
             'enabled':                      {'type': 'bool', 'description': 'Controls if the bot is active', 'default': True},
             'delete_commands':              {'type': 'bool', 'description': 'Delete command messages', 'default': True},
             'delete_declined_requests':     {'type': 'bool', 'description': 'Delete declined requests'},
+            'whitelist_max_age':            {'type': 'int', 'description': 'Seconds whitelist data may be reused without reading the source again (0: always read)', 'default': 0},
+            'negative_cache_ttl':           {'type': 'int', 'description': 'Seconds a user found not allowed is not checked again (0: always check)', 'default': 0},
+            'lookup_timeout_ms':            {'type': 'int', 'description': 'Max whitelist lookup time of a join request, in milliseconds (0: no limit)', 'default': 0},
         }, redis_client=redis_client)
 
+        self.whitelist = Whitelist(config, self.logger, redis_client=redis_client, options=self.options)
+
+        self.pending = PendingJoins(redis_client, self.whitelist, self.options, self.logger,
+                                    max_age=int(config.get('pending_max_age') or 604800),
+                                    ownership=self.whitelist.ownership, changes=self.whitelist.changes)
+        self.pending_refresher = None
+        self.pending_follower = None
+
+        # Join decision audit log, disabled with zero stream length
+        audit_max_len = config.get('join_audit_maxlen')
+        audit_max_len = 1000 if audit_max_len is None else int(audit_max_len)
+        self.audit = JoinAudit(redis_client, self.logger, max_len=audit_max_len) if audit_max_len > 0 else None
+        self.audit_flusher = None
+
+        # Sampling profiler of join requests and commands, also switched on and off with /profile
+        profiler.path = self.config.get('profile_file') or 'profile.jsonl'
+        profiler.set_sample_rate(float(self.config.get('profile_sample_rate') or 0))
+        self.profile_dumper = None
+
+        self.app.post_init = self.post_init
+        self.app.post_shutdown = self.post_shutdown
+
     async def is_admin(self, update: Update, user_id) -> bool:
         """Checks if a user is an administrator in the current chat."""
         if not update.effective_chat:
             return False  # Not in a chat context, or chat is not available
 
+        metrics.inc('telegram_api_calls_total', method='get_member')
         member = await update.effective_chat.get_member(user_id)
 
         return member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]
@@ -70,6 +121,21 @@ class TgBot(TgBotBase):
             elif location['reader_type'] == 'file':
                 await update.effective_chat.send_message(
                     f"Current whitelist is: {location['params']['location']} ({location['reader_type']})")
+            elif location['reader_type'] == 'redis':
+                reader = self.whitelist.get_reader('redis')
+                await update.effective_chat.send_message(
+                    f"Current whitelist is: {reader.count_users(location)} users ({location['reader_type']})")
+            elif location['reader_type'] == 'composite':
+                sources = []
+                for source in location['params']['sources']:
+                    if 'is_default' in source:
+                        sources.append('default')
+                    else:
+                        sources.append(f"{source['reader_type']} {source['params'].get('location', '')}".strip())
+
+                await update.effective_chat.send_message(
+                    f"Current whitelist is: {location['params'].get('mode', 'union')} of {len(sources)} sources ({location['reader_type']})\n"
+                    + '\n'.join(f'{i + 1}. {source}' for i, source in enumerate(sources)))
             elif location['reader_type'] == 'api':
                 token_note = 'with token' if 'token' in location['params'] and location['params']['token'] else 'no token'
                 await update.effective_chat.send_message(
@@ -82,6 +148,35 @@ class TgBot(TgBotBase):
         self.whitelist.set_whitelist_params(chat_id, context.args)
 
         await update.effective_chat.send_message('Setting new whitelist')
+        self.pending.schedule_refresh(context.bot, chat_id)
+
+    async def cmd_add_whitelist_source(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Add data source to composite whitelist of this chat"""
+        chat_id = update.effective_message.chat_id
+
+        count = self.whitelist.add_whitelist_source(chat_id, context.args)
+
+        await update.effective_chat.send_message(f'Adding whitelist source #{count}')
+        self.pending.schedule_refresh(context.bot, chat_id)
+
+    async def cmd_load_whitelist(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Load redis whitelist from file URL or replied document"""
+        chat_id = update.effective_message.chat_id
+        reply = update.effective_message.reply_to_message
+
+        if context.args:
+            count = await self.whitelist.load_whitelist_set(chat_id, url=context.args[0])
+        elif reply is not None and reply.document is not None:
+            metrics.inc('telegram_api_calls_total', method='get_file')
+            file = await reply.document.get_file()
+            data = await file.download_as_bytearray()
+
+            count = await self.whitelist.load_whitelist_set(chat_id, data=bytes(data))
+        else:
+            raise Exception('Please provide file URL or reply to a text file with this command')
+
+        await update.effective_chat.send_message(f'Whitelist loaded: {count} users')
+        self.pending.schedule_refresh(context.bot, chat_id)
 
     async def cmd_test_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Test if user with given username is allowed"""
@@ -95,6 +190,117 @@ class TgBot(TgBotBase):
             await update.effective_chat.send_message(f'User {context.args[0]} is not allowed')
 
 
+    async def cmd_test_users(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Test usernames given as arguments or in replied document with one bulk whitelist check"""
+        chat_id = update.effective_message.chat_id
+        reply = update.effective_message.reply_to_message
+
+        if context.args:
+            usernames = [name.strip().lower().removeprefix('@') for arg in context.args for name in arg.split(',')]
+        elif reply is not None and reply.document is not None:
+            metrics.inc('telegram_api_calls_total', method='get_file')
+            file = await reply.document.get_file()
+            data = await file.download_as_bytearray()
+
+            with ReaderRedis.open_bytes(bytes(data)) as stream:
+                usernames = list(ReaderFile.iter_usernames(stream))
+        else:
+            raise Exception('Please provide usernames or reply to a text file with this command')
+
+        usernames = list(dict.fromkeys(username for username in usernames if username))
+
+        if not usernames:
+            raise Exception('No usernames given')
+        if len(usernames) > self.MAX_TEST_USERS:
+            raise Exception(f'Up to {self.MAX_TEST_USERS} users can be checked at once')
+
+        results = await self.whitelist.check_allowed_users(chat_id, usernames)
+        allowed = [username for username, result in zip(usernames, results) if result]
+        not_allowed = [username for username, result in zip(usernames, results) if not result]
+
+        summary = f'Checked {len(usernames)} users: {len(allowed)} allowed, {len(not_allowed)} not allowed'
+
+        if len(usernames) <= self.MAX_LISTED_USERS:
+            message = summary
+            if allowed:
+                message += '\nAllowed: ' + ', '.join(allowed)
+            if not_allowed:
+                message += '\nNot allowed: ' + ', '.join(not_allowed)
+
+            await update.effective_chat.send_message(message)
+        else:
+            report = ''.join(f'{username}\t{'allowed' if result else 'not allowed'}\n'
+                             for username, result in zip(usernames, results))
+
+            await update.effective_chat.send_document(report.encode('utf-8'), filename='test_users.txt',
+                                                      caption=summary)
+
+    async def cmd_join_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Join request decision counts, approval rate and latency for the last hours"""
+        chat_id = update.effective_message.chat_id
+
+        if self.audit is None:
+            raise Exception('Join audit log is disabled')
+
+        hours = float(context.args[0].removeprefix('hours=')) if context.args else 24
+        stats = await self.audit.stats(chat_id, hours * 3600)
+
+        if not stats['total']:
+            await update.effective_chat.send_message(f'No join requests in the last {hours:g} hours')
+            return
+
+        if stats['truncated']:
+            covered = (time.time() - stats['since']) / 3600
+            message = (f'<b>Join requests in the last {covered:.1f} of {hours:g} hours:</b> {stats['total']} '
+                       f'(older ones are trimmed from the log)\n')
+        else:
+            message = f'<b>Join requests in the last {hours:g} hours:</b> {stats['total']}\n'
+        for outcome, count in sorted(stats['outcomes'].items(), key=lambda item: -item[1]):
+            message += f'{outcome}: {count}\n'
+
+        if stats['approval_rate'] is not None:
+            message += f'<b>Approval rate:</b> {stats['approval_rate'] * 100:.1f}%\n'
+
+        message += '<b>Decision time:</b> ' + ', '.join(f'p{p} {seconds * 1000:.0f} ms'
+                                                       for p, seconds in stats['percentiles'].items())
+
+        await update.effective_chat.send_message(message, parse_mode=ParseMode.HTML)
+
+    async def cmd_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Set the profiler sample rate, or show the stages of profiled invocations since the last dump"""
+        # The profiler is process-wide and its profile covers all chats, so chat admins may not use it
+        operator_id = self.config.get('profile_admin_id')
+        if not operator_id or update.effective_message.from_user.id != int(operator_id):
+            raise Exception('Only the bot operator can use this command')
+
+        if context.args:
+            argument = context.args[0].lower()
+            profiler.set_sample_rate(0.0 if argument == 'off' else float(argument))
+
+            if profiler.sample_rate:
+                await update.effective_chat.send_message(
+                    f'Profiling {profiler.sample_rate * 100:g}% of join requests and commands')
+            else:
+                await update.effective_chat.send_message('Profiling is off')
+            return
+
+        summary = profiler.summary()
+        message = f'<b>Sample rate:</b> {profiler.sample_rate * 100:g}%\n'
+
+        if not summary:
+            await update.effective_chat.send_message(message + 'No profiled invocations since the last dump',
+                                                     parse_mode=ParseMode.HTML)
+            return
+
+        for handler, entry in summary.items():
+            message += (f'\n<b>{handler}</b>: {entry['invocations']} invocations, '
+                        f'p50 {entry['p50'] * 1000:.1f} ms, p95 {entry['p95'] * 1000:.1f} ms\n')
+            for stage, stage_entry in list(entry['stages'].items())[0:self.MAX_PROFILE_STAGES]:
+                message += (f'{html.escape(stage)}: mean {stage_entry['mean'] * 1000:.1f} ms, '
+                            f'p95 {stage_entry['p95'] * 1000:.1f} ms ({stage_entry['share'] * 100:.0f}%)\n')
+
+        await update.effective_chat.send_message(message, parse_mode=ParseMode.HTML)
+
     async def cmd_test_whitelist(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Get 3 masked usernames for this chat"""
         chat_id = update.effective_message.chat_id
@@ -113,6 +319,7 @@ class TgBot(TgBotBase):
         await self.whitelist.set_whitelist_condition(chat_id, ' '.join(context.args))
 
         await update.effective_chat.send_message('Setting whitelist condition')
+        self.pending.schedule_refresh(context.bot, chat_id)
 
 
     async def cmd_get_option(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -180,47 +387,174 @@ class TgBot(TgBotBase):
         return result
 
     async def join_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Process join request"""
+        """Process join request, profiled if sampled"""
+        with profiler.profile('join_request'):
+            await self.handle_join_request(update, context)
+
+    async def handle_join_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         chat_join_request = update.chat_join_request
         user = chat_join_request.from_user
         chat = chat_join_request.chat
 
+        started = time.perf_counter()
+        reader_type = 'none'
+        outcome = 'error'
+
         self.logger.info('New join request from user %s to the group %s', user.username, chat.title)
 
+        with profiler.stage('claim'):
+            claimed = self.claim_join_request(chat_join_request)
+
+        if not claimed:
+            self.logger.info('Join request from user %s to the group %s is already handled', user.username, chat.title)
+            metrics.observe('join_decision_seconds', time.perf_counter() - started, reader=reader_type, outcome='duplicate')
+            return
+
         if not self.options.get_option(chat.id, 'enabled'):
             self.logger.info('Bot is disabled')
 
-        chat_member = await context.bot.get_chat_member(chat_id=chat.id, user_id=user.id)
+        metrics.inc('telegram_api_calls_total', method='get_chat_member')
+        try:
+            with profiler.stage('membership_check'):
+                chat_member = await context.bot.get_chat_member(chat_id=chat.id, user_id=user.id)
+        except Exception:
+            self.release_join_request(chat_join_request)
+            raise
 
         try:
             if chat_member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER,
                                       ChatMemberStatus.RESTRICTED]:
+                metrics.inc('telegram_api_calls_total', method='decline')
                 await chat_join_request.decline()
+                outcome = 'member'
 
                 self.logger.info('User %s in already a sort of member of group %s', user.username, chat.title)
             elif chat_member.status in [ChatMemberStatus.BANNED]:
                 if self.options.get_option(chat.id, 'delete_declined_requests'):
+                    metrics.inc('telegram_api_calls_total', method='decline')
                     await chat_join_request.decline()
+                outcome = 'banned'
 
                 self.logger.info('User %s was banned in group %s', user.username, chat.title)
-            elif await self.whitelist.check_allowed_user(chat.id, user.username):
-                await chat_join_request.approve()
-
-                self.logger.info(f'Join request approved for user %s into the chat %s', user.username, chat.title)
             else:
-                self.logger.info(f'User %s is not allowed into the group %s', user.username, chat.title)
+                location = self.whitelist.get_whitelist_params(chat.id)
+                if location is not None:
+                    reader_type = location['reader_type']
+
+                try:
+                    with profiler.stage('whitelist_check'):
+                        allowed = await self.whitelist.check_allowed_user(chat.id, user.username, location=location)
+                except LookupTimeoutError as e:
+                    self.logger.warning('Whitelist lookup for user %s into the group %s: %s', user.username, chat.title,
+                                        str(e))
+                    allowed = None
+
+                if allowed:
+                    metrics.inc('telegram_api_calls_total', method='approve')
+                    await chat_join_request.approve()
+                    outcome = 'approved'
+
+                    self.logger.info(f'Join request approved for user %s into the chat %s', user.username, chat.title)
+                elif allowed is None:
+                    # Not allowed yet: never declined on a slow lookup, checked again with the pending requests
+                    outcome = 'timeout'
+
+                    if user.username:
+                        self.pending.add(chat.id, user.id, user.username, chat_join_request.date.timestamp())
+                else:
+                    self.logger.info(f'User %s is not allowed into the group %s', user.username, chat.title)
+                    outcome = 'not_allowed'
+
+                    if self.options.get_option(chat.id, 'delete_declined_requests'):
+                        metrics.inc('telegram_api_calls_total', method='decline')
+                        await chat_join_request.decline()
+                        outcome = 'declined'
+                        self.logger.info('Join request declined for chat %s', chat.title)
+                    elif user.username:
+                        # Approved later if the user is added to the whitelist
+                        self.pending.add(chat.id, user.id, user.username, chat_join_request.date.timestamp())
 
-                if self.options.get_option(chat.id, 'delete_declined_requests'):
-                    await chat_join_request.decline()
-                    self.logger.info('Join request declined for chat %s', chat.title)
-                    
         except Exception as e:
             self.logger.error(f'Error processing join request for chat %s: %s (%s)', chat.title, str(e), type(e))
+            self.release_join_request(chat_join_request)
+        else:
+            self.finish_join_request(chat_join_request)
+
+        elapsed = time.perf_counter() - started
+        metrics.observe('join_decision_seconds', elapsed, reader=reader_type, outcome=outcome)
+
+        if self.audit:
+            self.audit.record(chat.id, user.id, user.username, outcome, reader_type, elapsed)
+
+    def _join_claim_key(self, chat_join_request):
+        """Redis key of a join request: redelivered updates share it, a new request by the same user does not"""
+        return f'join_claim:{chat_join_request.chat.id}:{chat_join_request.from_user.id}:{int(chat_join_request.date.timestamp())}'
+
+    def claim_join_request(self, chat_join_request) -> bool:
+        """
+        Returns True if this process should handle the join request, False if it is a duplicate: already done,
+        or being processed by a replica that claimed it less than join_claim_processing_ttl seconds ago.
+        The short processing claim lets a redelivered request through if its replica died mid-way.
+        """
+        try:
+            return self.redis.set_nx(self._join_claim_key(chat_join_request),
+                                     f'processing:{socket.gethostname()}:{os.getpid()}',
+                                     int(self.config.get('join_claim_processing_ttl') or 30))
+        except Exception as e:
+            # Handling a request twice is better than not handling it
+            self.logger.warning('Could not claim join request: %s', str(e))
+            return True
+
+    def finish_join_request(self, chat_join_request):
+        """Mark the claimed request as done, so redeliveries are dropped for join_claim_ttl seconds"""
+        try:
+            self.redis.set(self._join_claim_key(chat_join_request), f'done:{socket.gethostname()}:{os.getpid()}',
+                           int(self.config.get('join_claim_ttl') or 3600))
+        except Exception as e:
+            self.logger.warning('Could not mark join request as done: %s', str(e))
+
+    def release_join_request(self, chat_join_request):
+        """Drop the claim so a redelivered request is handled again"""
+        try:
+            self.redis.delete(self._join_claim_key(chat_join_request))
+        except Exception as e:
+            self.logger.warning('Could not release join request claim: %s', str(e))
 
     # help_message, join_request, cmd_* methods remain here in subclass
 
-    def run(self):
+    def register_handlers(self):
         # Register chat join request handler in subclass
         self.app.add_handler(ChatJoinRequestHandler(self.join_request))
-        # Then delegate to base to register commands, tracking, and start polling
+        # Then delegate to base to register commands and tracking
+        super().register_handlers()
+
+    async def post_init(self, application):
+        """Start background tasks once the application is initialized"""
+        interval = float(self.config.get('pending_refresh_interval') or 0)
+
+        if interval > 0:
+            self.pending_refresher = asyncio.create_task(self.pending.run_periodic(application.bot, interval))
+
+        if self.whitelist.changes:
+            self.pending_follower = asyncio.create_task(self.pending.follow_changes(application.bot))
+
+        if self.audit:
+            self.audit_flusher = asyncio.create_task(
+                self.audit.run_periodic(float(self.config.get('join_audit_flush_interval') or 1)))
+
+        self.profile_dumper = asyncio.create_task(
+            profiler.run_periodic(float(self.config.get('profile_dump_interval') or 60)))
+
+    async def post_shutdown(self, application):
+        """Write join audit records and profiles still buffered"""
+        if self.audit:
+            await self.audit.flush()
+
+        await profiler.dump()
+
+    def run(self):
+        if self.config.get('metrics_port'):
+            metrics.start_server(int(self.config['metrics_port']))
+            self.logger.info('Serving metrics on port %s', self.config['metrics_port'])
+
         return super().run()
\ No newline at end of file
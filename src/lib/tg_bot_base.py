@@ -2,6 +2,10 @@ import logging
 from typing import Optional
 
 from telegram import Chat, ChatMember, ChatMemberUpdated, Update
+from lib.metrics import metrics
+from lib.profiler import profiler
+from lib.rate_limiter import request_priority, PRIORITY_COMMAND
+from lib.outbound import OutboundScheduler, ScheduledRequest
 from telegram.ext import (
     Application,
     ChatJoinRequestHandler,
@@ -18,6 +22,7 @@ class TgBotBase:
     commands = {}
     config = None
     options = None
+    outbound = None
 
     def __init__(self, token, config, commands):
         logging.basicConfig(
@@ -30,12 +35,24 @@ class TgBotBase:
         self.token = token
         self.config = config
         self.commands = commands
-        self.app = Application.builder().token(token).build()
+        # All calls except getUpdates go through the outbound scheduler. Updates are handled concurrently,
+        # so a reply waiting for its chat's rate limit does not hold up join requests queued behind it
+        self.outbound = OutboundScheduler(rate_per_second=float(config.get('telegram_rate') or 30),
+                                          chat_rate_per_minute=float(config.get('telegram_chat_rate') or 20),
+                                          cache_size=int(config.get('cache_size') or 1000))
+        builder = Application.builder().token(token).request(ScheduledRequest(self.outbound)).concurrent_updates(True)
+
+        # Custom Bot API server, e.g. a local one or a fake one for load testing
+        if config.get('telegram_base_url'):
+            builder = builder.base_url(config['telegram_base_url']).base_file_url(config['telegram_base_url'])
+
+        self.app = builder.build()
 
     async def is_admin(self, update: Update, user_id) -> bool:
         if not update.effective_chat:
             return False
 
+        metrics.inc('telegram_api_calls_total', method='get_member')
         member = await update.effective_chat.get_member(user_id)
         from telegram.constants import ChatMemberStatus
 
@@ -94,6 +111,16 @@ class TgBotBase:
             context.bot_data.setdefault("channel_ids", set()).discard(chat.id)
 
     async def common_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # Commands yield upstream quota and Bot API rate to join requests
+        priority_token = request_priority.set(PRIORITY_COMMAND)
+
+        try:
+            with profiler.profile('common_handler'):
+                await self.handle_command(update, context)
+        finally:
+            request_priority.reset(priority_token)
+
+    async def handle_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user = update.effective_message.from_user
         message_text = update.effective_message.text
         chat_id = update.effective_chat.id
@@ -107,7 +134,10 @@ class TgBotBase:
             return
 
         if 'admin' in self.commands[command_name] and self.commands[command_name]['admin'] is True:
-            if not await self.is_admin(update, user.id):
+            with profiler.stage('admin_check'):
+                is_admin = await self.is_admin(update, user.id)
+
+            if not is_admin:
                 await update.effective_chat.send_message('Only admins can call this command')
                 return
 
@@ -131,21 +161,24 @@ class TgBotBase:
             await update.effective_chat.send_message(f'No handler for command {command_name}')
 
         try:
-            await handler(update, context)
+            with profiler.stage(f'command:{command_name}'):
+                await handler(update, context)
         except Exception as e:
             await update.effective_chat.send_message(str(e))
             self.logger.info('Command handler error: %s', str(e), exc_info=True)
 
         if self.options and self.options.get_option(chat_id, 'delete_commands'):
-            await context.bot.delete_message(chat_id, message_id)
+            self.outbound.defer_delete(context.bot, chat_id, message_id)
         return
 
-    def run(self):
+    def register_handlers(self):
         for command in self.commands:
             self.app.add_handler(CommandHandler(command, self.common_handler))
 
         self.app.add_handler(ChatMemberHandler(self.track_chats, ChatMemberHandler.MY_CHAT_MEMBER))
 
+    def run(self):
+        self.register_handlers()
 
         self.app.run_polling(allowed_updates=Update.ALL_TYPES)
 
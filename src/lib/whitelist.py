@@ -1,7 +1,20 @@
+import asyncio
+from lib.metrics import metrics
+from lib.profiler import profiler
+from lib.lru_cache import LruCache
 from lib.reader_gspread import ReaderGspread
 from lib.reader_file import ReaderFile
 from lib.reader_api import ReaderApi
+from lib.reader_redis import ReaderRedis
+from lib.reader_composite import ReaderComposite
 from lib.redis import Redis
+from lib.changes import SnapshotChanges
+from lib.ownership import RefreshOwnership
+
+
+class LookupTimeoutError(Exception):
+    """Whitelist lookup exceeded the chat lookup_timeout_ms option"""
+
 
 class Whitelist:
     DEFAULT_SOURCE_PARAM = 'default_source'
@@ -9,7 +22,14 @@ class Whitelist:
     READER_GSPREAD = 'gspread'
     READER_FILE = 'file'
     READER_API = 'api'
-    SUPPORTED_READERS = [DEFAULT_READER, READER_GSPREAD, READER_FILE, READER_API]
+    READER_REDIS = 'redis'
+    READER_COMPOSITE = 'composite'
+    SUPPORTED_READERS = [DEFAULT_READER, READER_GSPREAD, READER_FILE, READER_API, READER_REDIS, READER_COMPOSITE]
+
+    # Concurrent single-user checks for readers without bulk checks
+    BULK_CHECK_CONCURRENCY = 8
+    # Per-chat options passed to readers as location['policy'], zero meaning the default behaviour
+    POLICY_OPTIONS = ['whitelist_max_age', 'negative_cache_ttl', 'lookup_timeout_ms']
 
     default_reader = None
     default_reader_params = None
@@ -20,12 +40,39 @@ class Whitelist:
     chats = {}
     redis = None
     redis_key_prefix = 'whitelist'
+    changes = None
+    ownership = None
+    options = None
+    negative_results = None
 
-    def __init__(self, config, logger, redis_client: Redis | None = None, redis_key_prefix: str = 'whitelist'):
+    def __init__(self, config, logger, redis_client: Redis | None = None, redis_key_prefix: str = 'whitelist',
+                 options=None):
         self.logger = logger
         self.config = config
+        self.readers = {}
         self.redis = redis_client if redis_client else Redis()
         self.redis_key_prefix = redis_key_prefix
+        self.options = options
+
+        # Users found not allowed by (chat id, username) -> chat whitelist generation. Entries expire by the
+        # chat's negative_cache_ttl, checked on read, so the cache itself has no TTL
+        self.negative_results = LruCache('negative_results', max_size=int(config.get('cache_size') or 1000))
+
+        # Source change events, disabled with zero stream length
+        changes_max_len = config.get('changes_stream_maxlen')
+        changes_max_len = 10000 if changes_max_len is None else int(changes_max_len)
+        if changes_max_len > 0:
+            self.changes = SnapshotChanges(self.redis, max_len=changes_max_len,
+                                           cache_size=int(config.get('cache_size') or 1000),
+                                           cache_ttl=float(config.get('cache_ttl') or 3600))
+
+        # Source refreshes shared between bot replicas, disabled with zero lease period
+        lease_ttl = config.get('refresh_lease_ttl')
+        lease_ttl = 30 if lease_ttl is None else float(lease_ttl)
+        if lease_ttl > 0:
+            self.ownership = RefreshOwnership(self.redis, ttl=lease_ttl,
+                                              snapshot_ttl=float(config.get('cache_ttl') or 3600),
+                                              cache_size=int(config.get('cache_size') or 1000))
 
         if self.DEFAULT_SOURCE_PARAM in config and config[self.DEFAULT_SOURCE_PARAM]:
             args = config[self.DEFAULT_SOURCE_PARAM].split(';')
@@ -46,11 +93,15 @@ class Whitelist:
         if reader_type not in self.readers:
             match reader_type:
                 case self.READER_GSPREAD:
-                    self.readers[reader_type] = ReaderGspread(self.config)
+                    self.readers[reader_type] = ReaderGspread(self.config, changes=self.changes, ownership=self.ownership)
                 case self.READER_FILE:
-                    self.readers[reader_type] = ReaderFile(self.config)
+                    self.readers[reader_type] = ReaderFile(self.config, changes=self.changes)
                 case self.READER_API:
                     self.readers[reader_type] = ReaderApi(self.config)
+                case self.READER_REDIS:
+                    self.readers[reader_type] = ReaderRedis(self.config, self.redis, changes=self.changes)
+                case self.READER_COMPOSITE:
+                    self.readers[reader_type] = ReaderComposite(self.config, self.get_reader)
 
         return self.readers[reader_type]
 
@@ -58,27 +109,48 @@ class Whitelist:
         """Generate Redis key for chat whitelist location"""
         return f"{self.redis_key_prefix}:{chat_id}"
 
+    def _redis_generation_key(self, chat_id):
+        """Generate Redis key for chat whitelist generation, incremented on every whitelist change"""
+        return f"{self.redis_key_prefix}:{chat_id}:generation"
+
+    def _redis_set_key(self, chat_id):
+        """Generate Redis key for chat whitelist set (redis reader)"""
+        return f"{self.redis_key_prefix}:{chat_id}:users"
+
     def get_whitelist_params(self, chat_id):
         """Returns whitelist location for the given chat id"""
         key = self._redis_key(chat_id)
-        location_data = self.redis.get_dict(key)
+
+        with profiler.stage('config_load'):
+            location_data = self.redis.get_dict(key)
 
         if location_data is None:
             return None
 
+        return self.resolve_location(location_data)
+
+    def resolve_location(self, location_data):
+        """Returns location with the default source (also in composite sources) replaced by its parameters"""
         if location_data['reader_type'] == self.DEFAULT_READER:
             location = {
                         'reader_type': self.default_reader,
                         'params': self.default_reader_params,
                         'is_default': True
                         }
+        elif location_data['reader_type'] == self.READER_COMPOSITE:
+            location = {
+                        'reader_type': self.READER_COMPOSITE,
+                        'params': location_data['params'] | {
+                            'sources': [self.resolve_location(source) for source in location_data['params'].get('sources', [])]
+                        }
+                        }
         else:
             location = location_data
 
         return location
 
-    def set_whitelist_params(self, chat_id, args):
-        """Sets whitelist location for the given chat id"""
+    def parse_location(self, chat_id, args):
+        """Returns location data to store for the given /set_whitelist arguments"""
         if len(args) < 1:
             raise Exception('Please provide whitelist type')
 
@@ -93,16 +165,55 @@ class Whitelist:
             reader = self.get_reader(reader_type)
             params = reader.parse_params(args)
 
+            # Chats may only use their own set
+            if reader_type == self.READER_REDIS:
+                params['key'] = self._redis_set_key(chat_id)
+
         if reader_type not in self.SUPPORTED_READERS:
             raise Exception(f'Invalid reader type ({reader_type}). Supported readers: {', '.join(self.SUPPORTED_READERS)}')
 
-        key = self._redis_key(chat_id)
         location_data = {'reader_type': reader_type}
 
         if reader_type != self.DEFAULT_READER:
             location_data['params'] = params
 
+        return location_data
+
+    def set_whitelist_params(self, chat_id, args):
+        """Sets whitelist location for the given chat id"""
+        location_data = self.parse_location(chat_id, args)
+        key = self._redis_key(chat_id)
+
+        if location_data['reader_type'] == self.READER_COMPOSITE:
+            # Changing composite mode keeps its sources
+            current = self.redis.get_dict(key)
+
+            if current is not None and current['reader_type'] == self.READER_COMPOSITE:
+                location_data['params']['sources'] = current['params'].get('sources', [])
+            else:
+                location_data['params']['sources'] = []
+
+        self.redis.set_dict(key, location_data)
+        self.invalidate(chat_id)
+
+    def add_whitelist_source(self, chat_id, args):
+        """Adds a source to the composite whitelist of the given chat, returns the number of sources"""
+        key = self._redis_key(chat_id)
+        location_data = self.redis.get_dict(key)
+
+        if location_data is None or location_data['reader_type'] != self.READER_COMPOSITE:
+            raise Exception(f'Whitelist type should be {self.READER_COMPOSITE}, use /set_whitelist {self.READER_COMPOSITE} first')
+
+        source = self.parse_location(chat_id, args)
+
+        if source['reader_type'] == self.READER_COMPOSITE:
+            raise Exception('Composite whitelists can not be nested')
+
+        location_data['params'].setdefault('sources', []).append(source)
         self.redis.set_dict(key, location_data)
+        self.invalidate(chat_id)
+
+        return len(location_data['params']['sources'])
 
     async def set_whitelist_condition(self, chat_id, condition):
         key = self._redis_key(chat_id)
@@ -118,6 +229,39 @@ class Whitelist:
             location_data['params']['condition'] = params['condition']
 
         self.redis.set_dict(key, location_data)
+        self.invalidate(chat_id)
+
+    async def load_whitelist_set(self, chat_id, url: str | None = None, data: bytes | None = None):
+        """Replace redis whitelist of the given chat with usernames from file URL or uploaded file content"""
+        location = self.get_whitelist_params(chat_id)
+
+        if location is not None and 'is_default' in location:
+            raise Exception('Default whitelist can not be loaded from a chat')
+
+        if location is not None and location['reader_type'] == self.READER_COMPOSITE:
+            sources = location['params']['sources']
+        else:
+            sources = [location] if location is not None else []
+
+        if not any(source['reader_type'] == self.READER_REDIS and 'is_default' not in source for source in sources):
+            raise Exception(f'Whitelist type should be {self.READER_REDIS}, use /set_whitelist {self.READER_REDIS} first')
+
+        location = {'reader_type': self.READER_REDIS, 'params': {'key': self._redis_set_key(chat_id)}}
+        reader = self.get_reader(self.READER_REDIS)
+
+        if url is not None:
+            file_reader = self.get_reader(self.READER_FILE)
+            open_stream = lambda: file_reader.open_stream({'params': {'location': url}})
+        elif data is not None:
+            open_stream = lambda: reader.open_bytes(data)
+        else:
+            raise Exception('Please provide file URL or file content')
+
+        count = await reader.load(location, open_stream)
+        self.invalidate(chat_id)
+        self.logger.info('Loaded %s usernames into whitelist set of chat %s', count, chat_id)
+
+        return count
 
     async def test(self, chat_id):
         """Get the result of whitelist test: 3 entries or check if user bob can access api"""
@@ -138,7 +282,7 @@ class Whitelist:
 
             return entries
         # If class only checks single user
-        elif isinstance(reader, ReaderApi):
+        elif isinstance(reader, (ReaderApi, ReaderComposite)):
             username = 'bob'
 
             try:
@@ -153,9 +297,10 @@ class Whitelist:
         else:
             return ['n/a']
 
-    async def check_allowed_user(self, chat_id, username):
+    async def check_allowed_user(self, chat_id, username, location=None):
         """Checks if user is allowed to join to the given group"""
-        location = self.get_whitelist_params(chat_id)
+        if location is None:
+            location = self.get_whitelist_params(chat_id)
 
         if location is None:
             raise Exception('No whitelist for this chat')
@@ -165,7 +310,104 @@ class Whitelist:
         if not reader:
             raise Exception('Unsupported reader type')
 
-        return await reader.check_allowed_user(location, username)
+        policy = self.get_policy(chat_id)
+        location = dict(location, policy=policy)
+
+        generation = self.get_generation(chat_id) if policy.get('negative_cache_ttl') else None
+        if generation is not None and self.is_cached_negative(chat_id, username, generation, policy):
+            return False
+
+        with profiler.stage(f'reader_check:{location['reader_type']}'):
+            allowed = await self.with_timeout(reader.check_allowed_user(location, username), location)
+
+        if generation is not None and not allowed:
+            self.negative_results.set((chat_id, username.lower().removeprefix('@')), generation)
+
+        return allowed
+
+    async def with_timeout(self, lookup, location):
+        """Await the lookup within the chat lookup_timeout_ms option, raises LookupTimeoutError"""
+        timeout = location['policy'].get('lookup_timeout_ms')
+
+        try:
+            return await asyncio.wait_for(lookup, timeout / 1000 if timeout else None)
+        except asyncio.TimeoutError:
+            metrics.inc('lookup_timeouts_total', reader=location['reader_type'])
+            raise LookupTimeoutError(f'Whitelist lookup timed out after {timeout} ms')
+
+    def get_generation(self, chat_id):
+        """Chat whitelist generation shared by all bot replicas"""
+        return int(self.redis.get(self._redis_generation_key(chat_id)) or 0)
+
+    def is_cached_negative(self, chat_id, username, generation, policy) -> bool:
+        """True if the user was found not allowed by this whitelist generation within negative_cache_ttl"""
+        negative_key = (chat_id, username.lower().removeprefix('@'))
+
+        if self.negative_results.get(negative_key) == generation:
+            if self.negative_results.age(negative_key) <= policy['negative_cache_ttl']:
+                metrics.inc('negative_cache_hits_total')
+                return True
+
+        return False
+
+    def get_policy(self, chat_id):
+        """Per-chat freshness and latency options"""
+        if self.options is None:
+            return {}
+
+        return {name: max(0, value) for name, value in self.options.get_options(chat_id, self.POLICY_OPTIONS).items()}
+
+    def invalidate(self, chat_id):
+        """Forget cached negative results of the chat on all bot replicas after its whitelist changed"""
+        self.redis.incr(self._redis_generation_key(chat_id))
+
+    async def check_allowed_users(self, chat_id, usernames, location=None, fresh=False):
+        """
+        Checks several users at once, returns a list of results in the order of usernames.
+        Cached negative results and the lookup timeout apply as for single checks; with fresh=True every user
+        is looked up. Readers with bulk checks read their source once, within one lookup timeout; for others
+        users are checked concurrently, and a failed or timed out check counts as not allowed.
+        """
+        if location is None:
+            location = self.get_whitelist_params(chat_id)
+
+        if location is None:
+            raise Exception('No whitelist for this chat')
+
+        reader = self.get_reader(location['reader_type'])
+        policy = self.get_policy(chat_id)
+        location = dict(location, policy=policy)
+
+        generation = self.get_generation(chat_id) if policy.get('negative_cache_ttl') else None
+        results = [False] * len(usernames)
+        positions = [i for i, username in enumerate(usernames)
+                     if generation is None or fresh or not self.is_cached_negative(chat_id, username, generation, policy)]
+        lookup = [usernames[i] for i in positions]
+
+        if not lookup:
+            return results
+
+        if hasattr(reader, 'check_allowed_users'):
+            allowed = await self.with_timeout(reader.check_allowed_users(location, lookup), location)
+        else:
+            semaphore = asyncio.Semaphore(self.BULK_CHECK_CONCURRENCY)
+
+            async def check(username):
+                async with semaphore:
+                    try:
+                        return bool(await self.with_timeout(reader.check_allowed_user(location, username), location))
+                    except Exception as e:
+                        self.logger.warning('Could not check user %s: %s', username, str(e))
+                        return False
+
+            allowed = await asyncio.gather(*[check(username) for username in lookup])
+
+        for i, result in zip(positions, allowed):
+            results[i] = bool(result)
+            if generation is not None and not result:
+                self.negative_results.set((chat_id, usernames[i].lower().removeprefix('@')), generation)
+
+        return results
 
     def dump(self):
         """Dump all whitelist locations from Redis (for backward compatibility)"""
@@ -11,8 +11,35 @@ def main() -> None:
     parser.add_argument('-tg_token', '--telegram_token', action=EnvDefault, envvar='TELEGRAM_TOKEN', help='Telegram token', required=True)
     parser.add_argument('-ds', '--default_source',       action=EnvDefault, envvar='DEFAULT_SOURCE', help='Default whitelist source')
     parser.add_argument('-at', '--api_token',            action=EnvDefault, envvar='API_TOKEN',      help='Default API bearer token')
+    parser.add_argument('-aw', '--api_workers',          action=EnvDefault, envvar='API_WORKERS',    help='Thread pool size for API reader requests', default='8', type=int)
+    parser.add_argument('-ato', '--api_timeout',         action=EnvDefault, envvar='API_TIMEOUT',    help='API reader request timeout, seconds', default='10', type=float)
+    parser.add_argument('-tg_url', '--telegram_base_url', action=EnvDefault, envvar='TELEGRAM_BASE_URL', help='Custom Bot API base URL, e.g. http://localhost:8081/bot')
+    parser.add_argument('-tr', '--telegram_rate',        action=EnvDefault, envvar='TELEGRAM_RATE',  help='Max Bot API message calls (send, edit, delete) per second', default='30', type=float)
+    parser.add_argument('-tcr', '--telegram_chat_rate',  action=EnvDefault, envvar='TELEGRAM_CHAT_RATE', help='Max messages per minute sent to one chat', default='20', type=float)
+    parser.add_argument('-gw', '--gspread_workers',      action=EnvDefault, envvar='GSPREAD_WORKERS', help='Thread pool size for Google Sheets calls', default='4', type=int)
+    parser.add_argument('-gt', '--gspread_timeout',      action=EnvDefault, envvar='GSPREAD_TIMEOUT', help='Google Sheets call timeout, seconds', default='30', type=float)
+    parser.add_argument('-gq', '--gspread_quota',        action=EnvDefault, envvar='GSPREAD_QUOTA',   help='Google Sheets requests per minute', default='60', type=float)
+    parser.add_argument('-cs', '--cache_size',           action=EnvDefault, envvar='CACHE_SIZE',      help='Max entries per reader cache (worksheets, snapshots)', default='1000', type=int)
+    parser.add_argument('-ct', '--cache_ttl',            action=EnvDefault, envvar='CACHE_TTL',       help='Reader cache entry lifetime, seconds', default='3600', type=float)
+    parser.add_argument('-sw', '--snapshot_workers',     action=EnvDefault, envvar='SNAPSHOT_WORKERS', help='Process pool size for large whitelist indexing (default: CPU count)', type=int)
+    parser.add_argument('-spt', '--snapshot_pool_threshold', action=EnvDefault, envvar='SNAPSHOT_POOL_THRESHOLD', help='File size in bytes above which whitelists are indexed in the process pool', default='8388608', type=int)
+    parser.add_argument('-jct', '--join_claim_ttl',      action=EnvDefault, envvar='JOIN_CLAIM_TTL', help='How long a handled join request is remembered to drop duplicate deliveries, seconds', default='3600', type=int)
+    parser.add_argument('-jcp', '--join_claim_processing_ttl', action=EnvDefault, envvar='JOIN_CLAIM_PROCESSING_TTL', help='How long a join request being processed is claimed before another replica may take it over, seconds', default='30', type=int)
+    parser.add_argument('-pri', '--pending_refresh_interval', action=EnvDefault, envvar='PENDING_REFRESH_INTERVAL', help='Re-check all pending join requests every N seconds, a fallback for sources without change events (0 to disable)', default='3600', type=float)
+    parser.add_argument('-pma', '--pending_max_age',     action=EnvDefault, envvar='PENDING_MAX_AGE', help='Forget pending join requests older than N seconds', default='604800', type=int)
+    parser.add_argument('-csm', '--changes_stream_maxlen', action=EnvDefault, envvar='CHANGES_STREAM_MAXLEN', help='Approximate length of the whitelist changes stream (0 to disable)', default='10000', type=int)
+    parser.add_argument('-jam', '--join_audit_maxlen', action=EnvDefault, envvar='JOIN_AUDIT_MAXLEN', help='Approximate length of the join audit stream of each chat (0 to disable)', default='1000', type=int)
+    parser.add_argument('-jaf', '--join_audit_flush_interval', action=EnvDefault, envvar='JOIN_AUDIT_FLUSH_INTERVAL', help='Seconds between join audit log writes', default='1', type=float)
+    parser.add_argument('-rlt', '--refresh_lease_ttl', action=EnvDefault, envvar='REFRESH_LEASE_TTL', help='Seconds a bot replica owns the refresh of a source after its last refresh (0 to disable sharing)', default='30', type=float)
+    parser.add_argument('-psr', '--profile_sample_rate', action=EnvDefault, envvar='PROFILE_SAMPLE_RATE', help='Fraction of join requests and commands profiled by stage (0 to disable)', default='0', type=float)
+    parser.add_argument('-prf', '--profile_file',      action=EnvDefault, envvar='PROFILE_FILE', help='File the aggregated profiles are appended to, as JSON lines', default='profile.jsonl')
+    parser.add_argument('-pai', '--profile_admin_id',  action=EnvDefault, envvar='PROFILE_ADMIN_ID', help='Telegram user id of the bot operator allowed to use /profile (disabled if not set)', type=int)
+    parser.add_argument('-pdi', '--profile_dump_interval', action=EnvDefault, envvar='PROFILE_DUMP_INTERVAL', help='Seconds between profile dumps', default='60', type=float)
     parser.add_argument('-rh', '--redis_host',           action=EnvDefault, envvar='REDIS_HOST',     help='Redis server host', default='localhost')
     parser.add_argument('-rp', '--redis_port',           action=EnvDefault, envvar='REDIS_PORT',     help='Redis server port', default='6379', type=int)
+    parser.add_argument('-rs', '--redis_serializer',     action=EnvDefault, envvar='REDIS_SERIALIZER', help='Encoding of whitelist configs and shared snapshots in Redis: binary or json', default='binary')
+    parser.add_argument('-rct', '--redis_compress_threshold', action=EnvDefault, envvar='REDIS_COMPRESS_THRESHOLD', help='Binary encoded values larger than N bytes are compressed', default='1024', type=int)
+    parser.add_argument('-mp', '--metrics_port',         action=EnvDefault, envvar='METRICS_PORT',   help='Prometheus metrics HTTP port (disabled if not set)', type=int)
 
     args = parser.parse_args()
     config = vars(args)
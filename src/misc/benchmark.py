@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+Offline micro-benchmarks for whitelist readers, condition helpers and Redis value serializers
+
+Synthetic whitelists are generated locally: ReaderFile reads them via file:// URLs and ReaderGspread
+runs against a stubbed worksheet, so no network access or credentials are required.
+
+Run (from the src directory):
+  python3 misc/benchmark.py
+  python3 misc/benchmark.py --sizes 1000,100000 --output bench_results.json
+
+Compare two runs:
+  python3 misc/benchmark.py --output before.json
+  python3 misc/benchmark.py --output after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import gspread
+import gzip
+import json
+import os
+import platform
+import random
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from lib.executor import BlockingExecutor
+from lib.lru_cache import LruCache
+from lib.params import Params
+from lib.condition import Condition
+from lib.reader_file import ReaderFile
+from lib.rate_limiter import TokenBucketScheduler
+from lib.reader_gspread import ReaderGspread
+from lib.serializer import get_serializer
+from lib.snapshot import SortedIndex, build_index
+
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000, 5000000]
+CONDITION = '2 in ("yes", "True")'
+EXPRESSION = '2 in ("yes", "True") and 3 > 18 and not 2 = "maybe"'
+
+
+def generate_usernames(size, seed=42):
+    """Generate deterministic list of unique synthetic usernames"""
+    rnd = random.Random(seed)
+    alphabet = string.ascii_lowercase + string.digits + '_'
+
+    return [f'{rnd.choice(string.ascii_letters)}{''.join(rnd.choices(alphabet, k=8))}{i}' for i in range(size)]
+
+
+def generate_conditions(size, seed=42):
+    """Generate condition column values"""
+    rnd = random.Random(seed)
+
+    return [rnd.choice(['yes', 'no', 'True', 'maybe']) for _ in range(size)]
+
+
+class StubWorksheet:
+    """Worksheet stand-in serving prebuilt columns"""
+    def __init__(self, columns):
+        self.columns = columns
+
+    def batch_get(self, ranges, major_dimension=None):
+        value_ranges = []
+        for a1_range in ranges:
+            start, end = a1_range.split(':')
+            column = gspread.utils.a1_to_rowcol(start.rstrip('0123456789') + '1')[1]
+            limit = int(end.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ') or 0) or None
+            value_ranges.append([self.columns[column][0:limit]])
+
+        return value_ranges
+
+
+class StubSpreadsheet:
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    def get_worksheet(self, index):
+        return self.worksheet
+
+
+class StubClient:
+    def __init__(self, worksheet):
+        self.spreadsheet = StubSpreadsheet(worksheet)
+
+    def open_by_url(self, url):
+        return self.spreadsheet
+
+
+def stub_gspread_reader(usernames, conditions):
+    """ReaderGspread instance wired to a stubbed worksheet, bypassing service account setup"""
+    reader = ReaderGspread.__new__(ReaderGspread)
+    reader.config = {}
+    reader.sources = LruCache('gspread_worksheets')
+    reader.last_values = LruCache('gspread_snapshots')
+    ages = [str(i % 60) for i in range(len(usernames))]
+    reader.reader = StubClient(StubWorksheet({1: usernames, 2: conditions, 3: ages}))
+    reader.executor = BlockingExecutor('gspread', max_workers=1)
+    reader.scheduler = TokenBucketScheduler('gspread', rate_per_minute=1e9)
+
+    return reader
+
+
+def measure(func, repeat=1):
+    """Returns best wall time of func over repeat runs, in seconds"""
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def result(benchmark, size, seconds, ops=1, **extra):
+    entry = {'benchmark': benchmark, 'size': size, 'seconds': seconds, 'ops': ops,
+             'per_op_us': seconds / ops * 1e6}
+    entry.update(extra)
+
+    return entry
+
+
+def measure_peak_memory(func):
+    """Returns peak traced Python memory allocated by func, in bytes"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_reader_file(size, usernames, workdir, repeat):
+    path = Path(workdir) / f'whitelist_{size}.txt'
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('# synthetic whitelist\n')
+        for i, username in enumerate(usernames):
+            f.write(f'@{username}\n' if i % 2 else f'{username}\n')
+
+    gz_path = Path(workdir) / f'whitelist_{size}.txt.gz'
+    with open(path, 'rb') as src, gzip.open(gz_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+
+    reader = ReaderFile({})
+    pool_reader = ReaderFile({'snapshot_pool_threshold': 1})
+    location = {'reader_type': 'file', 'params': {'location': path.as_uri()}}
+    gz_location = {'reader_type': 'file', 'params': {'location': gz_path.as_uri()}}
+
+    results = [
+        result('reader_file.read_users', size,
+               measure(lambda: asyncio.run(reader.read_users(location)), repeat),
+               bytes=path.stat().st_size,
+               peak_bytes=measure_peak_memory(lambda: asyncio.run(reader.read_users(location)))),
+        result('reader_file.read_users.first_3', size,
+               measure(lambda: asyncio.run(reader.read_users(location, 3)), repeat)),
+        result('reader_file.read_index', size,
+               measure(lambda: asyncio.run(reader.read_index(location)), repeat),
+               bytes=path.stat().st_size,
+               peak_bytes=measure_peak_memory(lambda: asyncio.run(reader.read_index(location)))),
+        result('reader_file.read_index.gzip', size,
+               measure(lambda: asyncio.run(reader.read_index(gz_location)), repeat),
+               bytes=gz_path.stat().st_size,
+               peak_bytes=measure_peak_memory(lambda: asyncio.run(reader.read_index(gz_location)))),
+        result('reader_file.read_index.process_pool', size,
+               measure(lambda: asyncio.run(pool_reader.read_index(location)), repeat),
+               bytes=path.stat().st_size,
+               peak_bytes=measure_peak_memory(lambda: asyncio.run(pool_reader.read_index(location)))),
+        result('reader_file.check_allowed_user.hit', size,
+               measure(lambda: asyncio.run(reader.check_allowed_user(location, usernames[-1])), repeat)),
+        result('reader_file.check_allowed_user.miss', size,
+               measure(lambda: asyncio.run(reader.check_allowed_user(location, 'no_such_user')), repeat)),
+    ]
+
+    path.unlink()
+    gz_path.unlink()
+
+    return results
+
+
+def bench_snapshot(size, usernames, repeat):
+    raw = ('\n'.join(usernames) + '\n').encode('utf-8')
+    index = SortedIndex(*build_index(raw))
+    plain = set(usernames)
+    lookups = usernames[::max(1, size // 10000)]
+
+    def lookup_all(container):
+        for username in lookups:
+            username in container
+
+    return [
+        result('snapshot.build_index', size, measure(lambda: build_index(raw), repeat),
+               peak_bytes=measure_peak_memory(lambda: build_index(raw)), index_bytes=index.nbytes()),
+        result('snapshot.sorted_index.lookup', size, measure(lambda: lookup_all(index), repeat), ops=len(lookups)),
+        result('snapshot.set.lookup', size, measure(lambda: lookup_all(plain), repeat), ops=len(lookups)),
+    ]
+
+
+def bench_reader_gspread(size, usernames, conditions, repeat):
+    reader = stub_gspread_reader(usernames, conditions)
+    location = {'reader_type': 'gspread',
+                'params': {'location': 'stub://sheet', 'column': 1, 'sheet': 1,
+                           'condition': Params.parse_condition(CONDITION)}}
+    expression_location = {'reader_type': 'gspread',
+                           'params': {'location': 'stub://sheet', 'column': 1, 'sheet': 1,
+                                      'condition': Params.parse_condition(EXPRESSION)}}
+    plain_location = {'reader_type': 'gspread',
+                      'params': {'location': 'stub://sheet', 'column': 1, 'sheet': 1}}
+
+    return [
+        result('reader_gspread.check_allowed_user.hit', size,
+               measure(lambda: asyncio.run(reader.check_allowed_user(plain_location, usernames[-1])), repeat)),
+        result('reader_gspread.check_allowed_user.miss', size,
+               measure(lambda: asyncio.run(reader.check_allowed_user(plain_location, 'no_such_user')), repeat)),
+        result('reader_gspread.check_allowed_user.condition', size,
+               measure(lambda: asyncio.run(reader.check_allowed_user(location, usernames[-1])), repeat)),
+        result('reader_gspread.check_allowed_user.expression', size,
+               measure(lambda: asyncio.run(reader.check_allowed_user(expression_location, usernames[-1])), repeat)),
+        result('reader_gspread.read_users.first_3', size,
+               measure(lambda: asyncio.run(reader.read_users(plain_location, 3)), repeat)),
+    ]
+
+
+def bench_params(size, conditions, repeat):
+    parse_ops = min(size, 100000)
+    condition = Params.parse_condition(CONDITION)
+
+    def check_all():
+        for value in conditions:
+            Params.check_condition(condition, value, lower_case=True)
+
+    expression = Params.parse_condition(EXPRESSION)
+    values = {2: conditions, 3: [str(i % 60) for i in range(size)]}
+
+    def evaluate_all():
+        check = Condition.compile(expression)
+        for i in range(size):
+            check(values, i)
+
+    return [
+        result('params.parse_condition', size,
+               measure(lambda: [Params.parse_condition(CONDITION) for _ in range(parse_ops)], repeat), ops=parse_ops),
+        result('params.check_condition', size, measure(check_all, repeat), ops=size),
+        result('condition.parse.expression', size,
+               measure(lambda: [Condition.parse(EXPRESSION) for _ in range(parse_ops)], repeat), ops=parse_ops),
+        result('condition.evaluate.expression', size, measure(evaluate_all, repeat), ops=size),
+    ]
+
+
+def bench_serializer(size, usernames, conditions, repeat):
+    """Encoded size and decode time of a chat whitelist config and of a shared gspread snapshot"""
+    config = {'reader_type': 'composite',
+              'params': {'mode': 'union', 'sources': [
+                  {'reader_type': 'gspread', 'params': {'location': 'https://docs.google.com/spreadsheets/d/stub',
+                                                        'column': 1, 'sheet': 1,
+                                                        'condition': Params.parse_condition(EXPRESSION)}},
+                  {'reader_type': 'file', 'params': {'location': 'https://example.com/whitelist.txt',
+                                                     'append_only': True}}]}}
+    snapshot = [usernames, conditions]
+    config_ops = 10000
+    results = []
+
+    for name in ('json', 'binary'):
+        serializer = get_serializer(name)
+        encoded_config = serializer.encode(config)
+        encoded_snapshot = serializer.encode(snapshot)
+
+        results += [
+            result(f'serializer.{name}.decode.config', size,
+                   measure(lambda: [serializer.decode(encoded_config) for _ in range(config_ops)], repeat),
+                   ops=config_ops, encoded_bytes=len(encoded_config)),
+            result(f'serializer.{name}.encode.snapshot', size, measure(lambda: serializer.encode(snapshot), repeat)),
+            result(f'serializer.{name}.decode.snapshot', size, measure(lambda: serializer.decode(encoded_snapshot), repeat),
+                   encoded_bytes=len(encoded_snapshot)),
+        ]
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=Path(__file__).resolve().parent, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_file):
+    """Print relative change of each benchmark against a previous results file"""
+    with open(baseline_file, encoding='utf-8') as f:
+        baseline = {(r['benchmark'], r['size']): r for r in json.load(f)['results']}
+
+    for entry in results:
+        previous = baseline.get((entry['benchmark'], entry['size']))
+        if previous is None or not previous['seconds']:
+            continue
+
+        change = (entry['seconds'] - previous['seconds']) / previous['seconds'] * 100
+        print(f'{entry['benchmark']:<48} {entry['size']:>9} {change:+8.1f}%')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline whitelist reader and condition benchmarks')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)), help='Comma-separated whitelist sizes')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark, best time is reported')
+    parser.add_argument('--output', default='bench_results.json', help='Path of JSON results file')
+    parser.add_argument('--compare', default=None, help='Previous JSON results file to compare with')
+
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            usernames = generate_usernames(size)
+            conditions = generate_conditions(size)
+
+            for entry in (bench_reader_file(size, usernames, workdir, args.repeat)
+                          + bench_snapshot(size, usernames, args.repeat)
+                          + bench_reader_gspread(size, usernames, conditions, args.repeat)
+                          + bench_params(size, conditions, args.repeat)
+                          + bench_serializer(size, usernames, conditions, args.repeat)):
+                peak = f' peak {entry['peak_bytes'] / 1048576:8.1f}MiB' if 'peak_bytes' in entry else ''
+                encoded = f' encoded {entry['encoded_bytes']:>10}B' if 'encoded_bytes' in entry else ''
+                print(f'{entry['benchmark']:<48} {entry['size']:>9} {entry['seconds']:10.4f}s {entry['per_op_us']:12.2f}us/op{peak}{encoded}')
+                results.append(entry)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'results': results,
+    }
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare and os.path.exists(args.compare):
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
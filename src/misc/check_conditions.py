@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Checks that single conditions written for the old regex parser are parsed the same by the expression parser
+
+Every condition of the table is parsed by a copy of the old Params.parse_condition and by the current one;
+the script prints both results and exits with status 1 if any of them differ.
+
+Run (from the src directory):
+  python3 misc/check_conditions.py
+"""
+
+import re
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from lib.params import Params
+
+CONDITIONS = [
+    '2=5',
+    '2 = 5',
+    '2=1.5',
+    '2="5"',
+    '2!=5',
+    '2<10',
+    '2 > 18',
+    '2=yes',
+    '2="yes"',
+    "2='yes'",
+    '2 = "foo bar"',
+    '2=foo bar',
+    '2 = early bird',
+    "3=O'Brien",
+    "3 = 'O'Brien'",
+    "2 = don't know",
+    '2=a=b',
+    '2 != a=b',
+    '2 in (1,2,3,"foo")',
+    '2 in ("yes", "True")',
+    '2 not in (1, 2)',
+    "2 in (don't, O'Brien)",
+    '2 in (foo bar, baz)',
+]
+
+
+def to_number(value):
+    try:
+        return float(value) if '.' in value else int(value)
+    except ValueError:
+        return value
+
+
+def baseline_parse_condition(condition_str):
+    """The old single-condition parser: the first matching pattern wins, values are stripped of quotes"""
+    text = condition_str.strip()
+
+    for operator, pattern in (('not in', r'^(.+?)\s+not\s+in\s+\((.+?)\)$'), ('in', r'^(.+?)\s+in\s+\((.+?)\)$')):
+        match = re.match(pattern, text)
+        if match:
+            values = [to_number(value.strip().strip('"\'')) for value in match.group(2).strip().split(',')]
+            return {'operator': operator, 'value': values, 'param': match.group(1).strip()}
+
+    for operator in ('!=', '<', '>', '='):
+        match = re.match(rf'^(.+?){operator}(.+)$', text)
+        if match:
+            return {'operator': operator, 'value': to_number(match.group(2).strip().strip('"\'')),
+                    'param': match.group(1).strip()}
+
+    return None
+
+
+def main():
+    failed = 0
+
+    for condition in CONDITIONS:
+        expected = baseline_parse_condition(condition)
+        parsed = Params.parse_condition(condition)
+        ok = parsed == expected
+        failed += not ok
+
+        print(f'{"ok  " if ok else "FAIL"} {condition!r}: {parsed}' + ('' if ok else f', expected {expected}'))
+
+    print(f'{len(CONDITIONS) - failed} of {len(CONDITIONS)} conditions parsed as before')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
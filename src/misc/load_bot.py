@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+End-to-end throughput harness: runs TgBot against a local fake Telegram Bot API server
+
+The fake server feeds synthetic chat_join_request and command updates through getUpdates at a configurable
+rate and records approveChatJoinRequest, declineChatJoinRequest, getChatMember and sendMessage calls with
+timestamps. Whitelists are served by the mock server from test_api.py. A local Redis is required.
+
+Run (from the src directory):
+  python3 misc/load_bot.py --rate 200 --duration 30 --chats 10 --users_count 100000 --reader file
+  python3 misc/load_bot.py --rate 50 --reader api --latency lognormal:40:1.0 --output load_results.json
+  python3 misc/load_bot.py --rate 50 --reader file --profile_sample_rate 0.1
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from lib.tg_bot import TgBot
+from lib.profiler import profiler
+from misc.test_api import make_server, load_users
+
+
+BOT_TOKEN = '123456:LOADTEST'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Load', 'username': 'load_test_bot'}
+RECORDED_METHODS = ['approveChatJoinRequest', 'declineChatJoinRequest', 'getChatMember', 'sendMessage', 'deleteMessages']
+UNLIMITED_METHODS = ['getMe', 'getUpdates']
+
+
+class FakeBotApi:
+    """In-memory Bot API state shared by request handler threads"""
+    def __init__(self, flood_limit=0):
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.condition = threading.Condition()
+        self.calls = []
+        self.enqueued_at = {}
+        self.flood_limit = flood_limit
+        self.flood_window = (0, 0)
+        self.flood_responses = 0
+
+    def push(self, update, key=None):
+        with self.condition:
+            update['update_id'] = self.next_update_id
+            self.next_update_id += 1
+            self.updates.append(update)
+            if key is not None:
+                self.enqueued_at[key] = time.perf_counter()
+            self.condition.notify_all()
+
+    def get_updates(self, offset, limit, timeout):
+        deadline = time.monotonic() + min(timeout, 1.0)
+
+        with self.condition:
+            # Drop confirmed updates
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+
+            while not self.updates and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+
+            return self.updates[0:limit]
+
+    def throttle(self):
+        """Returns retry_after seconds if calls in the current second exceed flood_limit, like Bot API 429"""
+        if not self.flood_limit:
+            return None
+
+        with self.condition:
+            second = int(time.monotonic())
+            window_second, count = self.flood_window
+            count = count + 1 if window_second == second else 1
+            self.flood_window = (second, count)
+
+            if count > self.flood_limit:
+                self.flood_responses += 1
+                return 1
+
+        return None
+
+    def record(self, method, params):
+        if method in RECORDED_METHODS:
+            with self.condition:
+                self.calls.append((time.perf_counter(), method, params))
+
+    def message(self, chat_id, text=''):
+        with self.condition:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+
+        return {'message_id': message_id, 'date': int(time.time()), 'text': text,
+                'chat': {'id': int(chat_id), 'type': 'supergroup', 'title': f'Chat {chat_id}'}}
+
+
+def make_bot_api_server(api, port=0):
+    class BotApiHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            method = self.path.rstrip('/').split('/')[-1]
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+            params = {k: v[0] for k, v in parse_qs(body).items()}
+
+            retry_after = api.throttle() if method not in UNLIMITED_METHODS else None
+            if retry_after:
+                self.respond(429, {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {retry_after}',
+                                   'parameters': {'retry_after': retry_after}})
+                return
+
+            api.record(method, params)
+
+            match method:
+                case 'getMe':
+                    result = BOT_USER
+                case 'getUpdates':
+                    result = api.get_updates(int(params.get('offset', 0)), int(params.get('limit', 100)),
+                                             float(params.get('timeout', 0)))
+                case 'getChatMember':
+                    result = {'status': 'left', 'user': {'id': int(params['user_id']), 'is_bot': False,
+                                                         'first_name': 'User'}}
+                case 'sendMessage':
+                    result = api.message(params['chat_id'], params.get('text', ''))
+                case _:
+                    result = True
+
+            self.respond(200, {'ok': True, 'result': result})
+
+        def respond(self, code, data):
+            response = json.dumps(data).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            try:
+                self.wfile.write(response)
+            except (BrokenPipeError, ConnectionResetError):
+                # Long polling request cancelled by the bot on shutdown
+                pass
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            return
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), BotApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def join_update(chat_id, user_id, username):
+    return {'chat_join_request': {
+        'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'Chat {chat_id}'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': username},
+        'user_chat_id': user_id,
+        'date': int(time.time()),
+    }}
+
+
+def command_update(chat_id, user_id, text):
+    command = text.split(' ')[0]
+
+    return {'message': {
+        'message_id': random.randint(1, 1 << 30),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'Chat {chat_id}'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Admin'},
+        'text': text,
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+    }}
+
+
+def percentile(values, p):
+    if not values:
+        return None
+
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def produce(api, args, chat_ids, users):
+    """Feed join and command updates at the configured rates"""
+    started = time.perf_counter()
+    sent = 0
+    commands = 0
+
+    while time.perf_counter() - started < args.duration:
+        elapsed = time.perf_counter() - started
+
+        while sent < elapsed * args.rate:
+            chat_id = random.choice(chat_ids)
+            user_id = 1000000 + sent
+            if random.random() < args.allowed_ratio:
+                username = random.choice(users)
+            else:
+                username = f'stranger{sent}'
+
+            api.push(join_update(chat_id, user_id, username), key=(chat_id, user_id))
+            sent += 1
+
+        while args.command_rate and commands < elapsed * args.command_rate:
+            api.push(command_update(random.choice(chat_ids), 42, f'/test_user {random.choice(users)}'))
+            commands += 1
+
+        await asyncio.sleep(0.005)
+
+    return sent
+
+
+async def run(args):
+    api = FakeBotApi(flood_limit=args.flood_limit)
+    bot_api_server = make_bot_api_server(api, args.bot_api_port)
+    base_url = f'http://127.0.0.1:{bot_api_server.server_address[1]}/bot'
+
+    users = load_users(users_count=args.users_count)
+    whitelist_server = make_server('127.0.0.1', 0, users=users, latency=args.latency, error_rate=args.error_rate)
+    threading.Thread(target=whitelist_server.serve_forever, daemon=True).start()
+    whitelist_url = f'http://127.0.0.1:{whitelist_server.server_address[1]}'
+
+    config = {'telegram_token': BOT_TOKEN, 'telegram_base_url': base_url,
+              'redis_host': args.redis_host, 'redis_port': args.redis_port, 'telegram_rate': args.telegram_rate,
+              'profile_sample_rate': args.profile_sample_rate}
+    bot = TgBot(BOT_TOKEN, config)
+    bot.logger.setLevel('WARNING')
+
+    chat_ids = [-1000000000000 - i for i in range(args.chats)]
+    for chat_id in chat_ids:
+        if args.reader == 'file':
+            bot.whitelist.set_whitelist_params(chat_id, ['file', f'location={whitelist_url}/users.txt'])
+        else:
+            bot.whitelist.set_whitelist_params(chat_id, ['api', f'location={whitelist_url}/check-user/{{username}}', 'token='])
+        bot.options.set_option(chat_id, 'delete_declined_requests', True)
+        bot.options.set_option(chat_id, 'delete_commands', False)
+
+    # Time TgBot.join_request itself
+    decision_latencies = []
+    join_request = bot.join_request
+
+    async def timed_join_request(update, context):
+        start = time.perf_counter()
+        await join_request(update, context)
+        decision_latencies.append(time.perf_counter() - start)
+
+    bot.join_request = timed_join_request
+    bot.register_handlers()
+
+    async with bot.app:
+        await bot.app.start()
+        await bot.app.updater.start_polling(poll_interval=0, timeout=1)
+
+        started = time.perf_counter()
+        sent = await produce(api, args, chat_ids, users)
+
+        # Let in-flight requests drain
+        drain_deadline = time.perf_counter() + args.drain
+        while len(decision_latencies) < sent and time.perf_counter() < drain_deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+
+        await bot.app.updater.stop()
+        await bot.app.stop()
+
+    bot_api_server.shutdown()
+    whitelist_server.shutdown()
+
+    # End-to-end latency: update enqueued -> approve/decline call received
+    e2e_latencies = []
+    for ts, method, params in api.calls:
+        if method in ['approveChatJoinRequest', 'declineChatJoinRequest']:
+            key = (int(params['chat_id']), int(params['user_id']))
+            if key in api.enqueued_at:
+                e2e_latencies.append(ts - api.enqueued_at[key])
+
+    report = {
+        'reader': args.reader,
+        'target_rate': args.rate,
+        'duration': elapsed,
+        'joins_sent': sent,
+        'joins_processed': len(decision_latencies),
+        'joins_per_second': len(decision_latencies) / elapsed if elapsed else 0,
+        'decision_p50_ms': (percentile(decision_latencies, 50) or 0) * 1000,
+        'decision_p99_ms': (percentile(decision_latencies, 99) or 0) * 1000,
+        'e2e_p50_ms': (percentile(e2e_latencies, 50) or 0) * 1000,
+        'e2e_p99_ms': (percentile(e2e_latencies, 99) or 0) * 1000,
+        'calls': dict(Counter(method for _, method, _ in api.calls)),
+        'flood_responses': api.flood_responses,
+    }
+
+    if args.profile_sample_rate:
+        report['profile'] = profiler.summary()
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end join request throughput harness')
+    parser.add_argument('--rate', type=float, default=50, help='Join requests per second')
+    parser.add_argument('--command_rate', type=float, default=0, help='Command updates per second')
+    parser.add_argument('--duration', type=float, default=10, help='Load duration in seconds')
+    parser.add_argument('--drain', type=float, default=10, help='Max seconds to wait for in-flight requests')
+    parser.add_argument('--chats', type=int, default=5, help='Number of chats')
+    parser.add_argument('--users_count', type=int, default=10000, help='Whitelisted users count')
+    parser.add_argument('--allowed_ratio', type=float, default=0.8, help='Fraction of join requests from whitelisted users')
+    parser.add_argument('--reader', choices=['file', 'api'], default='file', help='Whitelist reader type')
+    parser.add_argument('--latency', default=None, help='Whitelist server latency distribution, see test_api.py')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Whitelist server error rate')
+    parser.add_argument('--telegram_rate', type=float, default=30, help='Bot outbound Bot API calls per second')
+    parser.add_argument('--flood_limit', type=int, default=0, help='Fake Bot API calls per second before 429 responses (0: no limit)')
+    parser.add_argument('--bot_api_port', type=int, default=0, help='Fake Bot API port (random if 0)')
+    parser.add_argument('--redis_host', default='localhost', help='Redis server host')
+    parser.add_argument('--redis_port', type=int, default=6379, help='Redis server port')
+    parser.add_argument('--profile_sample_rate', type=float, default=0, help='Fraction of join requests and commands profiled by stage, reported per stage')
+    parser.add_argument('--output', default=None, help='Path of JSON results file')
+
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
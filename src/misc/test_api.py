@@ -1,32 +1,85 @@
 #!/usr/bin/env python3
 """
-Simple webserver to test ReaderApi class
+Mock whitelist server to test and load test ReaderApi and ReaderFile
 
 Run:
   Without auth:
-  
+
   python3 src/misc/test_api.py --port 8080
 
 With auth:
   python3 src/misc/test_api.py --port 8080 --token secret123
 
+Load testing with 1M generated users, 20-200 ms latency, 1% errors and throttled file body:
+  python3 src/misc/test_api.py --port 8080 --users_count 1000000 --latency uniform:20:200 \\
+      --error_rate 0.01 --body_rate 1048576
+
 Examples:
   curl 'http://localhost:8080/check-user/bob'
   curl 'http://localhost:8080/check-user?username=BillGates'
   curl -H 'Authorization: Bearer secret123' 'http://localhost:8080/check-user/JohnDoe'
+  curl 'http://localhost:8080/users.txt'
+  curl -H 'If-None-Match: "<etag>"' -i 'http://localhost:8080/users.txt'
+  curl -H 'Range: bytes=100-' -i 'http://localhost:8080/users.txt'
+
+Latency distributions (milliseconds): fixed:<ms>, uniform:<min>:<max>, exp:<mean>, lognormal:<median>:<sigma>
 """
 
 import argparse
+import hashlib
 import json
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import urlparse, parse_qs
 
 
 KNOWN_USERS = {u.lower().lstrip('@') for u in ['gtjuks', 'bob', 'JohnDoe']}
 
 
+class Latency:
+    """Random latency generator parsed from a distribution spec"""
+    def __init__(self, spec=None):
+        self.kind = 'none'
+        self.args = []
+
+        if spec:
+            parts = spec.split(':')
+            self.kind = parts[0]
+            self.args = [float(a) for a in parts[1:]]
+
+            if self.kind not in ['fixed', 'uniform', 'exp', 'lognormal']:
+                raise ValueError(f'Unknown latency distribution: {self.kind}')
+
+    def sample(self):
+        """Returns delay in seconds"""
+        match self.kind:
+            case 'fixed':
+                ms = self.args[0]
+            case 'uniform':
+                ms = random.uniform(self.args[0], self.args[1])
+            case 'exp':
+                ms = random.expovariate(1 / self.args[0])
+            case 'lognormal':
+                ms = random.lognormvariate(math.log(self.args[0]), self.args[1])
+            case _:
+                ms = 0
+
+        return max(ms, 0) / 1000
+
+
 class CheckUserHandler(BaseHTTPRequestHandler):
     configured_token = None
+    known_users = KNOWN_USERS
+    users_body = b''
+    users_etag = None
+    users_lock = threading.Lock()
+    latency = Latency()
+    error_rate = 0.0
+    body_rate = 0
+    chunk_size = 16384
 
     def _send_json(self, obj, status_code=200):
         response_bytes = json.dumps(obj).encode('utf-8')
@@ -36,27 +89,85 @@ class CheckUserHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(response_bytes)
 
+    def _send_body(self, body, content_type, headers=None, status_code=200):
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        if not self.body_rate:
+            self.wfile.write(body)
+            return
+
+        # Slow body: write in chunks, sleeping to keep the configured byte rate
+        for offset in range(0, len(body), self.chunk_size):
+            chunk = body[offset:offset + self.chunk_size]
+            self.wfile.write(chunk)
+            self.wfile.flush()
+            time.sleep(len(chunk) / self.body_rate)
+
     def _unauthorized(self):
         self._send_json({'error': 'unauthorized'}, status_code=401)
 
+    def _authorized(self):
+        if not self.configured_token:
+            return True
+
+        return self.headers.get('Authorization') == f'Bearer {self.configured_token}'
+
     def do_GET(self):
         parsed = urlparse(self.path)
 
+        delay = self.latency.sample()
+        if delay:
+            time.sleep(delay)
+
+        if self.error_rate and random.random() < self.error_rate:
+            return self._send_json({'error': 'injected failure'}, status_code=random.choice([500, 502, 503]))
+
         if parsed.path.startswith('/check-user'):
-            if self.configured_token:
-                auth_header = self.headers.get('Authorization')
-                expected = f'Bearer {self.configured_token}'
-                if auth_header != expected:
-                    return self._unauthorized()
+            if not self._authorized():
+                return self._unauthorized()
 
             username = self._extract_username(parsed)
             if username is None or username == '':
                 return self._send_json({'error': 'username is required'}, status_code=400)
 
             normalized = username.lower().lstrip('@')
-            allowed = normalized in KNOWN_USERS
+            allowed = normalized in self.known_users
             return self._send_json({'result': allowed})
 
+        if parsed.path == '/users.txt':
+            if not self._authorized():
+                return self._unauthorized()
+
+            with self.users_lock:
+                users_body, users_etag = self.users_body, self.users_etag
+
+            if self.headers.get('If-None-Match') == users_etag:
+                self.send_response(304)
+                self.send_header('ETag', users_etag)
+                self.end_headers()
+                return
+
+            range_header = self.headers.get('Range', '')
+            if range_header.startswith('bytes=') and range_header.endswith('-'):
+                start = int(range_header[len('bytes='):-1])
+                if start >= len(users_body):
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{len(users_body)}')
+                    self.end_headers()
+                    return
+
+                return self._send_body(users_body[start:], 'text/plain; charset=utf-8',
+                                       {'ETag': users_etag,
+                                        'Content-Range': f'bytes {start}-{len(users_body) - 1}/{len(users_body)}'},
+                                       status_code=206)
+
+            return self._send_body(users_body, 'text/plain; charset=utf-8', {'ETag': users_etag})
+
         self._send_json({'error': 'not found'}, status_code=404)
 
     def log_message(self, format, *args):
@@ -74,17 +185,74 @@ class CheckUserHandler(BaseHTTPRequestHandler):
         return None
 
 
+def load_users(users_file=None, users_count=0):
+    """Build user set from file lines and/or generated user<N> names"""
+    users = list(KNOWN_USERS)
+
+    if users_file:
+        with open(users_file, encoding='utf-8') as f:
+            users += [line.strip().lower().lstrip('@') for line in f if line.strip() and not line.startswith('#')]
+
+    users += [f'user{i}' for i in range(users_count)]
+
+    return users
+
+
+def append_users(users):
+    """Append usernames to the served user set and file, as a registration system would"""
+    with CheckUserHandler.users_lock:
+        CheckUserHandler.known_users.update(users)
+        CheckUserHandler.users_body += ('\n'.join(users) + '\n').encode('utf-8')
+        CheckUserHandler.users_etag = '"' + hashlib.sha1(CheckUserHandler.users_body).hexdigest() + '"'
+
+
+def append_forever(rate):
+    """Append generated appended<N> usernames at given rate per second"""
+    count = 0
+    while True:
+        time.sleep(1)
+        append_users([f'appended{count + i}' for i in range(rate)])
+        count += rate
+
+
+def make_server(host, port, token=None, users=None, latency=None, error_rate=0.0, body_rate=0):
+    """Configure handler and create threaded server"""
+    users = users if users is not None else list(KNOWN_USERS)
+    users_body = ('\n'.join(users) + '\n').encode('utf-8')
+
+    CheckUserHandler.configured_token = token
+    CheckUserHandler.known_users = set(users)
+    CheckUserHandler.users_body = users_body
+    CheckUserHandler.users_etag = '"' + hashlib.sha1(users_body).hexdigest() + '"'
+    CheckUserHandler.latency = Latency(latency)
+    CheckUserHandler.error_rate = error_rate
+    CheckUserHandler.body_rate = body_rate
+
+    server = ThreadingHTTPServer((host, port), CheckUserHandler)
+    server.daemon_threads = True
+
+    return server
+
+
 def main():
-    parser = argparse.ArgumentParser(description='Simple test API server with optional Bearer auth')
+    parser = argparse.ArgumentParser(description='Mock whitelist server with optional Bearer auth and fault injection')
     parser.add_argument('--host', default='0.0.0.0', help='Host to bind')
     parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
     parser.add_argument('--token', default=None, help='If set, require Authorization: Bearer <token>')
+    parser.add_argument('--users_file', default=None, help='Text file with extra usernames, one per line')
+    parser.add_argument('--users_count', type=int, default=0, help='Number of generated user<N> usernames')
+    parser.add_argument('--latency', default=None, help='Response latency distribution, e.g. uniform:20:200')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of requests failing with 5xx')
+    parser.add_argument('--body_rate', type=int, default=0, help='Throttle response bodies to given bytes per second')
+    parser.add_argument('--append_rate', type=int, default=0, help='Append given number of users to /users.txt per second')
 
     args = parser.parse_args()
 
-    CheckUserHandler.configured_token = args.token
+    server = make_server(args.host, args.port, token=args.token, users=load_users(args.users_file, args.users_count),
+                         latency=args.latency, error_rate=args.error_rate, body_rate=args.body_rate)
 
-    server = HTTPServer((args.host, args.port), CheckUserHandler)
+    if args.append_rate:
+        threading.Thread(target=append_forever, args=(args.append_rate,), daemon=True).start()
     try:
         server.serve_forever()
     except KeyboardInterrupt: